@@ -2,8 +2,28 @@ from flask import Flask
 from flask_cors import CORS
 from .blueprints.orders import orders_blueprint
 
-app = Flask(__name__)
-cors = CORS(app)
 
-# register orders blueprint to add all orders endpoints
-app.register_blueprint(orders_blueprint)
\ No newline at end of file
+def create_app(config=None):
+    """ creates the flask app, no database connection is made until the first request or cli command
+
+    The orders session, caches and job queue are module globals that the app
+    configures, so only one app per process is supported.  wsgi.py builds the
+    app of the server process.
+
+    Args:
+        config (dict, optional): settings that override the ORDERS_SETTINGS file, see orders/database.py for the available keys
+
+    Returns:
+        Flask: the app
+    """
+    app = Flask(__name__)
+    CORS(app)
+
+    # optional settings file (database url, pool size, etc), see orders/database.py for the available keys
+    app.config.from_envvar('ORDERS_SETTINGS', silent=True)
+    if config:
+        app.config.update(config)
+
+    # register orders blueprint to add all orders endpoints
+    app.register_blueprint(orders_blueprint)
+    return app
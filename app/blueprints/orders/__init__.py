@@ -1,5 +1,7 @@
 from flask_restx import Api
 from .controller import orders_blueprint, namespaces
+from .serializers import output_json
+from . import commands
 
 # create swagger api
 orders_swagger_api = Api(
@@ -9,6 +11,9 @@ orders_swagger_api = Api(
     doc="/orders/help" #/orders/help
 )
 
+# encode the responses with the same (fastest available) encoder as the cached and streamed bodies
+orders_swagger_api.representation('application/json')(output_json)
+
 # register all namespaces
 for ns in namespaces:
     orders_swagger_api.add_namespace(ns)
\ No newline at end of file
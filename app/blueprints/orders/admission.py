@@ -0,0 +1,412 @@
+""" admission control for the orders api: per client and per route rate limits, and a priority queue in front
+of the database
+
+Every request takes a token from its client's bucket (ORDERS_RATE_LIMIT) and
+from its client's bucket on its route (ORDERS_ROUTE_RATE_LIMITS), an empty
+bucket answers 429.  Admitted requests then wait, by priority (writes, reads,
+bulk reads), for one of ORDERS_ADMISSION_CONCURRENCY slots, so a burst queues
+here instead of on the pool and the sqlite lock.  A full queue or a wait over
+ORDERS_ADMISSION_MAX_WAIT answers 503.  The slots are per process, set
+ORDERS_RATE_LIMIT_BACKEND (e.g. RedisRateLimitStore) to share the buckets.
+"""
+import asyncio
+import bisect
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from .database import DEFAULT_CONFIG as DATABASE_CONFIG
+from .utils import dynamic_error
+
+DEFAULT_CONFIG = {
+    'ORDERS_ADMISSION_ENABLED': True,
+    # header that identifies a client, the remote address is used without it
+    'ORDERS_ADMISSION_CLIENT_HEADER': 'X-Client-ID',
+    # (requests per second, burst) for each client over all routes, None for no limit
+    'ORDERS_RATE_LIMIT': None,
+    # "METHOD /rule" -> (requests per second, burst) for each client on that route, e.g. {'GET /items': (5, 10)}
+    'ORDERS_ROUTE_RATE_LIMITS': {},
+    # an instance of a RateLimitStore, the in process MemoryRateLimitStore is used when this is None
+    'ORDERS_RATE_LIMIT_BACKEND': None,
+    'ORDERS_RATE_LIMIT_MAX_CLIENTS': 10000,
+    # requests handled at the same time, defaults to ORDERS_POOL_SIZE + ORDERS_MAX_OVERFLOW, 0 for no limit
+    'ORDERS_ADMISSION_CONCURRENCY': None,
+    # slots the bulk reads can hold at the same time
+    'ORDERS_ADMISSION_BULK_CONCURRENCY': 4,
+    # requests that can wait for a slot, more are answered with 503 right away
+    'ORDERS_ADMISSION_QUEUE_SIZE': 64,
+    # longest a request waits for a slot (seconds)
+    'ORDERS_ADMISSION_MAX_WAIT': 5.0,
+    # GET routes that read many rows, they wait behind the other requests
+    'ORDERS_BULK_ROUTES': ['/orders', '/items', '/customers', '/orders/export', '/items/export', '/reports/<string:name>', '/search'],
+    # routes that do not wait for a slot, they do not hold a connection for long (or only wait on other requests),
+    # /changes long polls and streams are limited by ORDERS_CHANGES_MAX_WAITERS instead
+    'ORDERS_ADMISSION_EXEMPT_ROUTES': ['/orders/_metrics', '/orders/cache-stats', '/changes', '/changes/latest', '/orders/help', '/swagger.json']
+}
+
+# priorities, lower is admitted first
+WRITE, READ, BULK = 0, 1, 2
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# why a request was shed
+RATE_LIMITED, QUEUE_FULL, TIMED_OUT = 'rate_limited', 'queue_full', 'timed_out'
+
+# set on the wsgi environ by the async app (see aio.py) for requests whose rate limits it already applied
+RATE_CHECKED_KEY = 'orders.rate_checked'
+
+# set on the wsgi environ by the async app to the reason it could not get a slot for a request, flask answers the 503
+SHED_KEY = 'orders.shed'
+
+
+def is_stream(value):
+    """ True for a stream query arg that turns streaming on, like flask_restx.inputs.boolean """
+    return value is not None and str(value).lower() in ('true', '1')
+
+
+class Overloaded(Exception):
+    """ raised when a request cannot get a slot, reason is QUEUE_FULL or TIMED_OUT """
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+#***********************************************************************************************************##
+#  RATE LIMITS                                                                                              ##
+#***********************************************************************************************************##
+class RateLimitStore:
+    """ interface for token bucket storage
+
+    A bucket holds up to burst tokens and refills rate tokens per second, every request takes one.
+    """
+    # True when take() does not leave the process, the async app calls it on the event loop then
+    local = False
+
+    def take(self, key, rate, burst):
+        """ takes a token from a bucket
+
+        Returns:
+            float: 0 when a token was taken, otherwise the seconds until the bucket has one again
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """ refills every bucket """
+        raise NotImplementedError
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """ thread safe in process buckets, the least recently used are dropped (refilled) beyond max_entries """
+    local = True
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# refills and takes in one step on the redis server, with the server's clock
+_TAKE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+class RedisRateLimitStore(RateLimitStore):
+    """ buckets shared by every process, on a redis-like client (anything with eval, keys and delete) """
+
+    def __init__(self, client, prefix='orders-rate:'):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, rate, burst):
+        wait = self.client.eval(_TAKE_SCRIPT, 1, self.prefix + key, rate, burst)
+        return float(wait.decode('utf-8') if isinstance(wait, bytes) else wait)
+
+    def clear(self):
+        for key in self.client.keys(self.prefix + '*'):
+            self.client.delete(key)
+
+
+#***********************************************************************************************************##
+#  CONCURRENCY                                                                                              ##
+#***********************************************************************************************************##
+class _Waiter:
+    __slots__ = ('priority', 'order', 'wake', 'admitted')
+
+    def __init__(self, priority, order, wake):
+        self.priority = priority
+        self.order = order
+        # called (under the queue lock) once the waiter has a slot
+        self.wake = wake
+        self.admitted = False
+
+    def __lt__(self, other):
+        return (self.priority, self.order) < (other.priority, other.order)
+
+
+class AdmissionQueue:
+    """ counting semaphore whose waiters get a free slot by priority, then in the order they came
+
+    Args:
+        slots (int): requests that can run at the same time
+        bulkSlots (int): how many of the slots BULK requests can hold
+        queueSize (int): requests that can wait
+    """
+    def __init__(self, slots, bulkSlots, queueSize):
+        self.slots = slots
+        self.bulkSlots = bulkSlots
+        self.queueSize = queueSize
+        self.running = 0
+        self.bulkRunning = 0
+        self._waiting = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def _fits(self, priority):
+        return self.running < self.slots and (priority != BULK or self.bulkRunning < self.bulkSlots)
+
+    def _start(self, priority):
+        self.running += 1
+        if priority == BULK:
+            self.bulkRunning += 1
+
+    def _enqueue(self, priority, wake):
+        """ takes a slot right away and returns None, or queues a waiter that is woken once it has one """
+        with self._lock:
+            # a request never passes one of the same or a higher priority that is already waiting
+            if self._fits(priority) and not any(waiter.priority <= priority for waiter in self._waiting):
+                self._start(priority)
+                return None
+            if len(self._waiting) >= self.queueSize:
+                raise Overloaded(QUEUE_FULL)
+            waiter = _Waiter(priority, next(self._order), wake)
+            bisect.insort(self._waiting, waiter)
+            return waiter
+
+    def _abandon(self, waiter):
+        """ removes a waiter that stopped waiting, returns False when it was admitted in the meantime """
+        with self._lock:
+            if waiter.admitted:
+                return False
+            self._waiting.remove(waiter)
+            return True
+
+    def acquire(self, priority, timeout):
+        """ waits for a slot
+
+        Raises:
+            Overloaded: when the queue is full or no slot was free within timeout seconds
+        """
+        event = threading.Event()
+        waiter = self._enqueue(priority, event.set)
+        if waiter is None or event.wait(timeout) or not self._abandon(waiter):
+            return
+        raise Overloaded(TIMED_OUT)
+
+    async def acquire_async(self, priority, timeout):
+        """ like acquire(), but waits on the running event loop instead of blocking a thread """
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: admitted.done() or admitted.set_result(True))
+
+        waiter = self._enqueue(priority, wake)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(admitted), timeout)
+        except asyncio.TimeoutError:
+            if self._abandon(waiter):
+                raise Overloaded(TIMED_OUT)
+        except asyncio.CancelledError:
+            # the client went away, hand the slot on if it was granted meanwhile
+            if not self._abandon(waiter):
+                self.release(priority)
+            raise
+
+    def release(self, priority):
+        """ frees the slot of a finished request and hands the free slots to the waiters that fit first """
+        with self._lock:
+            self.running -= 1
+            if priority == BULK:
+                self.bulkRunning -= 1
+            for waiter in list(self._waiting):
+                if self.running >= self.slots:
+                    break
+                if self._fits(waiter.priority):
+                    self._waiting.remove(waiter)
+                    self._start(waiter.priority)
+                    waiter.admitted = True
+                    waiter.wake()
+
+
+#***********************************************************************************************************##
+#  REQUEST HOOKS                                                                                            ##
+#***********************************************************************************************************##
+class AdmissionControl:
+    """ sheds requests over their rate limits and queues the others for a limited number of slots """
+    def __init__(self):
+        self.enabled = DEFAULT_CONFIG['ORDERS_ADMISSION_ENABLED']
+        self.clientHeader = DEFAULT_CONFIG['ORDERS_ADMISSION_CLIENT_HEADER']
+        self.rateLimit = DEFAULT_CONFIG['ORDERS_RATE_LIMIT']
+        self.routeRateLimits = {}
+        self.store = MemoryRateLimitStore()
+        self.maxWait = DEFAULT_CONFIG['ORDERS_ADMISSION_MAX_WAIT']
+        self.bulkRoutes = set(DEFAULT_CONFIG['ORDERS_BULK_ROUTES'])
+        self.exemptRoutes = set(DEFAULT_CONFIG['ORDERS_ADMISSION_EXEMPT_ROUTES'])
+        self.queue = None
+        self.rejected = {RATE_LIMITED: 0, QUEUE_FULL: 0, TIMED_OUT: 0}
+        # guards the counters, the requests are shed from many threads
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.enabled = app.config['ORDERS_ADMISSION_ENABLED']
+        self.clientHeader = app.config['ORDERS_ADMISSION_CLIENT_HEADER']
+        self.rateLimit = app.config['ORDERS_RATE_LIMIT']
+        self.routeRateLimits = dict(app.config['ORDERS_ROUTE_RATE_LIMITS'])
+        self.store = app.config['ORDERS_RATE_LIMIT_BACKEND'] or MemoryRateLimitStore(app.config['ORDERS_RATE_LIMIT_MAX_CLIENTS'])
+        self.maxWait = app.config['ORDERS_ADMISSION_MAX_WAIT']
+        self.bulkRoutes = set(app.config['ORDERS_BULK_ROUTES'])
+        self.exemptRoutes = set(app.config['ORDERS_ADMISSION_EXEMPT_ROUTES'])
+
+        slots = app.config['ORDERS_ADMISSION_CONCURRENCY']
+        if slots is None:
+            slots = app.config.get('ORDERS_POOL_SIZE', DATABASE_CONFIG['ORDERS_POOL_SIZE']) + app.config.get('ORDERS_MAX_OVERFLOW', DATABASE_CONFIG['ORDERS_MAX_OVERFLOW'])
+        bulkSlots = min(slots, app.config['ORDERS_ADMISSION_BULK_CONCURRENCY'] or slots)
+        self.queue = AdmissionQueue(slots, bulkSlots, app.config['ORDERS_ADMISSION_QUEUE_SIZE']) if slots else None
+
+    def client_id(self, header, address):
+        """ returns the client a request counts against, from the client header or else the remote address """
+        return header or address or 'unknown'
+
+    def priority(self, method, rule, stream=False):
+        """ returns WRITE for changes, BULK for the ORDERS_BULK_ROUTES and streams, otherwise READ """
+        if method not in READ_METHODS:
+            return WRITE
+        return BULK if stream or rule in self.bulkRoutes else READ
+
+    def check_rates(self, client, method, rule):
+        """ takes a token from the route bucket and then the client bucket of a request
+
+        Returns:
+            float: 0 when the request is within its limits, otherwise the seconds until it would be
+        """
+        if not self.enabled:
+            return 0.0
+        limit = self.routeRateLimits.get(f'{method} {rule}')
+        if limit:
+            wait = self.store.take(f'route:{method} {rule}:{client}', *limit)
+            if wait:
+                return wait
+        if self.rateLimit:
+            return self.store.take(f'client:{client}', *self.rateLimit)
+        return 0.0
+
+    def _reject(self, code, description, reason, retryAfter, message):
+        with self._lock:
+            self.rejected[reason] += 1
+        response = dynamic_error(code=code, description=description, message=message)
+        response.headers['Retry-After'] = str(max(1, math.ceil(retryAfter)))
+        return response
+
+    def admit(self):
+        """ before_request hook: applies the rate limits and waits for a slot, returns a 429 or 503 for shed requests """
+        if not self.enabled or request.url_rule is None:
+            return None
+        rule = request.url_rule.rule
+        if not request.environ.get(RATE_CHECKED_KEY):
+            wait = self.check_rates(self.client_id(request.headers.get(self.clientHeader), request.remote_addr), request.method, rule)
+            if wait:
+                return self._reject(429, 'Too Many Requests', RATE_LIMITED, wait, f'Rate limit exceeded, retry in {wait:.1f} seconds')
+
+        shed = request.environ.get(SHED_KEY)
+        if shed:
+            return self._reject(503, 'Service Unavailable', shed, 1, 'The server is busy, retry later')
+        if self.queue is None or rule in self.exemptRoutes:
+            return None
+        priority = self.priority(request.method, rule, is_stream(request.args.get('stream')))
+        try:
+            self.queue.acquire(priority, self.maxWait)
+        except Overloaded as e:
+            return self._reject(503, 'Service Unavailable', e.reason, 1, 'The server is busy, retry later')
+        g._orders_admission = (self.queue, priority)
+        return None
+
+    def release(self, exc=None):
+        """ teardown_request hook: frees the slot, streamed responses keep it until the stream is closed """
+        admitted = g.pop('_orders_admission', None)
+        if admitted is not None:
+            queue, priority = admitted
+            queue.release(priority)
+
+    @property
+    def stats(self):
+        with self._lock:
+            rejected = dict(self.rejected)
+        return {
+            'rejected': rejected,
+            'running': self.queue.running if self.queue else 0,
+            'waiting': self.queue.waiting if self.queue else 0
+        }
+
+    def render(self):
+        """ the admission counters in the prometheus text exposition format """
+        stats = self.stats
+        lines = [
+            '# HELP orders_admission_rejected_total Requests shed by admission control',
+            '# TYPE orders_admission_rejected_total counter'
+        ]
+        lines += [f'orders_admission_rejected_total{{reason="{reason}"}} {count}' for reason, count in sorted(stats['rejected'].items())]
+        lines += [
+            '# HELP orders_admission_running Requests holding a slot',
+            '# TYPE orders_admission_running gauge',
+            f'orders_admission_running {stats["running"]}',
+            '# HELP orders_admission_waiting Requests waiting for a slot',
+            '# TYPE orders_admission_waiting gauge',
+            f'orders_admission_waiting {stats["waiting"]}'
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+# shared admission control for the orders api
+admission_control = AdmissionControl()
@@ -0,0 +1,388 @@
+""" time partitioned archive of old orders, read back only when a date range reaches it
+
+Orders created before a cutoff are moved with their items into one pair of
+tables per year (OrderHeader_2018, OrderItem_2018), ORDERS_ARCHIVE_BATCH_SIZE
+orders per transaction, so a stopped run can simply be started again.  The
+ArchivePartition table keeps the counts and cutoff of each year.  The list
+routes and reports read an archived year only when their date range reaches
+it, GET /orders/<id> only when the id is not in the hot table.
+"""
+import datetime
+import heapq
+import re
+import threading
+from operator import attrgetter
+from sqlalchemy import Column, Index, MetaData, Table, func, inspect, literal, select, union_all
+from .changes import triggers_available
+from .database import session, primary_bind
+from .models import ArchivePartition, Change, OrderHeader, OrderItem
+from .pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE, set_next_cursor
+from .reports import report_summaries
+from .sharding import shard_map
+
+DEFAULT_CONFIG = {
+    # orders moved per transaction
+    'ORDERS_ARCHIVE_BATCH_SIZE': 500,
+    # orders older than this are archived when no cutoff is given (days)
+    'ORDERS_ARCHIVE_AFTER_DAYS': 2 * 365
+}
+
+# the change log action for orders and items that moved to the archive
+ARCHIVED = 'archive'
+
+# the archive tables of a year, e.g. OrderHeader_2018
+ARCHIVE_TABLE = re.compile(r'^(%s|%s)_\d{4}$' % (OrderHeader.__tablename__, OrderItem.__tablename__))
+
+# max ids per IN (...) to stay under the sqlite parameter limit
+ID_CHUNK_SIZE = 500
+
+
+class ArchivedRow:
+    """ an archived order or item, dumped by the same schemas as the mapped objects """
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def order_filters(table, start=None, end=None, **equals):
+    """ returns the conditions of the order list filters, for OrderHeader or one of its archive tables
+
+    Args:
+        table (Table): the orders table
+        start (datetime, optional): orders created on or after this
+        end (datetime, optional): orders created before this
+        **equals: column name -> value, e.g. CustomerID=7
+    """
+    filters = [table.c[name] == value for name, value in equals.items()]
+    if start is not None:
+        filters.append(table.c.CreationDate >= start)
+    if end is not None:
+        filters.append(table.c.CreationDate < end)
+    return filters
+
+
+def _year_range(year, before):
+    """ returns the [start, end) dates of a year that are archived with a cutoff """
+    return datetime.datetime(year, 1, 1), min(datetime.datetime(year + 1, 1, 1), before)
+
+
+def _chunks(ids):
+    for i in range(0, len(ids), ID_CHUNK_SIZE):
+        yield ids[i:i + ID_CHUNK_SIZE]
+
+
+class OrderArchive:
+    """ moves old orders into yearly archive tables and reads them back """
+    def __init__(self):
+        self.batchSize = DEFAULT_CONFIG['ORDERS_ARCHIVE_BATCH_SIZE']
+        self.afterDays = DEFAULT_CONFIG['ORDERS_ARCHIVE_AFTER_DAYS']
+        self.metadata = MetaData()
+        self._tables = {}
+        self._created = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.batchSize = app.config['ORDERS_ARCHIVE_BATCH_SIZE']
+        self.afterDays = app.config['ORDERS_ARCHIVE_AFTER_DAYS']
+
+    def cutoff(self, days=None):
+        """ returns the date orders older than days (ORDERS_ARCHIVE_AFTER_DAYS by default) were created before """
+        return datetime.datetime.utcnow() - datetime.timedelta(days=self.afterDays if days is None else days)
+
+    def tables(self, year):
+        """ returns the (orders, items) archive tables of a year
+
+        They have the columns of OrderHeader and OrderItem without the foreign
+        keys, and only the indexes the archive reads use.
+        """
+        with self._lock:
+            if year not in self._tables:
+                orders = Table(f'{OrderHeader.__tablename__}_{year}', self.metadata, *[
+                    Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+                    for column in OrderHeader.__table__.columns
+                ])
+                Index(f'ix_{orders.name}_CustomerID_CreationDate', orders.c.CustomerID, orders.c.CreationDate)
+                items = Table(f'{OrderItem.__tablename__}_{year}', self.metadata, *[
+                    Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+                    for column in OrderItem.__table__.columns
+                ])
+                Index(f'ix_{items.name}_OrderHeaderID', items.c.OrderHeaderID)
+                self._tables[year] = (orders, items)
+            return self._tables[year]
+
+    def _create(self, engine, year):
+        # in its own transaction, the batch that moves the rows must start with a write
+        if (engine, year) not in self._created:
+            for table in self.tables(year):
+                table.create(engine, checkfirst=True)
+            self._created.add((engine, year))
+
+    def drop(self, engine):
+        """ drops every archive table, e.g. before the database is recreated with the sample data """
+        for name in inspect(engine).get_table_names():
+            if ARCHIVE_TABLE.match(name):
+                engine.execute(f'DROP TABLE IF EXISTS "{name}"')
+        with self._lock:
+            self._created = {(bind, year) for bind, year in self._created if bind is not engine}
+
+    #***********************************************************************************************************##
+    #  ARCHIVING                                                                                                ##
+    #***********************************************************************************************************##
+    def pending(self, before):
+        """ returns the number of hot orders created before a date, on every shard """
+        header = OrderHeader.__table__
+        stmt = select([func.count()]).where(header.c.CreationDate < before)
+        return sum(engine.execute(stmt).scalar() for engine in self._engines())
+
+    def archive(self, before, batchSize=None, progress=None):
+        """ moves the orders created before a date with their items into the archive tables
+
+        Every batch is moved in one transaction, so this can be stopped at any
+        point and run again.  The moved rows bypass the session events, clear
+        the response cache afterwards.
+
+        Args:
+            before (datetime): archive the orders created before this (utc)
+            batchSize (int, optional): orders moved per transaction, defaults to ORDERS_ARCHIVE_BATCH_SIZE
+            progress (callable, optional): called with the running counts after each batch
+
+        Returns:
+            dict: the number of orders and items archived
+        """
+        counts = {'orders': 0, 'items': 0}
+        for engine in self._engines():
+            while True:
+                moved = self._archive_batch(engine, before, batchSize or self.batchSize)
+                if moved is None:
+                    break
+                counts['orders'] += moved['orders']
+                counts['items'] += moved['items']
+                if progress is not None:
+                    progress(counts)
+        return counts
+
+    def _archive_batch(self, engine, before, batchSize):
+        """ moves the oldest batch of orders, returns None when there are none left """
+        header, item = OrderHeader.__table__, OrderItem.__table__
+        with engine.connect() as conn:
+            rows = conn.execute(select([header.c.OrderHeaderID, header.c.CreationDate]).where(
+                header.c.CreationDate < before
+            ).order_by(header.c.CreationDate).limit(batchSize)).fetchall()
+        if not rows:
+            return None
+
+        years = {}
+        for orderId, created in rows:
+            years.setdefault(created.year, []).append(orderId)
+        for year in years:
+            self._create(engine, year)
+
+        moved = {'orders': 0, 'items': 0}
+        partitions = ArchivePartition.__table__
+        with engine.begin() as conn:
+            lastChange = None
+            for year, ids in sorted(years.items()):
+                orders, items = self.tables(year)
+                start, end = _year_range(year, before)
+                # the orders are copied first, this write takes the lock before anything else is read, and the
+                # date range is checked again in case an order changed since the batch was picked
+                conn.execute(orders.insert().from_select(
+                    [column.name for column in header.columns],
+                    select([header]).where(header.c.OrderHeaderID.in_(ids)).where(header.c.CreationDate >= start).where(header.c.CreationDate < end)
+                ))
+                archived = select([orders.c.OrderHeaderID]).where(orders.c.OrderHeaderID.in_(ids))
+                conn.execute(items.insert().from_select(
+                    [column.name for column in item.columns], select([item]).where(item.c.OrderHeaderID.in_(archived))
+                ))
+                if lastChange is None and triggers_available(conn):
+                    lastChange = conn.execute(select([func.coalesce(func.max(Change.ChangeID), 0)])).scalar()
+
+                itemCount = conn.execute(item.delete().where(item.c.OrderHeaderID.in_(archived))).rowcount
+                orderCount = conn.execute(header.delete().where(header.c.OrderHeaderID.in_(archived))).rowcount
+                moved['orders'] += orderCount
+                moved['items'] += itemCount
+
+                partition = conn.execute(select([partitions.c.ArchivedBefore]).where(partitions.c.Year == year)).first()
+                if partition is None:
+                    conn.execute(partitions.insert().values(Year=year, ArchivedBefore=before, Orders=orderCount, Items=itemCount))
+                else:
+                    conn.execute(partitions.update().where(partitions.c.Year == year).values(
+                        ArchivedBefore=max(partition.ArchivedBefore, before),
+                        Orders=partitions.c.Orders + orderCount,
+                        Items=partitions.c.Items + itemCount
+                    ))
+
+            # the reports read the archive too, but summaries of the months have to be recomputed from both
+            if not shard_map.enabled:
+                report_summaries.mark(conn, {created for _, created in rows})
+
+            # the delete triggers logged the moved rows, they were archived and still exist
+            if lastChange is not None:
+                changes = Change.__table__
+                conn.execute(changes.update().where(changes.c.ChangeID > lastChange).where(changes.c.Action == 'delete').values(Action=ARCHIVED))
+        return moved
+
+    def _engines(self):
+        return shard_map.engines() if shard_map.enabled else [primary_bind()]
+
+    #***********************************************************************************************************##
+    #  READS                                                                                                    ##
+    #***********************************************************************************************************##
+    def sources(self, start=None, end=None):
+        """ returns (connection, years) for every database with archived orders created in [start, end)
+
+        The connections are the session's, so the archive is read in the same
+        transaction (and snapshot) as the hot tables.  An empty list means the
+        range only covers hot orders.
+        """
+        # every shard may have archived orders, customers that moved leave theirs behind
+        if shard_map.enabled:
+            connections = [session.connection(shard_id=shard) for shard in shard_map.shard_ids]
+        else:
+            connections = [session.connection()]
+
+        sources = []
+        for conn in connections:
+            years = self._years(conn, start, end)
+            if years:
+                sources.append((conn, years))
+        return sources
+
+    def _years(self, bind, start=None, end=None):
+        """ returns the years archived on a database with orders created in [start, end) """
+        partitions = ArchivePartition.__table__
+        stmt = select([partitions.c.Year, partitions.c.ArchivedBefore]).order_by(partitions.c.Year)
+        if start is not None:
+            stmt = stmt.where(partitions.c.Year >= start.year)
+        if end is not None:
+            stmt = stmt.where(partitions.c.Year <= end.year)
+
+        years = []
+        for year, before in bind.execute(stmt):
+            first, last = _year_range(year, before)
+            if (start is None or start < last) and (end is None or end > first):
+                years.append(year)
+        return years
+
+    def report_tables(self, bind, start=None, end=None):
+        """ returns the (orders, items) archive tables with orders created in [start, end), for reports.py
+
+        Args:
+            bind (Session|Connection|Engine): the database, reports are not served while the orders are sharded
+        """
+        return [self.tables(year) for year in self._years(bind, start, end)]
+
+    def _query(self, years, filters, after=None):
+        """ a union of the archive tables of the years, each row with its year """
+        key = OrderHeader.OrderHeaderID.key
+        selects = []
+        for year in years:
+            orders = self.tables(year)[0]
+            stmt = select([orders, literal(year).label('ArchiveYear')])
+            for condition in filters(orders) if filters else ():
+                stmt = stmt.where(condition)
+            if after is not None:
+                stmt = stmt.where(orders.c[key] > after)
+            selects.append(stmt)
+        return union_all(*selects) if len(selects) > 1 else selects[0]
+
+    def _load(self, conn, rows):
+        """ builds the archived orders of result rows and loads their items """
+        orders = []
+        byYear = {}
+        for row in rows:
+            values = dict(row)
+            year = values.pop('ArchiveYear')
+            order = ArchivedRow(values)
+            order.orderItems = []
+            orders.append(order)
+            byYear.setdefault(year, {})[order.OrderHeaderID] = order
+
+        for year, byId in byYear.items():
+            items = self.tables(year)[1]
+            for ids in _chunks(list(byId)):
+                for row in conn.execute(select([items]).where(items.c.OrderHeaderID.in_(ids)).order_by(items.c.OrderItemID)):
+                    byId[row.OrderHeaderID].orderItems.append(ArchivedRow(dict(row)))
+        return orders
+
+    def orders(self, sources, filters=None, after=None, limit=None):
+        """ returns the archived orders that match, by OrderHeaderID, with their items
+
+        Args:
+            sources (list): from sources()
+            filters (callable, optional): takes an orders table and returns the conditions, see order_filters()
+            after (int, optional): only orders with a greater OrderHeaderID
+            limit (int, optional): the max number of orders to return
+
+        Returns:
+            list: ArchivedRow orders
+        """
+        parts = []
+        for conn, years in sources:
+            stmt = self._query(years, filters, after)
+            stmt = stmt.order_by(OrderHeader.OrderHeaderID.key)
+            if limit:
+                stmt = stmt.limit(limit)
+            parts.append(self._load(conn, conn.execute(stmt).fetchall()))
+        rows = list(heapq.merge(*parts, key=attrgetter('OrderHeaderID')))
+        return rows[:limit] if limit else rows
+
+    def iter_orders(self, sources, filters=None, batchSize=STREAM_BATCH_SIZE):
+        """ like orders() without a limit, but reads the orders in keyset batches so memory stays flat """
+        after = None
+        while True:
+            rows = self.orders(sources, filters, after, batchSize)
+            yield from rows
+            if len(rows) < batchSize:
+                return
+            after = rows[-1].OrderHeaderID
+
+    def get(self, id):
+        """ returns an archived order by id with its items, or None """
+        for conn, years in self.sources():
+            rows = conn.execute(self._query(years, lambda orders: [orders.c.OrderHeaderID == id])).fetchall()
+            if rows:
+                return self._load(conn, rows[:1])[0]
+        return None
+
+    def paginate(self, query, sources, filters, limit=None, after=None):
+        """ pagination.keyset_paginate() over the hot orders of a query and the archived orders together
+
+        Args:
+            query (Query): the OrderHeader query with the same filters
+            sources (list): from sources()
+            filters (callable): takes an orders table and returns the conditions, see order_filters()
+            limit (int, optional): the max number of orders to return, DEFAULT_PAGE_SIZE when None
+            after (int, optional): only orders with a greater OrderHeaderID
+
+        Returns:
+            list: the OrderHeader and ArchivedRow orders for this page, by OrderHeaderID
+        """
+        query = query.order_by(OrderHeader.OrderHeaderID)
+        if after is not None:
+            query = query.filter(OrderHeader.OrderHeaderID > after)
+        # fetch one extra row to know if there is another page
+        limit = max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+        query = query.limit(limit + 1)
+
+        rows = list(heapq.merge(query.all(), self.orders(sources, filters, after, limit + 1), key=attrgetter('OrderHeaderID')))
+        if len(rows) > limit:
+            rows = rows[:limit]
+            set_next_cursor(rows[-1].OrderHeaderID)
+        return rows
+
+    def stats(self):
+        """ returns the archived years with their counts, on every shard """
+        counts = {}
+        partitions = ArchivePartition.__table__
+        for engine in self._engines():
+            for row in engine.execute(select([partitions]).order_by(partitions.c.Year)):
+                entry = counts.setdefault(row.Year, {'orders': 0, 'items': 0, 'before': row.ArchivedBefore})
+                entry['orders'] += row.Orders
+                entry['items'] += row.Items
+                entry['before'] = max(entry['before'], row.ArchivedBefore)
+        return counts
+
+
+order_archive = OrderArchive()
@@ -0,0 +1,373 @@
+import datetime
+import itertools
+import json
+from marshmallow import Schema, EXCLUDE, fields, missing, post_load, ValidationError
+from sqlalchemy import and_, bindparam, select, func
+from .models import Customer, OrderHeader, OrderItem, TAX_RATE, recalculate_order_totals
+from .catalog import product_catalog, resolve_products
+from .schemas import OrderHeaderSchema, OrderItemSchema
+from .reports import report_summaries, ALL_PERIODS
+
+# default number of orders written per transaction
+BULK_BATCH_SIZE = 1000
+
+
+class BulkOrderItemSchema(OrderItemSchema):
+    """ validates an order item without building an ORM object, the price defaults to the catalog list price """
+
+    @post_load
+    def make_object(self, data, **kwargs):
+        return product_catalog.fill(data)
+
+
+class BulkOrderSchema(OrderHeaderSchema):
+    """ validates an order without building ORM objects, the CustomerID is required """
+    CustomerID = fields.Integer(description='the customer id', required=True)
+    Items = fields.List(fields.Nested(BulkOrderItemSchema), attribute='orderItems', many=True, missing=[])
+
+    @post_load
+    def make_object(self, data, **kwargs):
+        return data
+
+
+class ItemChangeSchema(Schema):
+    """ an entry in an item batch: a new item without an OrderItemID, otherwise an update or a Delete """
+    class Meta:
+        unknown = EXCLUDE
+
+    OrderItemID = fields.Integer(description='the item to update or remove, omit to add a new item')
+    ProductID = fields.Integer(description='the catalog product')
+    ProductName = fields.String(description='the product name')
+    Quantity = fields.Integer(description='the item quantity')
+    UnitPrice = fields.Float(description='the price for the item')
+    Delete = fields.Boolean(description='remove the item', missing=False)
+
+
+def iter_ndjson(stream):
+    """ yields one json document per non-empty line of a binary stream
+
+    Args:
+        stream (file): the request stream
+
+    Yields:
+        dict: the decoded document, or the raw line if it is not valid json
+    """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line
+
+
+def compute_totals(orders):
+    """ computes the item, tax and grand totals of validated orders, so they are inserted with their final
+    totals instead of being recalculated with an UPDATE afterwards
+
+    The arithmetic matches OrderItem.updateItem() and OrderHeader.updateOrder().
+
+    Args:
+        orders (list): validated order dicts with their "orderItems"
+    """
+    for order in orders:
+        itemTotal = 0
+        for item in order['orderItems']:
+            item['ItemTotal'] = item['UnitPrice'] * item['Quantity']
+            itemTotal += item['ItemTotal']
+        order['ItemTotal'] = itemTotal
+        order['TaxTotal'] = (itemTotal + order['ShippingTotal']) * TAX_RATE
+        order['GrandTotal'] = itemTotal + order['ShippingTotal'] + order['TaxTotal']
+
+
+def _write_batch(engine, batch, errors):
+    """ writes a batch of validated orders in a single transaction
+
+    Returns:
+        int: the number of orders created
+    """
+    headerTable = OrderHeader.__table__
+    itemTable = OrderItem.__table__
+    with engine.begin() as conn:
+        # reject orders for unknown customers up front instead of failing the batch
+        customerIds = {order['CustomerID'] for _, order in batch}
+        known = {row[0] for row in conn.execute(
+            select([Customer.CustomerID]).where(Customer.CustomerID.in_(customerIds))
+        )}
+        valid = []
+        for index, order in batch:
+            if order['CustomerID'] in known:
+                valid.append(order)
+            else:
+                errors.append({'row': index, 'errors': {'CustomerID': [f'Invalid Customer ID: {order["CustomerID"]}']}})
+
+        compute_totals(valid)
+        now = datetime.datetime.utcnow()
+        headers = [{
+            'CustomerID': order['CustomerID'],
+            'Product': order.get('Product'),
+            'CreationDate': order.get('CreationDate') or now,
+            'ItemTotal': order['ItemTotal'],
+            'TaxTotal': order['TaxTotal'],
+            'ShippingTotal': order['ShippingTotal'],
+            'GrandTotal': order['GrandTotal'],
+        } for order in valid]
+        if not headers:
+            return 0
+
+        # sqlite assigns the first header's id (never a deleted order's id, see models.OrderHeader) and the insert
+        # holds the write lock until commit, so the ids after it are free for the rest of the batch and the other
+        # headers can go out in one executemany; concurrent writers wait for the lock instead of failing the batch
+        firstId = conn.execute(headerTable.insert(), headers[0]).inserted_primary_key[0]
+        items = []
+        for orderId, header, order in zip(itertools.count(firstId), headers, valid):
+            header['OrderHeaderID'] = orderId
+            for item in order['orderItems']:
+                items.append({
+                    'OrderHeaderID': orderId,
+                    'ProductID': item.get('ProductID'),
+                    'ProductName': item.get('ProductName'),
+                    'Quantity': item['Quantity'],
+                    'UnitPrice': item['UnitPrice'],
+                    'ItemTotal': item['ItemTotal'],
+                })
+
+        # the other headers and then all items for the batch go out in one executemany each
+        if len(headers) > 1:
+            conn.execute(headerTable.insert(), headers[1:])
+        if items:
+            resolve_products(conn, items)
+            conn.execute(itemTable.insert(), items)
+
+        # core inserts skip the orm events, so log the months for the report summaries here
+        report_summaries.mark(conn, {order.get('CreationDate') or now for order in valid})
+    return len(valid)
+
+
+def bulk_import_orders(engine, rows, batch_size=BULK_BATCH_SIZE):
+    """ validates and inserts orders with their items in batches
+
+    Each batch is written with Core inserts inside its own transaction.  Rows that
+    fail validation are reported and skipped, and a batch that fails to write is
+    rolled back and reported without aborting the rest of the load.
+
+    Args:
+        engine (Engine): the database engine
+        rows (iterable): order documents, each with a CustomerID and optional Items
+        batch_size (int, optional): the number of orders written per transaction
+
+    Returns:
+        dict: the number of created and failed rows and the per-row errors
+    """
+    schema = BulkOrderSchema()
+    batch_size = max(1, batch_size or BULK_BATCH_SIZE)
+    created = 0
+    errors = []
+    batch = []
+
+    def flush():
+        nonlocal created
+        batchErrors = []
+        try:
+            created += _write_batch(engine, batch, batchErrors)
+        except Exception as e:
+            batchErrors = [{'row': index, 'errors': {'_batch': [str(e)]}} for index, _ in batch]
+        errors.extend(batchErrors)
+        batch.clear()
+
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append({'row': index, 'errors': {'_schema': ['Invalid input type.']}})
+            continue
+        try:
+            batch.append((index, schema.load(row)))
+        except ValidationError as e:
+            errors.append({'row': index, 'errors': e.messages})
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    errors.sort(key=lambda e: e['row'])
+    return {'created': created, 'failed': len(errors), 'errors': errors}
+
+
+def apply_item_changes(session, order, changes):
+    """ adds, updates and removes many items of one order and recomputes its totals once
+
+    The items are written with Core statements in the session's transaction (the
+    caller commits) and ItemTotal, TaxTotal and GrandTotal are recalculated in SQL
+    a single time at the end, instead of re-summing the items after every change.
+
+    Args:
+        session (Session): the session
+        order (OrderHeader): the order the items belong to
+        changes (list): validated item dicts, an item without an "OrderItemID" is added with
+            the OrderItemSchema defaults, one with "Delete" is removed and any other is updated
+            with the fields it has
+
+    Raises:
+        ValueError: when an OrderItemID does not belong to the order
+
+    Returns:
+        dict: the created, updated and deleted item ids
+    """
+    itemTable = OrderItem.__table__
+    defaults = {name: field.missing for name, field in BulkOrderItemSchema().load_fields.items() if field.missing is not missing}
+
+    inserts = []
+    updates = {}
+    deletes = set()
+    for change in changes:
+        change = dict(change)
+        itemId = change.pop('OrderItemID', None)
+        remove = change.pop('Delete', False)
+        if itemId is None:
+            if remove:
+                raise ValueError('Delete requires an OrderItemID')
+            inserts.append(product_catalog.fill(dict(defaults, **change)))
+        elif remove:
+            deletes.add(itemId)
+        else:
+            updates.setdefault(itemId, {}).update(change)
+
+    # updates need the current values to recompute each ItemTotal
+    current = {}
+    ids = set(updates) | deletes
+    if ids:
+        rows = session.execute(
+            select([itemTable.c.OrderItemID, itemTable.c.ProductID, itemTable.c.ProductName, itemTable.c.Quantity, itemTable.c.UnitPrice]).where(
+                and_(itemTable.c.OrderHeaderID == order.OrderHeaderID, itemTable.c.OrderItemID.in_(ids))
+            )
+        )
+        current = {row.OrderItemID: dict(row) for row in rows}
+        unknown = sorted(ids - set(current))
+        if unknown:
+            raise ValueError(f'Items {unknown} do not belong to order {order.OrderHeaderID}')
+
+    resolve_products(session, inserts)
+    created = []
+    for item in inserts:
+        item['OrderHeaderID'] = order.OrderHeaderID
+        item['ItemTotal'] = item['UnitPrice'] * item['Quantity']
+        created.append(session.execute(itemTable.insert(), item).inserted_primary_key[0])
+
+    updated = [itemId for itemId in updates if itemId not in deletes]
+    if updated:
+        rows = []
+        for itemId in updated:
+            change = updates[itemId]
+            item = dict(current[itemId], **change)
+            if 'ProductName' in change and 'ProductID' not in change:
+                item['ProductID'] = None
+            item['ItemTotal'] = item['UnitPrice'] * item['Quantity']
+            item['itemId'] = item.pop('OrderItemID')
+            rows.append(product_catalog.fill(item))
+        resolve_products(session, rows)
+        session.execute(
+            itemTable.update().where(itemTable.c.OrderItemID == bindparam('itemId')).values(Version=itemTable.c.Version + 1), rows
+        )
+
+    if deletes:
+        session.execute(itemTable.delete().where(itemTable.c.OrderItemID.in_(deletes)))
+
+    recalculate_order_totals(session, [order.OrderHeaderID])
+    report_summaries.mark(session, [order.CreationDate])
+
+    # the totals changed in sql, reload them on the next access
+    session.expire(order)
+    return {'created': created, 'updated': updated, 'deleted': sorted(deletes)}
+
+
+def load_sample_data(engine, data, batch_size=BULK_BATCH_SIZE, progress=None, ids=None, products=None):
+    """ loads customers with nested Orders and Items (the data.sample_data shape) with core executemany
+
+    Ids are assigned up front from the current max id of each table, so this is
+    meant for seeding a database that nothing else is writing to.
+
+    Args:
+        engine (Engine): the database engine
+        data (dict): {"customers": [...]} where each customer has "Orders" and each order has "Items"
+        batch_size (int, optional): the number of customers written per transaction
+        progress (callable, optional): called with the running counts after every transaction
+        ids (dict, optional): table name -> (first id, step) for the ids of that table instead of counting up
+            from its current max id, e.g. to seed a shard (see sharding.py)
+        products (dict, optional): ProductName -> ProductID for the items, by default the products are looked
+            up (and added) in the engine's own Product table
+
+    Returns:
+        dict: the number of customers, orders and items created
+    """
+    customerTable = Customer.__table__
+    headerTable = OrderHeader.__table__
+    itemTable = OrderItem.__table__
+    counts = {'customers': 0, 'orders': 0, 'items': 0}
+    now = datetime.datetime.utcnow()
+
+    def counter(table, key):
+        if ids and table.name in ids:
+            return itertools.count(*ids[table.name])
+        with engine.connect() as conn:
+            return itertools.count(conn.execute(select([func.coalesce(func.max(table.c[key]), 0)])).scalar() + 1)
+
+    customerIds = counter(customerTable, 'CustomerID')
+    orderIds = counter(headerTable, 'OrderHeaderID')
+    itemIds = counter(itemTable, 'OrderItemID')
+
+    def flush(customers, orders, items):
+        with engine.begin() as conn:
+            conn.execute(customerTable.insert(), customers)
+            if orders:
+                conn.execute(headerTable.insert(), orders)
+            if items:
+                if products is None:
+                    resolve_products(conn, items)
+                else:
+                    for item in items:
+                        item['ProductID'] = products.get(item['ProductName'])
+                conn.execute(itemTable.insert(), items)
+        counts['customers'] += len(customers)
+        counts['orders'] += len(orders)
+        counts['items'] += len(items)
+        if progress is not None:
+            progress(counts)
+
+    customers, orders, items = [], [], []
+    for customer in data['customers']:
+        customerId = next(customerIds)
+        customers.append({
+            'CustomerID': customerId,
+            'FirstName': customer.get('FirstName'),
+            'LastName': customer.get('LastName'),
+            'ShipToState': customer.get('ShipToState')
+        })
+
+        customerOrders = [{
+            'Product': order.get('Product'),
+            'CreationDate': order.get('CreationDate') or now,
+            'ShippingTotal': order.get('ShippingTotal', 0),
+            'orderItems': [{
+                'ProductName': item.get('ProductName'),
+                'Quantity': item.get('Quantity', 1),
+                'UnitPrice': item.get('UnitPrice', 0)
+            } for item in order.get('Items', [])]
+        } for order in customer.get('Orders', [])]
+        compute_totals(customerOrders)
+
+        for order in customerOrders:
+            orderId = next(orderIds)
+            for item in order.pop('orderItems'):
+                items.append(dict(item, OrderItemID=next(itemIds), OrderHeaderID=orderId))
+            orders.append(dict(order, OrderHeaderID=orderId, CustomerID=customerId))
+
+        if len(customers) >= batch_size:
+            flush(customers, orders, items)
+            customers, orders, items = [], [], []
+    if customers:
+        flush(customers, orders, items)
+
+    with engine.begin() as conn:
+        report_summaries.mark(conn, [ALL_PERIODS])
+    return counts
@@ -0,0 +1,334 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+from sqlalchemy import event
+from .models import Customer, OrderHeader, OrderItem
+from .serializers import dumps
+
+DEFAULT_CONFIG = {
+    'ORDERS_CACHE_ENABLED': True,
+    'ORDERS_CACHE_TTL': 60,
+    'ORDERS_CACHE_MAX_ENTRIES': 10000,
+    # an instance of a CacheBackend, the in process LRUCache is used when this is None
+    'ORDERS_CACHE_BACKEND': None
+}
+
+
+class CacheBackend:
+    """ interface for response cache storage
+
+    Entries are stored with a list of tags so they can be invalidated by the
+    resources they were built from (e.g. "order:1") instead of by key.
+    """
+
+    def get(self, key):
+        """ returns the cached value or None """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl, tags=()):
+        """ stores a value for ttl seconds and associates it with the given tags """
+        raise NotImplementedError
+
+    def add(self, key, value, ttl):
+        """ stores a value for ttl seconds only if the key is not set yet, returns True if it was stored """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ removes a single entry """
+        raise NotImplementedError
+
+    def invalidate(self, tags):
+        """ removes every entry associated with any of the tags, returns the number removed """
+        raise NotImplementedError
+
+    def clear(self):
+        """ removes all entries """
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """ thread safe in process cache with a max size and per entry expiration """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl, tags=()):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def add(self, key, value, ttl):
+        # checked and stored under one acquisition, so only one of several concurrent callers gets True
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= time.monotonic():
+                    return False
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value, ())
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate(self, tags):
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(CacheBackend):
+    """ cache backed by a redis-like client (anything with get, set(ex=), sadd, smembers, delete and expire) """
+
+    def __init__(self, client, prefix='orders-cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return value
+
+    def set(self, key, value, ttl, tags=()):
+        self.client.set(self.prefix + key, value, ex=ttl)
+        for tag in tags:
+            tagKey = f'{self.prefix}tag:{tag}'
+            self.client.sadd(tagKey, key)
+            self.client.expire(tagKey, ttl)
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self.prefix + key, value, ex=ttl, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def invalidate(self, tags):
+        keys = set()
+        for tag in tags:
+            tagKey = f'{self.prefix}tag:{tag}'
+            keys.update(k.decode('utf-8') if isinstance(k, bytes) else k for k in self.client.smembers(tagKey))
+            self.client.delete(tagKey)
+        if keys:
+            self.client.delete(*[self.prefix + k for k in keys])
+        return len(keys)
+
+    def clear(self):
+        for key in self.client.keys(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class ResponseCache:
+    """ read-through cache of serialized json responses with tag based invalidation """
+
+    def __init__(self, backend=None, ttl=60, enabled=True):
+        self.backend = backend or LRUCache()
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # guards the counters and the invalidation log, they are updated by every request thread
+        self._lock = threading.Lock()
+        # bumped by every invalidation, a miss notes it before building its response
+        self._sequence = 0
+        # tag -> sequence of its last invalidation, kept while a miss that started before it is running
+        self._invalidated = {}
+        # sequence a running miss started at -> number of misses running since then
+        self._running = {}
+
+    def init_app(self, app):
+        """ configures the cache from the app config
+
+        Args:
+            app (Flask): the flask app
+        """
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.enabled = app.config['ORDERS_CACHE_ENABLED']
+        self.ttl = app.config['ORDERS_CACHE_TTL']
+        self.backend = app.config['ORDERS_CACHE_BACKEND'] or LRUCache(app.config['ORDERS_CACHE_MAX_ENTRIES'])
+
+    def invalidate(self, tags):
+        """ removes every cached response built from any of the tags
+
+        Args:
+            tags (iterable): tags like "order:1" or "customer:2"
+        """
+        tags = set(tags)
+        if tags:
+            # logged before the entries are removed, so a miss storing its response in between finds it stale
+            with self._lock:
+                self._sequence += 1
+                if self._running:
+                    for tag in tags:
+                        self._invalidated[tag] = self._sequence
+            removed = self.backend.invalidate(tags)
+            with self._lock:
+                self.invalidations += removed
+
+    def clear(self):
+        self.backend.clear()
+
+    def _begin(self):
+        """ notes a miss that starts building a response, returns the sequence it started at """
+        with self._lock:
+            self.misses += 1
+            self._running[self._sequence] = self._running.get(self._sequence, 0) + 1
+            return self._sequence
+
+    def _stale(self, start, tags):
+        """ True when any of the tags was invalidated after a miss started at start """
+        with self._lock:
+            return any(self._invalidated.get(tag, start) > start for tag in tags)
+
+    def _finish(self, start):
+        with self._lock:
+            self._running[start] -= 1
+            if not self._running[start]:
+                del self._running[start]
+            if not self._running:
+                self._invalidated.clear()
+            elif start < min(self._running):
+                # the oldest miss finished, the invalidations before the now oldest one are not needed anymore
+                oldest = min(self._running)
+                self._invalidated = {tag: sequence for tag, sequence in self._invalidated.items() if sequence > oldest}
+
+    @property
+    def stats(self):
+        with self._lock:
+            hits, misses, invalidations = self.hits, self.misses, self.invalidations
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'invalidations': invalidations,
+            'hitRatio': hits / total if total else 0
+        }
+
+    def cached(self, tags):
+        """ decorator that caches the json output of a flask_accepts.responds() resource method
+
+        Place it above @flask_accepts.responds so the serialized output is cached.  Only
+        successful responses are stored, error responses pass through.  A response is
+        not kept when any of its tags is invalidated while it is being built, it may have
+        been read before the change was committed.
+
+        Args:
+            tags (callable): called with the view kwargs and the serialized output, returns the
+                tags the response depends on (e.g. lambda id, data: [f'order:{id}'])
+        """
+        def decorator(func):
+            @wraps(func)
+            def inner(resource, *args, **kwargs):
+                if not self.enabled:
+                    return func(resource, *args, **kwargs)
+
+                key = f'{request.path}?{"&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))}'
+                body = self.backend.get(key)
+                if body is not None:
+                    with self._lock:
+                        self.hits += 1
+                    return current_app.response_class(body, mimetype='application/json')
+
+                start = self._begin()
+                try:
+                    rv = func(resource, *args, **kwargs)
+                    if not isinstance(rv, tuple) or rv[1] != 200:
+                        return rv
+
+                    body = dumps(rv[0]) + '\n'
+                    responseTags = tags(data=rv[0], **kwargs)
+                    if not self._stale(start, responseTags):
+                        self.backend.set(key, body, self.ttl, responseTags)
+                        # an invalidation between the check and the set did not see the new entry
+                        if self._stale(start, responseTags):
+                            self.backend.delete(key)
+                finally:
+                    self._finish(start)
+                return current_app.response_class(body, mimetype='application/json')
+            return inner
+        return decorator
+
+
+def model_tags(obj):
+    """ returns the cache tags affected by a change to a model instance """
+    if isinstance(obj, OrderHeader):
+        return [f'order:{obj.OrderHeaderID}', f'customer:{obj.CustomerID}']
+    if isinstance(obj, OrderItem):
+        return [f'item:{obj.OrderItemID}', f'order:{obj.OrderHeaderID}']
+    if isinstance(obj, Customer):
+        return [f'customer:{obj.CustomerID}']
+    return []
+
+
+def register_session_events(cache, session):
+    """ invalidates cached responses for every row changed by a session once it commits
+
+    Args:
+        cache (ResponseCache): the response cache
+        session (scoped_session): the session to listen on
+    """
+    @event.listens_for(session, 'after_flush')
+    def collect_tags(s, flush_context):
+        tags = s.info.setdefault('cache_tags', set())
+        for obj in list(s.new) + list(s.dirty) + list(s.deleted):
+            tags.update(model_tags(obj))
+
+    @event.listens_for(session, 'after_commit')
+    def invalidate_tags(s):
+        cache.invalidate(s.info.pop('cache_tags', ()))
+
+    @event.listens_for(session, 'after_soft_rollback')
+    def discard_tags(s, previous_transaction):
+        s.info.pop('cache_tags', None)
+
+
+# shared response cache for the orders api
+response_cache = ResponseCache()
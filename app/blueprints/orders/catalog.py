@@ -0,0 +1,240 @@
+""" in memory product catalog: id <-> name and list price lookups without a query
+
+The Product table is small and read on every item write and product filter, so
+each process keeps a copy in two sorted arrays (ids and prices), a tuple of
+names and a name -> position dict.  Any commit that wrote to the Product table,
+through the ORM or through resolve_products(), invalidates the copy and the next
+lookup reloads it; ORDERS_CATALOG_TTL bounds how long another process's changes
+can take to show up.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from sqlalchemy import event, exists, func, inspect, select
+from sqlalchemy.engine import Engine
+from .database import RoutingSession, primary_bind
+from .models import OrderItem, Product
+
+DEFAULT_CONFIG = {
+    # seconds before the catalog is reloaded even without a local write
+    'ORDERS_CATALOG_TTL': 60
+}
+
+# set on a connection that wrote products, the catalog is invalidated when it commits
+CHANGED_KEY = 'orders_catalog_changed'
+
+
+class ProductCatalog:
+    """ compact, array backed copy of the Product table """
+    def __init__(self):
+        self.ttl = DEFAULT_CONFIG['ORDERS_CATALOG_TTL']
+        self.loads = 0
+        # (ids, prices, names, positions), replaced as a whole so readers never see half a reload
+        self._snapshot = (array('q'), array('d'), (), {})
+        self._loadedAt = None
+        self._bind = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.ttl = app.config['ORDERS_CATALOG_TTL']
+
+    def load(self, bind=None):
+        """ reads the whole Product table, ordered by id
+
+        Args:
+            bind (Engine|Connection, optional): defaults to the primary engine
+        """
+        bind = bind or primary_bind()
+        rows = bind.execute(select([Product.ProductID, Product.Name, Product.UnitPrice]).order_by(Product.ProductID)).fetchall()
+        ids = array('q', (row[0] for row in rows))
+        prices = array('d', (row[2] or 0 for row in rows))
+        names = tuple(row[1] for row in rows)
+        positions = {name: i for i, name in enumerate(names)}
+        with self._lock:
+            self._snapshot = (ids, prices, names, positions)
+            self._bind = bind
+            self._loadedAt = time.monotonic()
+            self.loads += 1
+
+    def invalidate(self):
+        self._loadedAt = None
+
+    def _current(self):
+        loadedAt = self._loadedAt
+        bind = primary_bind()
+        if loadedAt is None or bind is not self._bind or (self.ttl and time.monotonic() - loadedAt > self.ttl):
+            self.load(bind)
+        return self._snapshot
+
+    def __len__(self):
+        return len(self._current()[0])
+
+    def id_for(self, name):
+        """ returns the ProductID for a product name, or None if it is not in the catalog """
+        ids, _, _, positions = self._current()
+        position = positions.get(name)
+        return None if position is None else ids[position]
+
+    def _lookup(self, productId, column):
+        snapshot = self._current()
+        ids = snapshot[0]
+        position = bisect_left(ids, productId)
+        if position < len(ids) and ids[position] == productId:
+            return snapshot[column][position]
+        return None
+
+    def name_for(self, productId):
+        """ returns the name of a ProductID, or None if it is not in the catalog """
+        return self._lookup(productId, 2)
+
+    def price_for(self, productId):
+        """ returns the list price of a ProductID, or None if it is not in the catalog """
+        return self._lookup(productId, 1)
+
+    def products(self):
+        """ returns every product as dicts, ordered by id """
+        ids, prices, names, _ = self._current()
+        return [
+            {'ProductID': productId, 'Name': name, 'UnitPrice': price}
+            for productId, name, price in zip(ids, names, prices)
+        ]
+
+    def fill(self, item):
+        """ completes an item dict from the catalog: the ProductID for its ProductName (or the other way
+        around) and the list price when it has no UnitPrice, unknown products are priced at 0
+
+        Returns:
+            dict: the same item
+        """
+        if item.get('ProductID') is None and item.get('ProductName') is not None:
+            item['ProductID'] = self.id_for(item['ProductName'])
+        elif item.get('ProductID') is not None and item.get('ProductName') is None:
+            item['ProductName'] = self.name_for(item['ProductID'])
+        if item.get('UnitPrice') is None:
+            price = self.price_for(item['ProductID']) if item.get('ProductID') is not None else None
+            item['UnitPrice'] = price or 0
+        return item
+
+
+product_catalog = ProductCatalog()
+
+
+def product_filter(name):
+    """ filters items by product name, through the indexed ProductID when the name is in the catalog """
+    productId = product_catalog.id_for(name)
+    return OrderItem.ProductName == name if productId is None else OrderItem.ProductID == productId
+
+
+def resolve_products(conn, items):
+    """ sets the ProductID of item dicts from their ProductName, adding products that are not in the catalog yet
+
+    Unknown names are added with the first UnitPrice they are sold at.  The
+    inserts run on the given connection, so they commit or roll back with the items.
+
+    Args:
+        conn (Connection|Session): the connection the items are written with
+        items (list): item dicts with a ProductName and UnitPrice
+    """
+    # the cached ids only apply to the primary database, a connection to any other one (e.g. seeding a new file) looks them all up
+    cached = _connection(conn).engine is primary_bind()
+    missing = {}
+    for item in items:
+        name = item.get('ProductName')
+        if name is None:
+            item['ProductID'] = item.get('ProductID')
+            continue
+        productId = product_catalog.id_for(name) if cached else None
+        item['ProductID'] = productId
+        if productId is None:
+            missing.setdefault(name, item.get('UnitPrice') or 0)
+    if not missing:
+        return
+
+    # another transaction may have added them since the catalog was loaded
+    known = dict(conn.execute(select([Product.Name, Product.ProductID]).where(Product.Name.in_(missing))).fetchall())
+    new = [{'Name': name, 'UnitPrice': price, 'Version': 1} for name, price in missing.items() if name not in known]
+    if new:
+        conn.execute(Product.__table__.insert(), new)
+        known.update(conn.execute(select([Product.Name, Product.ProductID]).where(Product.Name.in_([p['Name'] for p in new]))).fetchall())
+        _connection(conn).info[CHANGED_KEY] = True
+    for item in items:
+        if item['ProductID'] is None and item.get('ProductName') is not None:
+            item['ProductID'] = known[item['ProductName']]
+
+
+def backfill_products(engine):
+    """ adds a product for every item name without one and links the items to it, for databases created before
+    the Product table existed (the list price is the highest price the product was sold at)
+
+    Returns:
+        int: the number of items linked
+    """
+    itemTable = OrderItem.__table__
+    unlinked = (itemTable.c.ProductID.is_(None)) & (itemTable.c.ProductName.isnot(None))
+    with engine.begin() as conn:
+        if conn.execute(select([itemTable.c.OrderItemID]).where(unlinked).limit(1)).first() is None:
+            return 0
+        conn.execute(Product.__table__.insert().from_select(
+            ['Name', 'UnitPrice'],
+            select([itemTable.c.ProductName, func.max(itemTable.c.UnitPrice)]).where(unlinked).where(
+                ~exists().where(Product.Name == itemTable.c.ProductName)
+            ).group_by(itemTable.c.ProductName)
+        ))
+        linked = conn.execute(itemTable.update().where(unlinked).values(
+            ProductID=select([Product.ProductID]).where(Product.Name == itemTable.c.ProductName).as_scalar()
+        )).rowcount
+    product_catalog.invalidate()
+    return linked
+
+
+def _connection(conn):
+    return conn.connection() if hasattr(conn, 'get_bind') else conn
+
+
+#***********************************************************************************************************##
+#  EVENTS                                                                                                   ##
+#***********************************************************************************************************##
+@event.listens_for(RoutingSession, 'before_flush')
+def _fill_items(session, flush_context, instances):
+    """ links new and renamed items to the catalog and prices new items that were sent without a UnitPrice """
+    items = [obj for obj in session.new if isinstance(obj, OrderItem)]
+    items += [obj for obj in session.dirty if isinstance(obj, OrderItem) and inspect(obj).attrs.ProductName.history.has_changes()]
+    if not items:
+        return
+    values = []
+    for item in items:
+        renamed = item not in session.new and item.ProductName is not None
+        values.append(product_catalog.fill({
+            'ProductID': None if renamed else item.ProductID,
+            'ProductName': item.ProductName,
+            'UnitPrice': item.UnitPrice
+        }))
+    resolve_products(session, values)
+    for item, value in zip(items, values):
+        priced = item.UnitPrice is None
+        item.ProductID = value['ProductID']
+        item.ProductName = value['ProductName']
+        item.UnitPrice = value['UnitPrice']
+        if priced and item.Quantity is not None:
+            item.updateItem()
+
+
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_update')
+@event.listens_for(Product, 'after_delete')
+def _product_changed(mapper, connection, target):
+    connection.info[CHANGED_KEY] = True
+
+
+@event.listens_for(Engine, 'commit')
+def _invalidate_on_commit(conn):
+    if conn.info.pop(CHANGED_KEY, False):
+        product_catalog.invalidate()
+
+
+@event.listens_for(Engine, 'rollback')
+def _discard_on_rollback(conn):
+    conn.info.pop(CHANGED_KEY, None)
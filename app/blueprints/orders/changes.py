@@ -0,0 +1,285 @@
+""" append only change log (outbox) for customers, orders and items, and the feed that serves it
+
+Sqlite triggers append every insert, update and delete on the Customer,
+OrderHeader and OrderItem tables to the Change table in the same transaction.
+ChangeID is an AUTOINCREMENT key, so the last id a consumer has seen is a
+complete cursor, and a gap in front of it can only come from prune().
+
+Waiting readers (long polls and event streams) are woken when a connection that
+committed goes back to the pool, or after ORDERS_CHANGES_POLL_INTERVAL seconds
+for commits made by other processes.  Each holds a server thread, so at most
+ORDERS_CHANGES_MAX_WAITERS of them wait at the same time.
+"""
+import threading
+import time
+from flask import Response, stream_with_context
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from .database import primary_bind
+from .models import Change, Customer, OrderHeader, OrderItem
+from .serializers import dumps
+
+DEFAULT_CONFIG = {
+    # longest a long poll request waits for a change (seconds)
+    'ORDERS_CHANGES_MAX_WAIT': 30,
+    # how often waiting requests check for changes committed by other processes (seconds)
+    'ORDERS_CHANGES_POLL_INTERVAL': 1.0,
+    # how long an event stream stays open before the client reconnects with Last-Event-ID (seconds)
+    'ORDERS_CHANGES_STREAM_SECONDS': 300,
+    # long polls and event streams that can wait at the same time in each process
+    'ORDERS_CHANGES_MAX_WAITERS': 4
+}
+
+# entity -> (model, primary key, parent key)
+SOURCES = {
+    'customer': (Customer, 'CustomerID', None),
+    'order': (OrderHeader, 'OrderHeaderID', 'CustomerID'),
+    'item': (OrderItem, 'OrderItemID', 'OrderHeaderID')
+}
+
+ACTIONS = {'INSERT': ('create', 'new'), 'UPDATE': ('update', 'new'), 'DELETE': ('delete', 'old')}
+
+# default number of changes per page
+CHANGES_PAGE_SIZE = 100
+
+# seconds between keep-alive comments on an idle event stream
+KEEP_ALIVE_SECONDS = 15
+
+# set on a connection that committed, waiting readers are woken when it is checked back into the pool
+COMMITTED_KEY = 'orders_changes_committed'
+
+
+class ChangesPruned(LookupError):
+    pass
+
+
+class WaitersBusy(Exception):
+    """ raised when ORDERS_CHANGES_MAX_WAITERS readers are waiting already """
+    pass
+
+
+#***********************************************************************************************************##
+#  TRIGGERS                                                                                                 ##
+#***********************************************************************************************************##
+def triggers_available(conn):
+    """ returns True when changes are recorded for this database (sqlite only) """
+    return conn.dialect.name == 'sqlite'
+
+
+def _trigger_statements(entity):
+    model, pk, parent = SOURCES[entity]
+    table = model.__tablename__
+    statements = []
+    for operation, (action, row) in ACTIONS.items():
+        parentId = f'{row}.{parent}' if parent else 'NULL'
+        statements.append(
+            f'CREATE TRIGGER IF NOT EXISTS {Change.__tablename__}_{table}_{action} AFTER {operation} ON {table} BEGIN '
+            f'INSERT INTO {Change.__tablename__} (Entity, EntityID, ParentID, Action) '
+            f"VALUES ('{entity}', {row}.{pk}, {parentId}, '{action}'); END"
+        )
+    return statements
+
+
+def create_change_log(engine):
+    """ creates the change triggers that are missing, the Change table itself is created by the migration
+
+    Returns:
+        bool: True if changes are recorded for this database
+    """
+    with engine.begin() as conn:
+        if not triggers_available(conn):
+            return False
+        for entity in SOURCES:
+            for statement in _trigger_statements(entity):
+                conn.execute(statement)
+    return True
+
+
+def record_reset(conn):
+    """ logs that every customer, order and item was replaced, e.g. by create_sample_data """
+    if triggers_available(conn):
+        conn.execute(Change.__table__.insert().values(Entity='*', Action='reset'))
+
+
+def _after_create(entity):
+    # tables recreated by drop_all()/create_all() lose their triggers
+    def listener(target, connection, **kw):
+        if triggers_available(connection):
+            for statement in _trigger_statements(entity):
+                connection.execute(statement)
+    return listener
+
+
+for _entity, _source in SOURCES.items():
+    event.listen(_source[0].__table__, 'after_create', _after_create(_entity))
+
+
+#***********************************************************************************************************##
+#  FEED                                                                                                     ##
+#***********************************************************************************************************##
+class ChangeFeed:
+    """ reads the change log by cursor and lets readers wait for new changes """
+    def __init__(self):
+        self.maxWait = DEFAULT_CONFIG['ORDERS_CHANGES_MAX_WAIT']
+        self.pollInterval = DEFAULT_CONFIG['ORDERS_CHANGES_POLL_INTERVAL']
+        self.streamSeconds = DEFAULT_CONFIG['ORDERS_CHANGES_STREAM_SECONDS']
+        self.maxWaiters = DEFAULT_CONFIG['ORDERS_CHANGES_MAX_WAITERS']
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._commits = threading.Condition()
+        self._generation = 0
+
+    def init_app(self, app):
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.maxWait = app.config['ORDERS_CHANGES_MAX_WAIT']
+        self.pollInterval = app.config['ORDERS_CHANGES_POLL_INTERVAL']
+        self.streamSeconds = app.config['ORDERS_CHANGES_STREAM_SECONDS']
+        self.maxWaiters = app.config['ORDERS_CHANGES_MAX_WAITERS']
+
+    def _enter(self):
+        with self._lock:
+            if self.waiting >= self.maxWaiters:
+                raise WaitersBusy(f'{self.waiting} readers are waiting for changes already, retry later')
+            self.waiting += 1
+
+    def _leave(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def notify(self):
+        """ wakes every waiting reader """
+        with self._commits:
+            self._generation += 1
+            self._commits.notify_all()
+
+    def fetch(self, since=0, limit=CHANGES_PAGE_SIZE, bind=None):
+        """ returns the changes after a cursor, oldest first
+
+        Reads on a fresh connection from the primary, so a reader never keeps a
+        snapshot open while it waits and never trails behind on a replica.
+
+        Args:
+            since (int, optional): the last ChangeID the consumer has seen, 0 for the whole log
+            limit (int, optional): the max number of changes to return
+            bind (Engine, optional): defaults to the primary engine
+
+        Raises:
+            ChangesPruned: when changes after the cursor were already pruned
+
+        Returns:
+            list: the change rows
+        """
+        table = Change.__table__
+        with (bind or primary_bind()).connect() as conn:
+            rows = conn.execute(select([table]).where(table.c.ChangeID > since).order_by(table.c.ChangeID).limit(limit)).fetchall()
+        if rows and rows[0].ChangeID > since + 1:
+            raise ChangesPruned(f'Changes after {since} were pruned, sync everything again and continue from {rows[0].ChangeID - 1}')
+        return rows
+
+    def wait(self, since=0, limit=CHANGES_PAGE_SIZE, timeout=0):
+        """ like fetch(), but waits up to timeout seconds for the first change when there is none yet
+
+        Raises:
+            ChangesPruned: when changes after the cursor were already pruned
+            WaitersBusy: when it would wait and ORDERS_CHANGES_MAX_WAITERS readers are waiting already
+        """
+        timeout = min(timeout or 0, self.maxWait)
+        if timeout <= 0:
+            return self.fetch(since, limit)
+        self._enter()
+        try:
+            return self._wait(since, limit, timeout)
+        finally:
+            self._leave()
+
+    def _wait(self, since, limit, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            # a commit that lands between the fetch and the wait still wakes this reader
+            generation = self._generation
+            rows = self.fetch(since, limit)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                return rows
+            with self._commits:
+                self._commits.wait_for(lambda: self._generation != generation, min(remaining, self.pollInterval))
+
+    def stream(self, since, schema):
+        """ serves the changes after a cursor as server sent events until ORDERS_CHANGES_STREAM_SECONDS have passed
+
+        Args:
+            since (int): the last ChangeID the consumer has seen
+            schema (Schema): dumps each change
+
+        Raises:
+            WaitersBusy: when ORDERS_CHANGES_MAX_WAITERS readers are waiting already
+
+        Returns:
+            flask.Response: a text/event-stream response
+        """
+        def generate():
+            cursor = since
+            deadline = time.monotonic() + self.streamSeconds
+            yield 'retry: 1000\n\n'
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    rows = self._wait(cursor, CHANGES_PAGE_SIZE, min(remaining, KEEP_ALIVE_SECONDS))
+                except ChangesPruned as e:
+                    yield f'event: pruned\ndata: {dumps({"message": str(e)})}\n\n'
+                    return
+                if not rows:
+                    yield ': keep-alive\n\n'
+                for row in rows:
+                    yield f'id: {row.ChangeID}\nevent: change\ndata: {dumps(schema.dump(row))}\n\n'
+                    cursor = row.ChangeID
+
+        self._enter()
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        # the server closes the response when the stream ends or the client goes away, even if it never started
+        response.call_on_close(self._leave)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    def prune(self, before, bind=None):
+        """ deletes the changes logged before a time, the ids of the remaining changes do not change
+
+        The newest change is always kept, so a consumer behind the pruned range
+        finds a gap in front of its cursor instead of an empty log.
+
+        Args:
+            before (datetime): delete changes created before this (utc)
+            bind (Engine, optional): defaults to the primary engine
+
+        Returns:
+            int: the number of changes deleted
+        """
+        table = Change.__table__
+        with (bind or primary_bind()).begin() as conn:
+            newest = select([func.max(table.c.ChangeID)]).as_scalar()
+            return conn.execute(table.delete().where(table.c.CreatedAt < before).where(table.c.ChangeID < newest)).rowcount
+
+    def latest(self, bind=None):
+        """ returns the newest ChangeID, a consumer that starts with a full sync continues from here """
+        with (bind or primary_bind()).connect() as conn:
+            return conn.execute(select([func.coalesce(func.max(Change.ChangeID), 0)])).scalar()
+
+
+change_feed = ChangeFeed()
+
+
+@event.listens_for(Engine, 'commit')
+def _mark_commit(conn):
+    conn.info[COMMITTED_KEY] = True
+
+
+@event.listens_for(Pool, 'checkin')
+def _wake_readers(dbapiConnection, connectionRecord):
+    # the commit event fires before the commit itself, by checkin the changes are visible to other connections
+    if connectionRecord is not None and connectionRecord.info.pop(COMMITTED_KEY, False):
+        change_feed.notify()
@@ -0,0 +1,123 @@
+""" flask cli commands for deployments that set ORDERS_AUTO_MIGRATE = False
+
+usage:
+    FLASK_APP=app flask orders migrate
+    FLASK_APP=app flask orders seed --customers 10000 --orders 10 --items 5
+    FLASK_APP=app flask orders prune-changes --days 30
+    FLASK_APP=app flask orders shards
+    FLASK_APP=app flask orders move-customer 42 --shard 1
+    FLASK_APP=app flask orders rebalance --limit 1000
+    FLASK_APP=app flask orders archive --before 2019-01-01
+"""
+import datetime
+import time
+import click
+from flask.cli import with_appcontext
+from .controller import orders_blueprint, migrate_database, has_orders, create_sample_data
+from .data import sample_data
+from .data.generator import generate_sample_data
+from .cache import response_cache
+from .changes import change_feed
+from .sharding import shard_map, UnknownShard
+from .archive import order_archive
+
+
+@orders_blueprint.cli.command('migrate')
+@with_appcontext
+def migrate_command():
+    """ creates any missing tables, columns and indexes and the search index """
+    start = time.perf_counter()
+    migrate_database()
+    click.echo(f'database is up to date ({time.perf_counter() - start:.2f}s)')
+
+
+@orders_blueprint.cli.command('seed')
+@click.option('--customers', type=int, help='generate this many customers instead of loading the sample data')
+@click.option('--orders', type=int, default=10, show_default=True, help='orders per generated customer')
+@click.option('--items', type=int, default=3, show_default=True, help='items per generated order')
+@click.option('--seed', type=int, default=0, show_default=True, help='random seed for the generated data')
+@click.option('--if-empty', is_flag=True, help='only load data when there are no orders yet')
+@with_appcontext
+def seed_command(customers, orders, items, seed, if_empty):
+    """ drops and recreates all tables and loads the sample (or generated) data """
+    if if_empty:
+        migrate_database()
+        if has_orders():
+            click.echo('database already has orders, nothing loaded')
+            return
+
+    data = generate_sample_data(customers, orders, items, seed) if customers else sample_data
+    start = time.perf_counter()
+    counts = create_sample_data(data)
+    response_cache.clear()
+    click.echo(f'loaded {counts["customers"]} customers, {counts["orders"]} orders and {counts["items"]} items '
+               f'in {time.perf_counter() - start:.2f}s')
+
+
+@orders_blueprint.cli.command('prune-changes')
+@click.option('--days', type=int, default=30, show_default=True, help='keep the changes logged in this many days')
+@with_appcontext
+def prune_changes_command(days):
+    """ deletes old entries from the change log, consumers further behind have to sync everything again """
+    deleted = change_feed.prune(datetime.datetime.utcnow() - datetime.timedelta(days=days))
+    click.echo(f'deleted {deleted} changes older than {days} days')
+
+
+def _require_shards():
+    if not shard_map.enabled:
+        raise click.ClickException('the orders are not sharded, set ORDERS_SHARD_URLS')
+
+
+@orders_blueprint.cli.command('shards')
+@with_appcontext
+def shards_command():
+    """ lists the shards and the number of customers on each """
+    _require_shards()
+    for shard, count in sorted(shard_map.counts().items()):
+        click.echo(f'{shard}: {count} customers ({shard_map.binds[shard].url})')
+
+
+@orders_blueprint.cli.command('move-customer')
+@click.argument('customer_id', type=int)
+@click.option('--shard', type=int, required=True, help='the shard to move the customer to')
+@with_appcontext
+def move_customer_command(customer_id, shard):
+    """ moves a customer with its orders and items to another shard """
+    _require_shards()
+    try:
+        moved = shard_map.move_customer(customer_id, shard)
+    except UnknownShard as e:
+        raise click.ClickException(str(e))
+    response_cache.clear()
+    click.echo(f'moved customer {customer_id} to shard {shard}' if moved else f'customer {customer_id} already is on shard {shard}')
+
+
+@orders_blueprint.cli.command('rebalance')
+@click.option('--limit', type=int, help='move at most this many customers')
+@with_appcontext
+def rebalance_command(limit):
+    """ moves customers from the fullest to the emptiest shards until every shard has about as many """
+    _require_shards()
+    start = time.perf_counter()
+    moved = shard_map.rebalance(limit)
+    response_cache.clear()
+    counts = ', '.join(f'{shard}: {count}' for shard, count in sorted(shard_map.counts().items()))
+    click.echo(f'moved {moved} customers in {time.perf_counter() - start:.2f}s, customers per shard: {counts}')
+
+
+@orders_blueprint.cli.command('archive')
+@click.option('--before', type=click.DateTime(formats=['%Y-%m-%d']), help='archive the orders created before this date')
+@click.option('--days', type=int, help='archive the orders older than this many days (default ORDERS_ARCHIVE_AFTER_DAYS)')
+@click.option('--batch-size', type=int, help='orders moved per transaction (default ORDERS_ARCHIVE_BATCH_SIZE)')
+@with_appcontext
+def archive_command(before, days, batch_size):
+    """ moves old orders with their items into yearly archive tables, safe to stop and run again """
+    before = before or order_archive.cutoff(days)
+    total = order_archive.pending(before)
+    start = time.perf_counter()
+    counts = order_archive.archive(before, batch_size, lambda counts: click.echo(f'archived {counts["orders"]} of {total} orders'))
+    response_cache.clear()
+    click.echo(f'archived {counts["orders"]} orders and {counts["items"]} items created before {before:%Y-%m-%d} '
+               f'in {time.perf_counter() - start:.2f}s')
+    for year, entry in order_archive.stats().items():
+        click.echo(f'{year}: {entry["orders"]} orders, {entry["items"]} items (archived before {entry["before"]:%Y-%m-%d})')
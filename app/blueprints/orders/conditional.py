@@ -0,0 +1,119 @@
+""" strong ETags from the row Version columns, conditional GETs and If-Match checks
+
+An order's Version changes with the order and with any of its items (see
+models.recalculate_order_totals), items and products have their own Version,
+and a customer's tag combines its Version with the versions of its orders
+since the customer response nests them.  Every tag also holds the table, the
+id and the database Epoch, which create_sample_data bumps, so a tag never
+matches another row or a recreated row that got the same id and Version.
+"""
+import hashlib
+from functools import wraps
+from flask import Response, request
+from sqlalchemy import func, select
+from sqlalchemy.orm.exc import StaleDataError
+from .database import session
+from .models import Customer, Epoch, OrderHeader, OrderItem, Product
+from .utils import dynamic_error
+
+# the newest EpochID, 0 before the tables were ever recreated
+current_epoch = select([func.coalesce(func.max(Epoch.EpochID), 0)])
+
+
+def row_etag(table, id, epoch, version):
+    """ builds the tag of a row from its table, id, the database epoch and its Version """
+    return f'{table}-{id}-{epoch}-{version}'
+
+
+def _version_etag(table, key, version, id):
+    row = session.query(version, current_epoch.as_scalar()).filter(key == id).first()
+    return None if row is None else row_etag(table, id, row[1], row[0])
+
+
+def order_etag(id):
+    """ returns the current ETag for an order, or None if it does not exist """
+    return _version_etag('order', OrderHeader.OrderHeaderID, OrderHeader.Version, id)
+
+
+def item_etag(id):
+    """ returns the current ETag for an item, or None if it does not exist """
+    return _version_etag('item', OrderItem.OrderItemID, OrderItem.Version, id)
+
+
+def product_etag(id):
+    """ returns the current ETag for a product, or None if it does not exist """
+    return _version_etag('product', Product.ProductID, Product.Version, id)
+
+
+def customer_etag(id):
+    """ returns the current ETag for a customer and its orders, or None if it does not exist """
+    row = session.query(Customer.Version, current_epoch.as_scalar()).filter(Customer.CustomerID == id).first()
+    if row is None:
+        return None
+    orders = session.query(OrderHeader.OrderHeaderID, OrderHeader.Version).filter(OrderHeader.CustomerID == id)
+    return combined_etag(id, row[1], row[0], orders)
+
+
+def combined_etag(id, epoch, version, orders):
+    """ combines a customer's tag with the (OrderHeaderID, Version) pairs of its orders """
+    digest = hashlib.sha1(repr(sorted(tuple(row) for row in orders)).encode()).hexdigest()[:16]
+    return f'{row_etag("customer", id, epoch, version)}-{digest}'
+
+
+def conditional(etag):
+    """ decorator for GET handlers: answers a matching If-None-Match with 304 before the handler
+    (and its schema dump) runs, and adds the ETag to every other response
+
+    Goes above @response_cache.cached() and @flask_accepts.responds().
+
+    Args:
+        etag (callable): takes the view arguments and returns the current tag, or None when the row does not exist
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            tag = etag(**kwargs)
+            if tag is None:
+                return func(*args, **kwargs)
+            if request.if_none_match.contains(tag):
+                response = Response(status=304)
+                response.set_etag(tag)
+                return response
+
+            rv = func(*args, **kwargs)
+            if isinstance(rv, Response):
+                if rv.status_code == 200:
+                    rv.set_etag(tag)
+                return rv
+            data, code = rv if isinstance(rv, tuple) else (rv, 200)
+            return data, code, {'ETag': f'"{tag}"'}
+        return wrapper
+    return decorator
+
+
+def precondition_failed(tag):
+    """ checks the If-Match header against the current tag of the row being changed
+
+    Args:
+        tag (str): the current tag, e.g. order_etag(id)
+
+    Returns:
+        Response: a 412 error when If-Match is sent and does not match, otherwise None
+    """
+    if request.if_match and not request.if_match.contains(tag):
+        return dynamic_error(code=412, description='Precondition Failed', message=f'The resource has changed, its current ETag is "{tag}"')
+    return None
+
+
+def optimistic(func):
+    """ decorator for write handlers: a row changed by someone else between loading it and the
+    versioned UPDATE (StaleDataError) is answered with 412 instead of overwriting their change
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except StaleDataError:
+            session.rollback()
+            return dynamic_error(code=412, description='Precondition Failed', message='The resource was changed by another request, reload it and try again')
+    return wrapper
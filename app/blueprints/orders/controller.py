@@ -1,56 +1,178 @@
-import os
+import datetime
+import heapq
+import threading
 import flask_accepts
-from flask import Blueprint, request
+from operator import attrgetter
+from flask_restx import inputs
+from flask import Blueprint, Response, after_this_request, current_app, request, url_for
+from marshmallow import ValidationError
 from flask_restx import Resource, Namespace
 from .data import sample_data
+from .data.generator import generate_sample_data
 from .models import *
 from .schemas import *
 from .utils import *
-
-thisDir = os.path.abspath(os.path.dirname(__file__))
-db_path = os.path.join(thisDir, 'data', 'Orders.db')
-
-# create database session
-session = create_session(f'sqlite:///{db_path}?check_same_thread=False', Base)
+from .database import session, init_app, migrate, primary_bind
+from .replicas import replica_router, read_from_primary
+from .pagination import add_pagination_args, keyset_paginate, next_page_headers, stream_ndjson, set_next_cursor, MAX_PAGE_SIZE, STREAM_BATCH_SIZE
+from .loaders import query_for_schema
+from .bulk import bulk_import_orders, load_sample_data, iter_ndjson, apply_item_changes, BulkOrderItemSchema, ItemChangeSchema, BULK_BATCH_SIZE
+from .cache import response_cache, register_session_events
+from .reports import report_summaries, run_report, REPORTS
+from .serializers import compiled
+from .instrumentation import instrumentation, PROMETHEUS_CONTENT_TYPE
+from .search import search, create_search_index, KINDS, SEARCH_PAGE_SIZE
+from .jobs import job_queue, UnknownJobType
+from .catalog import product_catalog, product_filter, backfill_products
+from .idempotency import idempotency_store
+from .changes import change_feed, create_change_log, record_reset, triggers_available, ChangesPruned, WaitersBusy, CHANGES_PAGE_SIZE
+from .export import add_export_args, export_response
+from .conditional import conditional, optimistic, precondition_failed, order_etag, item_etag, customer_etag, product_etag
+from .sharding import shard_map, single_database
+from .archive import order_archive, order_filters
+from .admission import admission_control
 
 # create blueprint
-orders_blueprint = Blueprint('orders_api', __name__)
+orders_blueprint = Blueprint('orders_api', __name__, cli_group='orders')
+
+# bind the database session when the blueprint is registered on an app, no connection is opened yet
+@orders_blueprint.record_once
+def setup_database(state):
+    engine = init_app(state.app, Base)
+    shard_map.init_app(state.app, engine)
+    response_cache.init_app(state.app)
+    # the reports read the archived orders of their date range too
+    report_summaries.init_app(state.app, archived=order_archive.report_tables)
+    instrumentation.init_app(state.app)
+    job_queue.init_app(state.app)
+    product_catalog.init_app(state.app)
+    change_feed.init_app(state.app)
+    idempotency_store.init_app(state.app)
+    order_archive.init_app(state.app)
+    admission_control.init_app(state.app)
+    # cached responses may have been built from replicas that just caught up
+    replica_router.init_app(state.app, on_sync=response_cache.clear)
+
+# invalidate cached responses for rows changed by each commit
+register_session_events(response_cache, session)
+
+# shed requests over their rate limits and queue the rest for a database slot, see admission.py
+orders_blueprint.before_request(admission_control.admit)
+orders_blueprint.teardown_request(admission_control.release)
 
 # create naemspaces
 orders_ns = Namespace('orders', 'Operations for managing orders', path='/orders')
 items_ns = Namespace('items', 'Operations for managing order items', path='/items')
 customers_ns = Namespace('customers', 'Operations for managing customers', path='/customers')
-namespaces = [customers_ns, orders_ns, items_ns]
+reports_ns = Namespace('reports', 'Aggregate sales reports', path='/reports')
+search_ns = Namespace('search', 'Prefix search over product and customer names', path='/search')
+jobs_ns = Namespace('jobs', 'Background jobs for long running operations', path='/jobs')
+changes_ns = Namespace('changes', 'Feed of customer, order and item changes for incremental syncs', path='/changes')
+products_ns = Namespace('products', 'Product catalog and list prices', path='/products')
+namespaces = [customers_ns, orders_ns, items_ns, products_ns, reports_ns, search_ns, changes_ns, jobs_ns]
 
-# create sample data function
-def create_sample_data():
-    # drop all tables to clean and recreate
-    Base.metadata.drop_all(session.get_bind())
-    Base.metadata.create_all(session.get_bind())
-
-    # build data
-    for customerAsJson in sample_data['customers']:
-        customer = CustomerSchema().load(customerAsJson)
-
-        # create orders
-        for orderAsJson in customerAsJson.get('Orders', []):
-            order = OrderHeaderSchema().load(orderAsJson)
-
-            # append child order
-            customer.orders.append(order)
-   
-        # add to database
-        session.add(customer)
-    session.commit()
+def migrate_database(engine=None):
+    """ creates any missing tables, columns and indexes, the search index and the change log triggers, and links
+    items from before the product catalog to their products
+
+    When the orders are sharded every shard is migrated and the shard directory
+    and id sequences are brought up to date.
+
+    Args:
+        engine (Engine, optional): defaults to the primary engine the session is bound to
+    """
+    engine = engine or primary_bind()
+    sharded = shard_map.enabled and engine is primary_bind()
+    for bind in shard_map.engines() if sharded else [engine]:
+        migrate(bind, Base)
+        create_search_index(bind)
+        create_change_log(bind)
+    backfill_products(engine)
+    if sharded:
+        shard_map.prepare()
+    return engine
+
+
+def has_orders():
+    """ returns True if there is at least one order, reads a single row no matter how big the table is """
+    return session.query(OrderHeader.OrderHeaderID).first() is not None
 
 
-# create sample data before first request
+# held while the tables are dropped and recreated or orders are moved to the archive, so those never overlap
+schema_lock = threading.Lock()
+
+
+# create sample data function
+def create_sample_data(data=sample_data, progress=None):
+    """ drops and recreates all tables (except the job table and the change log) and loads the sample data, the
+    archived orders are dropped as well
+
+    Args:
+        data (dict, optional): customers with nested Orders and Items, see data.generator for larger data sets
+        progress (callable, optional): called with the running counts, see bulk.load_sample_data
+    """
+    with schema_lock:
+        # drop all tables to clean and recreate, the job table is kept so a running job can report on itself,
+        # the change log so consumers see a reset followed by the new rows instead of a cursor that starts over
+        # and the epochs so they keep counting up
+        session.remove()
+        engine = primary_bind()
+        kept = (Job.__table__, Change.__table__, Epoch.__table__)
+        for bind in shard_map.engines() if shard_map.enabled else [engine]:
+            order_archive.drop(bind)
+            Base.metadata.drop_all(bind, tables=[table for table in Base.metadata.sorted_tables if table not in kept])
+            Base.metadata.create_all(bind)
+            # the ids start over, a new epoch keeps the ETags of the old rows from matching the new ones
+            with bind.begin() as conn:
+                conn.execute(Epoch.__table__.insert())
+        with engine.begin() as conn:
+            record_reset(conn)
+
+        # build data
+        product_catalog.invalidate()
+        if shard_map.enabled:
+            return shard_map.load_sample_data(data, progress=progress)
+        return load_sample_data(engine, data, progress=progress)
+
+
+@job_queue.job('create-sample-data', SampleDataJobSchema(), exclusive=True)
+def sample_data_job(progress, customers=None, orders=10, items=3, seed=0):
+    """ recreates the database with the sample data, or generated data when customers is given """
+    data = generate_sample_data(customers, orders, items, seed) if customers else sample_data
+    total = customers or len(sample_data['customers'])
+    progress(0, 'Recreating tables')
+    counts = create_sample_data(data, lambda counts: progress(counts['customers'] / total, f'Loaded {counts["customers"]} of {total} customers'))
+    response_cache.clear()
+    return counts
+
+
+@job_queue.job('archive-orders', ArchiveJobSchema(), exclusive=True)
+def archive_job(progress, before=None, days=None, batchSize=None):
+    """ moves the orders created before a date (or older than days) into the yearly archive tables """
+    before = datetime.datetime.strptime(before, '%Y-%m-%d') if before else order_archive.cutoff(days)
+    total = order_archive.pending(before)
+    progress(0, f'Archiving {total} orders created before {before:%Y-%m-%d}')
+    with schema_lock:
+        counts = order_archive.archive(before, batchSize, lambda counts: progress(
+            counts['orders'] / total if total else 1, f'Archived {counts["orders"]} of {total} orders'
+        ))
+    response_cache.clear()
+    return counts
+
+
+# create the schema and the sample data before the first request instead of at import
 @orders_blueprint.before_app_first_request
 def check_sample_data():
-    orders = session.query(OrderHeader).all()
-    if not orders:
-        create_sample_data()
-        
+    # the replicas are only copied from the primary once it is ready
+    read_from_primary()
+    if current_app.config['ORDERS_AUTO_MIGRATE']:
+        migrate_database()
+        if not has_orders():
+            create_sample_data()
+    replica_router.start_replication()
+    # pick up jobs that were still queued when the last process stopped
+    job_queue.recover()
+
 
 #***********************************************************************************************************##
 #  ORDERS                                                                                                   ##
@@ -61,48 +183,97 @@ class GetOrders(Resource):
     # add query uri args to limit records
     parser.add_argument('Product', type=str, help='product name to search for')
     parser.add_argument('CustomerID', type=int, help='a specific customer id to search for')
+    parser.add_argument('start', type=inputs.date, help='orders created on or after this date (YYYY-MM-DD), archived orders are included when it is before the archive cutoff')
+    parser.add_argument('end', type=inputs.date, help='orders created before this date (YYYY-MM-DD)')
+    add_pagination_args(parser)
 
     @orders_ns.expect(parser)
-    @flask_accepts.responds(schema=OrderHeaderSchema(many=True), api=orders_ns)
+    @next_page_headers(orders_ns)
+    @flask_accepts.responds(schema=compiled(OrderHeaderSchema(many=True)), api=orders_ns)
     def get(self):
-        """ fetches all orders """
-        res = session.query(OrderHeader)
+        """ fetches all orders, without a start or end date only the orders that are not archived """
+        res = query_for_schema(session, OrderHeader, OrderHeaderSchema())
         args = self.parser.parse_args()
-        product = args.get('Product')
-        customerId = args.get('CustomerID')
-        if product:
-            res = res.filter_by(Product=product)
-        if customerId:
-            res = res.filter_by(CustomerID=customerId)
+        start, end = args.get('start'), args.get('end')
+        criteria = {name: args.get(name) for name in ('Product', 'CustomerID') if args.get(name)}
+        filters = lambda table: order_filters(table, start, end, **criteria)
+        res = res.filter(*filters(OrderHeader.__table__))
+
+        # only a date range can reach into the archive
+        sources = order_archive.sources(start, end) if start or end else []
+        if args.get('stream'):
+            hot = res.order_by(OrderHeader.OrderHeaderID)
+            if sources:
+                return stream_ndjson(heapq.merge(hot.yield_per(STREAM_BATCH_SIZE), order_archive.iter_orders(sources, filters),
+                                                 key=attrgetter('OrderHeaderID')), compiled(OrderHeaderSchema()))
+            return stream_ndjson(hot, compiled(OrderHeaderSchema()))
+        if sources:
+            return order_archive.paginate(res, sources, filters, args.get('limit'), args.get('after'))
 
         # marshmallow and flask_accepts will serialize to json automatically
-        return res.all()
+        return keyset_paginate(res, OrderHeader.OrderHeaderID, args.get('limit'), args.get('after'))
+
+
+@orders_ns.route('/export')
+class ExportOrders(Resource):
+    parser = orders_ns.parser()
+    # same filters as GetOrders
+    parser.add_argument('Product', type=str, help='product name to search for')
+    parser.add_argument('CustomerID', type=int, help='a specific customer id to search for')
+    add_export_args(parser)
+
+    @orders_ns.expect(parser)
+    @single_database
+    def get(self):
+        """ streams the orders table as csv, arrow or parquet in fixed size batches """
+        args = self.parser.parse_args()
+        filters = []
+        if args.get('Product'):
+            filters.append(OrderHeader.Product == args.get('Product'))
+        if args.get('CustomerID'):
+            filters.append(OrderHeader.CustomerID == args.get('CustomerID'))
+        return export_response(session.get_bind(), OrderHeader, filters, args)
 
 
 @orders_ns.route('/<int:id>')
 class OrderHandler(Resource):
 
+    @conditional(order_etag)
+    @response_cache.cached(lambda id, data: [f'order:{id}'])
     @flask_accepts.responds(schema=OrderHeaderSchema, api=orders_ns)
     def get(self, id):
-        """ fetch a specific order by id """
-        order = session.query(OrderHeader).get(id)
+        """ fetch a specific order by id, archived orders included """
+        order = query_for_schema(session, OrderHeader, OrderHeaderSchema()).get(id)
+        if not order:
+            # only ids that are not in the hot table are looked up in the archive
+            order = order_archive.get(id)
         if not order:
             return dynamic_error(message=f'No Order found with ID: {id}')
         return order
 
+    @optimistic
     @flask_accepts.accepts(schema=OrderHeaderSchema, api=orders_ns)
     @flask_accepts.responds(schema=UpdateResourceSchema, api=orders_ns)
     def put(self, id):
-        """ update an order """
+        """ update an order, send If-Match with the ETag from a GET to only update the version you read """
         order = session.query(OrderHeader).get(id)
         if not order:
             return dynamic_error(message=f'No Order found with ID: {id}')
+        failed = precondition_failed(order_etag(id))
+        if failed:
+            return failed
         payload = request.json
         for k,v in payload.items():
             setattr(order, k, v)
+
+        # shipping may have changed, so refresh the totals, the flush bumped the Version if anything changed
+        session.flush()
+        recalculate_order_totals(session, [id], bumpVersion=False)
         session.commit()
 
-        return success(message='Successfully Updated Order', id=id)
+        response = success(message='Successfully Updated Order', id=id)
+        response.set_etag(order_etag(id))
+        return response
 
     @flask_accepts.responds(schema=DeleteResourceSchema, api=orders_ns)
     def delete(self, id):
@@ -115,8 +286,34 @@ class OrderHandler(Resource):
 
         return success('Successfully Removed Order', id=id)
 
+@orders_ns.route('/bulk')
+class BulkCreateOrders(Resource):
+    parser = orders_ns.parser()
+    parser.add_argument('batchSize', type=int, location='args', help=f'number of orders written per transaction (default {BULK_BATCH_SIZE})')
+
+    @orders_ns.expect(parser)
+    @flask_accepts.responds(schema=BulkImportResultSchema, api=orders_ns)
+    @single_database
+    def post(self):
+        """ bulk creates orders with their items from a json array or newline delimited json body """
+        args = self.parser.parse_args()
+        if request.mimetype == 'application/x-ndjson':
+            rows = iter_ndjson(request.stream)
+        else:
+            rows = request.get_json(force=True, silent=True)
+            if not isinstance(rows, list):
+                return dynamic_error(message='Expected a JSON array of orders')
+
+        result = bulk_import_orders(session.get_bind(), rows, args.get('batchSize') or BULK_BATCH_SIZE)
+
+        # core inserts bypass the session events, so drop every cached response
+        if result['created']:
+            response_cache.clear()
+        return success(message='Successfully Imported Orders', **result)
+
 @orders_ns.route('/<int:id>/create-item')
 class CreateItem(Resource):
+    @idempotency_store.idempotent
     @flask_accepts.accepts(schema=OrderItemSchema, api=orders_ns)
     def post(self, id):
         """ creates an item for an order """
@@ -128,20 +325,76 @@ class CreateItem(Resource):
         payload = request.json
         item = OrderItem(**payload)
 
-        # append child item to order and commit to db
-        order.addItem(item)
+        # insert the item and update the order totals in sql without loading the other items
+        item.OrderHeaderID = order.OrderHeaderID
+        session.add(item)
+        session.flush()
+        recalculate_order_totals(session, [order.OrderHeaderID])
         session.commit()
 
         return success(message='Successfully Created Order Item', id=item.OrderItemID)
 
+@orders_ns.route('/<int:id>/items')
+class OrderItems(Resource):
+    @idempotency_store.idempotent
+    @flask_accepts.accepts(schema=BulkOrderItemSchema(many=True), api=orders_ns)
+    @flask_accepts.responds(schema=ItemBatchResultSchema, api=orders_ns)
+    def post(self, id):
+        """ adds many items to an order in one transaction, the totals are recalculated once """
+        return self.applyChanges(id, request.parsed_obj)
+
+    @flask_accepts.accepts(schema=ItemChangeSchema(many=True), api=orders_ns)
+    @flask_accepts.responds(schema=ItemBatchResultSchema, api=orders_ns)
+    def patch(self, id):
+        """ adds (no OrderItemID), updates or removes ("Delete": true) many items of an order in one transaction """
+        return self.applyChanges(id, request.parsed_obj)
+
+    def applyChanges(self, id, changes):
+        order = session.query(OrderHeader).get(id)
+        if not order:
+            return dynamic_error(message=f'No Order found with ID: {id}')
+        try:
+            result = apply_item_changes(session, order, changes)
+        except ValueError as e:
+            session.rollback()
+            return dynamic_error(message=str(e))
+        session.commit()
+
+        # core statements bypass the session events, so invalidate the affected responses here
+        response_cache.invalidate([f'order:{id}', f'customer:{order.CustomerID}'] + [
+            f'item:{itemId}' for itemId in result['updated'] + result['deleted']
+        ])
+        return success(
+            message='Successfully Updated Order Items', id=id, ItemTotal=order.ItemTotal, TaxTotal=order.TaxTotal,
+            ShippingTotal=order.ShippingTotal, GrandTotal=order.GrandTotal, **result
+        )
+
+
+@orders_ns.route('/cache-stats')
+class CacheStats(Resource):
+    @flask_accepts.responds(schema=CacheStatsSchema, api=orders_ns)
+    def get(self):
+        """ returns the response cache hit and miss counters """
+        return response_cache.stats
+
+
+@orders_ns.route('/_metrics')
+class Metrics(Resource):
+    def get(self):
+        """ request and SQL statement metrics per endpoint and admission counters, in the prometheus text format """
+        return Response(instrumentation.render() + admission_control.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
 
 @orders_ns.route('/recreate-database')
 class CreateSampleData(Resource):
-    @flask_accepts.responds(schema=CreateResourceSchema, api=orders_ns)
+    @flask_accepts.responds(schema=CreateResourceSchema, status_code=202, api=orders_ns)
     def post(self):
-        """ convenience option to clean and recreate sample database """
-        create_sample_data()
-        return success('Successfully Recreated Database')
+        """ convenience option to clean and recreate sample database, runs as a create-sample-data job """
+        jobId = job_queue.submit('create-sample-data')
+        response = success('Recreating Database, poll the job for its status', id=jobId)
+        response.status_code = 202
+        response.headers['Location'] = url_for('orders_api.jobs_job_handler', id=jobId)
+        return response
 
 
 
@@ -154,22 +407,47 @@ class GetItems(Resource):
     # add query uri args to limit records
     parser.add_argument('Product', type=str, help='product name to search for')
     parser.add_argument('OrderHeaderID', type=int, help='a specific order id to search for')
+    add_pagination_args(parser)
 
     @items_ns.expect(parser)
-    @flask_accepts.responds(schema=OrderItemSchema(many=True), api=items_ns)
+    @next_page_headers(items_ns)
+    @flask_accepts.responds(schema=compiled(OrderItemSchema(many=True)), api=items_ns)
     def get(self):
         """ fetches all items """
-        res = session.query(OrderItem)
+        res = query_for_schema(session, OrderItem, OrderItemSchema())
         args = self.parser.parse_args()
-        product = args.get('ProductName')
+        product = args.get('Product')
         orderId = args.get('OrderHeaderID')
         if product:
-            res = res.filter_by(Product=product)
+            res = res.filter(product_filter(product))
         if orderId:
             res = res.filter_by(OrderHeaderID=orderId)
+        if args.get('stream'):
+            return stream_ndjson(res.order_by(OrderItem.OrderItemID), compiled(OrderItemSchema()))
 
         # marshmallow and flask_accepts will serialize to json automatically
-        return res.all()
+        return keyset_paginate(res, OrderItem.OrderItemID, args.get('limit'), args.get('after'))
+
+
+@items_ns.route('/export')
+class ExportItems(Resource):
+    parser = items_ns.parser()
+    # same filters as GetItems
+    parser.add_argument('Product', type=str, help='product name to search for')
+    parser.add_argument('OrderHeaderID', type=int, help='a specific order id to search for')
+    add_export_args(parser)
+
+    @items_ns.expect(parser)
+    @single_database
+    def get(self):
+        """ streams the items table as csv, arrow or parquet in fixed size batches """
+        args = self.parser.parse_args()
+        filters = []
+        if args.get('Product'):
+            filters.append(product_filter(args.get('Product')))
+        if args.get('OrderHeaderID'):
+            filters.append(OrderItem.OrderHeaderID == args.get('OrderHeaderID'))
+        return export_response(session.get_bind(), OrderItem, filters, args)
 
 @items_ns.route('/<int:id>')
 class ItemHandler(Resource):
@@ -179,35 +457,46 @@ class ItemHandler(Resource):
             return item
         raise RuntimeError('No Item Found')
 
+    @conditional(item_etag)
+    @response_cache.cached(lambda id, data: [f'item:{id}'])
     @flask_accepts.responds(schema=OrderItemSchema, api=items_ns)
     def get(self, id):
         """ fetch a specific item by id """
         return self.getItem(id)
 
+    @optimistic
     @flask_accepts.accepts(schema=OrderItemSchema, api=items_ns)
     @flask_accepts.responds(schema=UpdateResourceSchema, api=items_ns)
     def put(self, id):
-        """ update an item """
+        """ update an item, send If-Match with the ETag from a GET to only update the version you read """
         item = self.getItem(id)
+        failed = precondition_failed(item_etag(id))
+        if failed:
+            return failed
         payload = request.json
         for k,v in payload.items():
             setattr(item, k, v)
 
-        # now update parent
+        # now update parent totals in sql without loading the other items
         item.updateItem()
-        item.orderHeader.updateOrder()
+        session.flush()
+        recalculate_order_totals(session, [item.OrderHeaderID])
         session.commit()
 
-        return success(message='Successfully Updated Item', id=id)
+        response = success(message='Successfully Updated Item', id=id)
+        response.set_etag(item_etag(id))
+        return response
 
     @flask_accepts.responds(schema=DeleteResourceSchema, api=items_ns)
     def delete(self, id):
         """ removes an item """
         item = self.getItem(id)
-        order = item.orderHeader
-        # remove from parent to trigger orm 
-        order.removeItem(item)
-        order.updateOrder()
+        orderId = item.OrderHeaderID
+        session.delete(item)
+        session.flush()
+
+        # now update parent totals in sql without loading the other items
+        recalculate_order_totals(session, [orderId])
         session.commit()
 
         return success('Successfully Removed Item', id=id)
@@ -222,13 +511,15 @@ class GetCustomers(Resource):
     parser = customers_ns.parser()
     # add query uri args to limit records
     parser.add_argument('FirstName', type=str, help='customer first name')
-    parser.add_argument('LastName', type=int, help='customer last name')
+    parser.add_argument('LastName', type=str, help='customer last name')
+    add_pagination_args(parser)
 
     @customers_ns.expect(parser)
-    @flask_accepts.responds(schema=CustomerSchema(many=True, exclude=['Orders']), api=customers_ns)
+    @next_page_headers(customers_ns)
+    @flask_accepts.responds(schema=compiled(CustomerSchema(many=True, exclude=['Orders'])), api=customers_ns)
     def get(self):
         """ fetches all customers """
-        res = session.query(Customer)
+        res = query_for_schema(session, Customer, CustomerSchema(exclude=['Orders']))
         args = self.parser.parse_args()
         firstName = args.get('FirstName')
         lastName = args.get('LastName')
@@ -236,10 +527,13 @@ class GetCustomers(Resource):
             res = res.filter_by(FirstName=firstName)
         if lastName:
             res = res.filter_by(LastName=lastName)
+        if args.get('stream'):
+            return stream_ndjson(res.order_by(Customer.CustomerID), compiled(CustomerSchema(exclude=['Orders'])))
 
         # marshmallow and flask_accepts will serialize to json automatically
-        return res.all()
+        return keyset_paginate(res, Customer.CustomerID, args.get('limit'), args.get('after'))
 
+    @idempotency_store.idempotent
     @flask_accepts.accepts(schema=CustomerSchema(exclude=['Orders']), api=customers_ns)
     def post(self):
         """ create a new customer """
@@ -253,27 +547,34 @@ class GetCustomers(Resource):
 @customers_ns.route('/<int:id>')
 class CustomerHandler(Resource):
 
+    @conditional(customer_etag)
     @flask_accepts.responds(schema=CustomerSchema, api=customers_ns)
     def get(self, id):
         """ fetch a specific customer by id """
-        customer = session.query(Customer).get(id)
+        customer = query_for_schema(session, Customer, CustomerSchema()).get(id)
         if not customer:
             return dynamic_error(message=f'No Customer found with ID: {id}')
         return customer
 
+    @optimistic
     @flask_accepts.accepts(schema=CustomerSchema, api=customers_ns)
     @flask_accepts.responds(schema=UpdateResourceSchema, api=customers_ns)
     def put(self, id):
-        """ update a customer """
+        """ update a customer, send If-Match with the ETag from a GET to only update the version you read """
         customer = session.query(Customer).get(id)
         if not customer:
             return dynamic_error(message=f'No Customer found with ID: {id}')
+        failed = precondition_failed(customer_etag(id))
+        if failed:
+            return failed
         payload = request.json
-        for k,v in payload.orders():
+        for k,v in payload.items():
             setattr(customer, k, v)
         session.commit()
 
-        return success(message='Successfully Updated Customer', id=id)
+        response = success(message='Successfully Updated Customer', id=id)
+        response.set_etag(customer_etag(id))
+        return response
 
     @flask_accepts.responds(schema=DeleteResourceSchema, api=customers_ns)
     def delete(self, id):
@@ -288,17 +589,33 @@ class CustomerHandler(Resource):
 
 @customers_ns.route('/<int:id>/orders')
 class GetCustomerOrders(Resource):
-    @flask_accepts.responds(schema=OrderHeaderSchema(many=True), api=customers_ns)
+    parser = customers_ns.parser()
+    parser.add_argument('start', type=inputs.date, help='orders created on or after this date (YYYY-MM-DD), archived orders are included when it is before the archive cutoff')
+    parser.add_argument('end', type=inputs.date, help='orders created before this date (YYYY-MM-DD)')
+
+    @customers_ns.expect(parser)
+    @conditional(customer_etag)
+    @response_cache.cached(lambda id, data: [f'customer:{id}'] + [f'order:{o["OrderHeaderID"]}' for o in data])
+    @flask_accepts.responds(schema=compiled(OrderHeaderSchema(many=True)), api=customers_ns)
     def get(self, id):
-        """ fetches orders for customer """
+        """ fetches orders for customer, without a start or end date only the orders that are not archived """
         customer = session.query(Customer).get(id)
         if not customer:
             return dynamic_error(message=f'Invalid Customer ID: {id}')
-        return customer.orders
+        args = self.parser.parse_args()
+        start, end = args.get('start'), args.get('end')
+        filters = lambda table: order_filters(table, start, end, CustomerID=id)
+        orders = query_for_schema(session, OrderHeader, OrderHeaderSchema()).filter(*filters(OrderHeader.__table__)).order_by(OrderHeader.OrderHeaderID).all()
+
+        sources = order_archive.sources(start, end) if start or end else []
+        if not sources:
+            return orders
+        return sorted(orders + order_archive.orders(sources, filters), key=attrgetter('OrderHeaderID'))
 
 
 @customers_ns.route('/<int:id>/create-order')
-class CreateItem(Resource):
+class CreateOrder(Resource):
+    @idempotency_store.idempotent
     @flask_accepts.accepts(schema=OrderHeaderSchema, api=customers_ns)
     def post(self, id):
         """ creates an order for a customer """
@@ -306,16 +623,224 @@ class CreateItem(Resource):
         if not customer:
             return dynamic_error(message=f'Invalid Customer ID: {id}')
 
-        # create OrderHeader from json payload
-        payload = request.json
+        # create OrderHeader and its OrderItems from json payload
+        order = OrderHeaderSchema().load(request.json)
+
+        # append child order to customer and commit to db
+        customer.orders.append(order)
+        session.commit()
+
+        return success(message='Successfully Created Order', id=order.OrderHeaderID)
+
+
+
+#***********************************************************************************************************##
+#  REPORTS                                                                                                  ##
+#***********************************************************************************************************##
+@reports_ns.route('/<string:name>')
+@reports_ns.doc(params={'name': 'the report to run (%s)' % ', '.join(REPORTS)})
+class Report(Resource):
+    parser = reports_ns.parser()
+    # add query uri args to limit the orders included
+    parser.add_argument('start', type=inputs.date, help='include orders created on or after this date (YYYY-MM-DD)')
+    parser.add_argument('end', type=inputs.date, help='include orders created before this date (YYYY-MM-DD)')
+    parser.add_argument('ShipToState', type=str, help='only include customers shipping to this state')
+    parser.add_argument('source', type=str, choices=('live', 'summary'), help='force the live tables or the monthly summary tables')
+
+    @reports_ns.expect(parser)
+    @flask_accepts.responds(schema=ReportSchema, api=reports_ns)
+    @single_database
+    def get(self, name):
+        """ runs an aggregate sales report """
+        if name not in REPORTS:
+            return dynamic_error(code=404, message=f'Invalid Report: {name}')
+        args = self.parser.parse_args()
+        return run_report(session, name, args.get('start'), args.get('end'), args.get('ShipToState'), args.get('source'))
 
-        # get items and remove from initial payload
-        items = payload.get('Items', [])
-        if items:
-            del payload['Items']
 
-        # create order
-        order = OrderHeaderSchema().load(**payload)
+#***********************************************************************************************************##
+#  SEARCH                                                                                                   ##
+#***********************************************************************************************************##
+@search_ns.route('') # will already be /search
+class Search(Resource):
+    parser = search_ns.parser()
+    parser.add_argument('q', type=str, required=True, help='the words to search for, each is matched as the start of a word')
+    parser.add_argument('kind', type=str, choices=tuple(KINDS), help='only return customers, orders or items')
+    parser.add_argument('limit', type=int, help=f'max number of results to return (default {SEARCH_PAGE_SIZE}, up to {MAX_PAGE_SIZE})')
+    parser.add_argument('after', type=int, help='cursor from a previous page, the number of results already returned')
+
+    @search_ns.expect(parser)
+    @flask_accepts.responds(schema=SearchResultSchema(many=True), api=search_ns)
+    @single_database
+    def get(self):
+        """ ranked search over customer names, order products and item product names """
+        args = self.parser.parse_args()
+        limit = max(1, min(args.get('limit') or SEARCH_PAGE_SIZE, MAX_PAGE_SIZE))
+        offset = max(0, args.get('after') or 0)
+
+        # fetch one extra result to know if there is another page
+        results = search(session, args.get('q'), args.get('kind'), limit + 1, offset)
+        if len(results) > limit:
+            results = results[:limit]
+            set_next_cursor(offset + limit)
+        return results
+
+
+#***********************************************************************************************************##
+#  CHANGES                                                                                                  ##
+#***********************************************************************************************************##
+@changes_ns.route('') # will already be /changes
+class Changes(Resource):
+    parser = changes_ns.parser()
+    parser.add_argument('since', type=int, default=0, help='the last ChangeID already seen, 0 for the whole log')
+    parser.add_argument('limit', type=int, help=f'max number of changes to return (default {CHANGES_PAGE_SIZE}, up to {MAX_PAGE_SIZE})')
+    parser.add_argument('wait', type=float, help='long poll: seconds to wait for a change when there is none after the cursor yet')
+
+    @changes_ns.expect(parser)
+    @flask_accepts.responds(schema=ChangeSchema(many=True), api=changes_ns)
+    @single_database
+    def get(self):
+        """ changes after the since cursor, oldest first, send Accept: text/event-stream for server sent events """
+        if not triggers_available(primary_bind()):
+            return dynamic_error(code=501, description='Not Implemented', message='Changes are only recorded for sqlite databases')
+        args = self.parser.parse_args()
+        since = max(0, args.get('since') or 0)
+        limit = max(1, min(args.get('limit') or CHANGES_PAGE_SIZE, MAX_PAGE_SIZE))
+        try:
+            if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+                lastEventId = request.headers.get('Last-Event-ID', '')
+                return change_feed.stream(max(since, int(lastEventId)) if lastEventId.isdigit() else since, ChangeSchema())
+            rows = change_feed.wait(since, limit, args.get('wait'))
+        except ChangesPruned as e:
+            return dynamic_error(code=410, description='Gone', message=str(e))
+        except WaitersBusy as e:
+            response = dynamic_error(code=503, description='Service Unavailable', message=str(e))
+            response.headers['Retry-After'] = '1'
+            return response
+
+        # the cursor is always sent back, a consumer that is caught up polls again with the same one
+        set_next_cursor(rows[-1].ChangeID if rows else since, 'since')
+        return rows
+
+
+@changes_ns.route('/latest')
+class LatestChange(Resource):
+
+    @single_database
+    def get(self):
+        """ the newest ChangeID, take it before a full sync and continue the feed from it afterwards """
+        return success(message='Latest Change', ChangeID=change_feed.latest())
+
+
+#***********************************************************************************************************##
+#  JOBS                                                                                                     ##
+#***********************************************************************************************************##
+@jobs_ns.route('') # will already be /jobs
+class Jobs(Resource):
+    parser = jobs_ns.parser()
+    parser.add_argument('Status', type=str, choices=('queued', 'running', 'succeeded', 'failed'), help='only return jobs with this status')
+    parser.add_argument('Type', type=str, help='only return jobs of this type')
+    add_pagination_args(parser)
+
+    @jobs_ns.expect(parser)
+    @next_page_headers(jobs_ns)
+    @flask_accepts.responds(schema=JobSchema(many=True), api=jobs_ns)
+    def get(self):
+        """ fetches the jobs, oldest first """
+        args = self.parser.parse_args()
+        res = session.query(Job)
+        if args.get('Status'):
+            res = res.filter(Job.Status == args.get('Status'))
+        if args.get('Type'):
+            res = res.filter(Job.Type == args.get('Type'))
+        if args.get('stream'):
+            return stream_ndjson(res.order_by(Job.JobID), JobSchema())
+        return keyset_paginate(res, Job.JobID, args.get('limit'), args.get('after'))
+
+    @flask_accepts.accepts(schema=SubmitJobSchema, api=jobs_ns)
+    @flask_accepts.responds(schema=JobSchema, status_code=202, api=jobs_ns)
+    def post(self):
+        """ submits a job (e.g. {"type": "create-sample-data", "params": {"customers": 1000}}), poll the Location for its status """
+        payload = request.parsed_obj
+        try:
+            jobId = job_queue.submit(payload['type'], payload['params'])
+        except UnknownJobType as e:
+            return dynamic_error(message=str(e))
+        except ValidationError as e:
+            return dynamic_error(message=f'Invalid params for {payload["type"]}: {e.messages}')
+
+        location = url_for('orders_api.jobs_job_handler', id=jobId)
+
+        @after_this_request
+        def add_location(response):
+            response.headers['Location'] = location
+            return response
+
+        return session.query(Job).get(jobId)
+
+
+@jobs_ns.route('/<int:id>')
+class JobHandler(Resource):
+
+    @flask_accepts.responds(schema=JobSchema, api=jobs_ns)
+    def get(self, id):
+        """ fetches a job with its status, progress and result """
+        job = session.query(Job).get(id)
+        if not job:
+            return dynamic_error(code=404, message=f'Invalid Job ID: {id}')
+        return job
+
+
+@products_ns.route('') # will already be /products
+class Products(Resource):
+
+    @flask_accepts.responds(schema=ProductSchema(many=True), api=products_ns)
+    def get(self):
+        """ fetches the product catalog with list prices, served from memory """
+        return product_catalog.products()
+
+    @flask_accepts.accepts(schema=ProductSchema, api=products_ns)
+    def post(self):
+        """ adds a product to the catalog """
+        product = ProductSchema().load(request.json)
+        if product_catalog.id_for(product.Name) is not None:
+            return dynamic_error(message=f'Product already exists: {product.Name}')
+        session.add(product)
+        session.commit()
+        return success(message='Successfully Added New Product', id=product.ProductID)
+
+
+@products_ns.route('/<int:id>')
+class ProductHandler(Resource):
+
+    @conditional(product_etag)
+    @flask_accepts.responds(schema=ProductSchema, api=products_ns)
+    def get(self, id):
+        """ fetch a product with its list price """
+        name = product_catalog.name_for(id)
+        if name is None:
+            return dynamic_error(code=404, message=f'Invalid Product ID: {id}')
+        return {'ProductID': id, 'Name': name, 'UnitPrice': product_catalog.price_for(id)}
+
+    @optimistic
+    @flask_accepts.accepts(schema=ProductSchema(partial=True), api=products_ns)
+    @flask_accepts.responds(schema=UpdateResourceSchema, api=products_ns)
+    def put(self, id):
+        """ change a product's name or list price, items already sold keep their price and label """
+        product = session.query(Product).get(id)
+        if not product:
+            return dynamic_error(code=404, message=f'Invalid Product ID: {id}')
+        failed = precondition_failed(product_etag(id))
+        if failed:
+            return failed
+        payload = request.json
+        if product_catalog.id_for(payload.get('Name')) not in (None, id):
+            return dynamic_error(message=f'Product already exists: {payload["Name"]}')
+        for k,v in payload.items():
+            if k in ('Name', 'UnitPrice'):
+                setattr(product, k, v)
         session.commit()
 
-        return success(message='Successfully Created Order', id=order.OrderHeaderID)
\ No newline at end of file
+        response = success(message='Successfully Updated Product', id=id)
+        response.set_etag(product_etag(id))
+        return response
@@ -0,0 +1,102 @@
+""" deterministic synthetic data in the same shape as sample_data
+
+usage:
+    python -m app.blueprints.orders.data.generator --customers 10000 --orders 10 --items 5 --seed 42
+"""
+import argparse
+import datetime
+import random
+import time
+
+FIRST_NAMES = ['Jen', 'Doug', 'Bob', 'Alice', 'Maria', 'James', 'Linda', 'Omar', 'Priya', 'Chen', 'Sofia', 'Liam']
+LAST_NAMES = ['Simpson', 'Johnson', 'Hanson', 'Wonderland', 'Garcia', 'Smith', 'Nguyen', 'Patel', 'Brown', 'Lopez']
+STATES = ['MN', 'TX', 'CA', 'NY', 'WI', 'IA', 'FL', 'WA']
+
+# product name -> base unit price
+PRODUCTS = {
+    'Pirate': 10.25,
+    'Ninja': 11.12,
+    'Monster': 20.50,
+    'Frog': 14.68,
+    'Sailor': 18.32,
+    'Koala': 52.03,
+    'Sunglasses': 14.99,
+    'Robot': 32.40
+}
+
+START_DATE = datetime.datetime(2010, 1, 1)
+END_DATE = datetime.datetime(2020, 12, 31)
+
+
+def generate_sample_data(customers=1000, orders=10, items=3, seed=0):
+    """ generates customers with nested Orders and Items like data.sample_data
+
+    The same arguments always produce the same data.  Customers are generated
+    lazily so very large data sets never have to fit in memory at once.
+
+    Args:
+        customers (int, optional): the number of customers
+        orders (int, optional): the number of orders per customer
+        items (int, optional): the number of items per order
+        seed (int, optional): the random seed
+
+    Returns:
+        dict: {"customers": <generator of customer dicts>}
+    """
+    productNames = list(PRODUCTS)
+    span = int((END_DATE - START_DATE).total_seconds())
+
+    def customer_generator():
+        rand = random.Random(seed)
+        for _ in range(customers):
+            customerOrders = []
+            for _ in range(orders):
+                orderItems = []
+                for _ in range(items):
+                    product = rand.choice(productNames)
+                    orderItems.append({
+                        'ProductName': product,
+                        'Quantity': rand.randint(1, 10),
+                        'UnitPrice': PRODUCTS[product]
+                    })
+                customerOrders.append({
+                    'Product': orderItems[0]['ProductName'] if orderItems else rand.choice(productNames),
+                    'ShippingTotal': round(rand.uniform(0, 25), 2),
+                    'CreationDate': START_DATE + datetime.timedelta(seconds=rand.randrange(span)),
+                    'Items': orderItems
+                })
+            yield {
+                'FirstName': rand.choice(FIRST_NAMES),
+                'LastName': rand.choice(LAST_NAMES),
+                'ShipToState': rand.choice(STATES),
+                'Orders': customerOrders
+            }
+
+    return {'customers': customer_generator()}
+
+
+def main(argv=None):
+    from ..database import DEFAULT_CONFIG, create_engine_from_config
+    from ..models import Base
+    from ..bulk import load_sample_data
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=1000, help='number of customers')
+    parser.add_argument('--orders', type=int, default=10, help='orders per customer')
+    parser.add_argument('--items', type=int, default=3, help='items per order')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--database-url', default=DEFAULT_CONFIG['ORDERS_DATABASE_URL'], help='the database to recreate')
+    args = parser.parse_args(argv)
+
+    engine = create_engine_from_config({}, args.database_url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    start = time.perf_counter()
+    counts = load_sample_data(engine, generate_sample_data(args.customers, args.orders, args.items, args.seed))
+    elapsed = time.perf_counter() - start
+    print(f'loaded {counts["customers"]} customers, {counts["orders"]} orders and {counts["items"]} items in {elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import os
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.schema import CreateColumn
+
+thisDir = os.path.abspath(os.path.dirname(__file__))
+db_path = os.path.join(thisDir, 'data', 'Orders.db')
+
+DEFAULT_CONFIG = {
+    # the database url, can also be set with the ORDERS_DATABASE_URL environment variable
+    'ORDERS_DATABASE_URL': os.environ.get('ORDERS_DATABASE_URL', f'sqlite:///{db_path}'),
+    'ORDERS_POOL_SIZE': 5,
+    'ORDERS_MAX_OVERFLOW': 10,
+    'ORDERS_POOL_RECYCLE': 3600,
+    'ORDERS_POOL_PRE_PING': True,
+    # sqlite only settings, applied as pragmas on every new connection
+    'ORDERS_SQLITE_WAL': True,
+    'ORDERS_SQLITE_SYNCHRONOUS': 'NORMAL',
+    'ORDERS_SQLITE_BUSY_TIMEOUT': 5000,
+    # create missing tables, columns and indexes (and load the sample data into an empty database) on the
+    # first request, turn off to run "flask orders migrate" and "flask orders seed" as deployment steps instead
+    'ORDERS_AUTO_MIGRATE': True
+}
+
+class RoutingSession(Session):
+    """ session that lets a router pick the engine for each statement, e.g. a read replica (see replicas.py)
+
+    The router's bind_for(session) returns an engine, or None for the bound (primary) engine.
+    """
+    router = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.router is not None:
+            bind = self.router.bind_for(self)
+            if bind is not None:
+                return bind
+        return super().get_bind(mapper, clause)
+
+
+# thread local session, the engine is bound when the app is initialized
+session = scoped_session(sessionmaker(class_=RoutingSession))
+
+
+def use_session_class(class_):
+    """ makes the session create instances of a RoutingSession subclass from now on, e.g. the sharded session
+
+    Args:
+        class_ (type): the RoutingSession subclass
+    """
+    session.remove()
+    # like sessionmaker(class_=...), a subclass of its own keeps events on it apart
+    session.session_factory.class_ = type(class_.__name__, (class_,), {})
+
+
+def primary_bind():
+    """ returns the engine the session is bound to, writes and DDL always go here even when reads use replicas """
+    return session.session_factory.kw['bind']
+
+
+def sqlite_pragmas(config):
+    """ returns the PRAGMA statements to run on every new sqlite connection """
+    pragmas = [f'PRAGMA busy_timeout={int(config["ORDERS_SQLITE_BUSY_TIMEOUT"])}']
+    if config['ORDERS_SQLITE_WAL']:
+        pragmas.append('PRAGMA journal_mode=WAL')
+    if config['ORDERS_SQLITE_SYNCHRONOUS']:
+        pragmas.append(f'PRAGMA synchronous={config["ORDERS_SQLITE_SYNCHRONOUS"]}')
+    return pragmas
+
+
+def _sqlite_pragmas(config):
+    """ creates a connect listener that applies the sqlite pragmas from the config """
+    pragmas = sqlite_pragmas(config)
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return on_connect
+
+
+def create_engine_from_config(config, url=None):
+    """ creates an engine with the pool and sqlite settings from a config mapping
+
+    Args:
+        config (dict): the app config, missing keys fall back to DEFAULT_CONFIG
+        url (str, optional): overrides the ORDERS_DATABASE_URL setting
+
+    Returns:
+        Engine: the engine
+    """
+    config = dict(DEFAULT_CONFIG, **{k: v for k, v in config.items() if k.startswith('ORDERS_')})
+    url = make_url(url or config['ORDERS_DATABASE_URL'])
+    kwargs = {
+        'pool_pre_ping': config['ORDERS_POOL_PRE_PING'],
+        'pool_recycle': config['ORDERS_POOL_RECYCLE']
+    }
+    pooled = {
+        'pool_size': config['ORDERS_POOL_SIZE'],
+        'max_overflow': config['ORDERS_MAX_OVERFLOW']
+    }
+
+    isSqlite = url.get_backend_name() == 'sqlite'
+    if isSqlite:
+        kwargs['connect_args'] = {'check_same_thread': False}
+        if url.database and url.database != ':memory:':
+            # sqlite file databases default to NullPool, use a real pool so connections are reused
+            kwargs.update(pooled, poolclass=QueuePool)
+        else:
+            # an in memory database only exists for a single connection
+            kwargs['poolclass'] = StaticPool
+    else:
+        kwargs.update(pooled)
+
+    engine = create_engine(url, **kwargs)
+    if isSqlite:
+        event.listen(engine, 'connect', _sqlite_pragmas(config))
+    return engine
+
+
+def create_missing_indexes(engine, Base):
+    """ creates any indexes declared on the models that do not exist yet
+
+    create_all() skips tables that already exist, so indexes added to the models
+    later are never built on an existing database without this.
+
+    Args:
+        engine (Engine): the engine
+        Base (declarative_base): the sqlalchemy declarative_base
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
+def add_missing_columns(engine, Base):
+    """ adds columns declared on the models that do not exist on their tables yet
+
+    Like create_missing_indexes(), this keeps existing databases usable when a
+    column is added to a model.  Only columns that are nullable or have a
+    server_default can be added to a table that already has rows.
+
+    Args:
+        engine (Engine): the engine
+        Base (declarative_base): the sqlalchemy declarative_base
+
+    Returns:
+        list: the "Table.Column" names that were added
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise RuntimeError(f'cannot add NOT NULL column {table.name}.{column.name} without a server_default')
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(f'ALTER TABLE {engine.dialect.identifier_preparer.format_table(table)} ADD COLUMN {ddl}')
+            added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def migrate(engine, Base):
+    """ creates any missing tables, columns and indexes
+
+    Args:
+        engine (Engine): the engine
+        Base (declarative_base): the sqlalchemy declarative_base
+
+    Returns:
+        Engine: the engine
+    """
+    # create all tables
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine, Base)
+    create_missing_indexes(engine, Base)
+    return engine
+
+
+def bind_session(engine, Base):
+    """ binds the session to an engine without touching the schema
+
+    Args:
+        engine (Engine): the engine
+        Base (declarative_base): the sqlalchemy declarative_base
+
+    Returns:
+        Engine: the engine
+    """
+    Base.metadata.bind = engine
+    session.remove()
+    session.configure(bind=engine)
+    return engine
+
+
+def bind_engine(engine, Base):
+    """ creates any missing tables, columns and indexes and binds the session to an engine
+
+    Args:
+        engine (Engine): the engine
+        Base (declarative_base): the sqlalchemy declarative_base
+
+    Returns:
+        Engine: the engine
+    """
+    return bind_session(migrate(engine, Base), Base)
+
+
+def init_app(app, Base):
+    """ binds the session to an engine built from the app config and removes it at teardown
+
+    No connection is opened here, the schema is created by migrate() (see ORDERS_AUTO_MIGRATE).
+
+    Args:
+        app (Flask): the flask app
+        Base (declarative_base): the sqlalchemy declarative_base
+    """
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    engine = bind_session(create_engine_from_config(app.config), Base)
+
+    # discard the identity map and return the connection to the pool after every request
+    @app.teardown_appcontext
+    def remove_session(exception=None):
+        session.remove()
+
+    return engine
@@ -0,0 +1,200 @@
+""" streams the order and item tables as CSV, Arrow IPC or Parquet in fixed size batches
+
+Rows are read with a streaming (server side where the driver supports it)
+cursor and fetched batch_size at a time, and every batch is encoded and sent
+before the next one is read, so memory use depends on the batch size and not
+on the size of the table.  Arrow and Parquet need the optional pyarrow package.
+"""
+import csv
+import datetime
+import io
+from flask import Response
+from flask_restx import inputs
+from sqlalchemy import DateTime, Float, Integer, and_, select
+from .models import Customer, OrderHeader, OrderItem
+from .utils import dynamic_error
+
+# default number of rows read and encoded per batch
+EXPORT_BATCH_SIZE = 10000
+
+# format -> (content type, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet')
+}
+
+
+def add_export_args(parser):
+    """ adds the export format, customer join and batch size args to a request parser
+
+    Args:
+        parser (RequestParser): the namespace parser for an export endpoint
+    """
+    parser.add_argument('format', type=str, choices=tuple(EXPORT_FORMATS), default='csv', help='csv, arrow (IPC stream) or parquet')
+    parser.add_argument('customer', type=inputs.boolean, help='add the customer name and state columns')
+    parser.add_argument('batchSize', type=int, help=f'number of rows read and written per batch (default {EXPORT_BATCH_SIZE})')
+    return parser
+
+
+def export_query(model, filters=(), withCustomer=False):
+    """ builds the select for an export of the OrderHeader or OrderItem table
+
+    Args:
+        model (Base): OrderHeader or OrderItem
+        filters (list, optional): where clauses
+        withCustomer (bool, optional): left join the customer and add its columns
+
+    Returns:
+        Select: the statement, ordered by the primary key
+    """
+    table = model.__table__
+    columns = list(table.columns)
+    fromClause = table
+    if withCustomer:
+        if model is OrderItem:
+            fromClause = fromClause.outerjoin(OrderHeader.__table__, OrderItem.OrderHeaderID == OrderHeader.OrderHeaderID)
+            columns.append(OrderHeader.CustomerID)
+        fromClause = fromClause.outerjoin(Customer.__table__, OrderHeader.CustomerID == Customer.CustomerID)
+        columns += [Customer.FirstName, Customer.LastName, Customer.ShipToState]
+
+    stmt = select(columns).select_from(fromClause).order_by(*table.primary_key.columns)
+    filters = list(filters)
+    if filters:
+        stmt = stmt.where(and_(*filters))
+    return stmt
+
+
+def iter_batches(engine, stmt, batch_size=EXPORT_BATCH_SIZE):
+    """ yields the rows of a statement batch_size at a time from a streaming cursor
+
+    The connection is returned to the pool when the generator is exhausted or closed.
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(stmt)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+
+
+def _csv_value(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def write_csv(columns, batches):
+    """ encodes batches of rows as csv, yielding the header and then one chunk per batch """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.name for column in columns])
+    for rows in batches:
+        writer.writerows([_csv_value(value) for value in row] for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _arrow_type(column):
+    import pyarrow as pa
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+class _Sink:
+    """ write only file object that collects what pyarrow writes so it can be sent after every batch """
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def write_arrow(columns, batches, parquet=False):
+    """ encodes batches of rows as an Arrow IPC stream (or Parquet, one row group per batch) """
+    import pyarrow as pa
+
+    schema = pa.schema([(column.name, _arrow_type(column)) for column in columns])
+    sink = _Sink()
+    if parquet:
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    try:
+        for rows in batches:
+            arrays = [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)]
+            batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+            if parquet:
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_response(engine, model, filters=(), args=None):
+    """ builds the streaming response for an export endpoint
+
+    Args:
+        engine (Engine): the engine to read from
+        model (Base): OrderHeader or OrderItem
+        filters (list, optional): where clauses
+        args (dict, optional): the parsed format, customer and batchSize args
+
+    Returns:
+        flask.Response: the streaming response, or an error when the format needs pyarrow and it is not installed
+    """
+    args = args or {}
+    exportFormat = args.get('format') or 'csv'
+    batchSize = max(1, args.get('batchSize') or EXPORT_BATCH_SIZE)
+    if exportFormat != 'csv':
+        try:
+            import pyarrow
+        except ImportError:
+            return dynamic_error(message=f'The {exportFormat} export format requires the pyarrow package')
+
+    stmt = export_query(model, filters, bool(args.get('customer')))
+    columns = list(stmt.inner_columns)
+    batches = iter_batches(engine, stmt, batchSize)
+    if exportFormat == 'csv':
+        body = write_csv(columns, batches)
+    else:
+        body = write_arrow(columns, batches, parquet=exportFormat == 'parquet')
+
+    contentType, extension = EXPORT_FORMATS[exportFormat]
+    response = Response(body, content_type=contentType)
+    response.headers['Content-Disposition'] = f'attachment; filename={model.__tablename__}.{extension}'
+    return response
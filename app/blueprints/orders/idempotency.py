@@ -0,0 +1,178 @@
+""" Idempotency-Key support for write endpoints that clients retry
+
+The first request with a key stores a pending marker, runs, and then stores its
+response for ORDERS_IDEMPOTENCY_TTL seconds.  Retries get that response back and
+duplicates wait for the first request, so only one of them runs.  A key reused
+for a different request gets 422, and 5xx responses are not stored.  Set
+ORDERS_IDEMPOTENCY_BACKEND to a shared cache (e.g. RedisCache) to coalesce
+retries across processes; the marker expires after
+ORDERS_IDEMPOTENCY_LOCK_SECONDS there, so keep that above the longest request.
+"""
+import hashlib
+import json
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from flask_restx.utils import unpack
+from werkzeug.wrappers import BaseResponse
+from .cache import LRUCache
+from .serializers import dumps
+from .utils import dynamic_error
+
+DEFAULT_CONFIG = {
+    'ORDERS_IDEMPOTENCY_ENABLED': True,
+    # how long a stored response is replayed (seconds)
+    'ORDERS_IDEMPOTENCY_TTL': 24 * 60 * 60,
+    'ORDERS_IDEMPOTENCY_MAX_ENTRIES': 10000,
+    # how long a running request holds its key, a duplicate waits at most this long before it gets 409
+    'ORDERS_IDEMPOTENCY_LOCK_SECONDS': 30,
+    # an instance of a cache.CacheBackend, the in process LRUCache is used when this is None
+    'ORDERS_IDEMPOTENCY_BACKEND': None
+}
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+# response headers stored with the body and sent again on replays
+STORED_HEADERS = ('Location', 'ETag')
+
+# longest key accepted
+MAX_KEY_LENGTH = 255
+
+# seconds between checks of a key held by another process
+POLL_INTERVAL = 0.05
+
+
+class IdempotencyStore:
+    """ stores the responses of requests sent with an Idempotency-Key and coalesces duplicates """
+    def __init__(self, backend=None, ttl=DEFAULT_CONFIG['ORDERS_IDEMPOTENCY_TTL'], enabled=True):
+        self.backend = backend or LRUCache()
+        self.ttl = ttl
+        self.lockSeconds = DEFAULT_CONFIG['ORDERS_IDEMPOTENCY_LOCK_SECONDS']
+        self.enabled = enabled
+        self.replays = 0
+        self.coalesced = 0
+        # key -> (Event set when the request holding it in this process finishes, its fingerprint)
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.enabled = app.config['ORDERS_IDEMPOTENCY_ENABLED']
+        self.ttl = app.config['ORDERS_IDEMPOTENCY_TTL']
+        self.lockSeconds = app.config['ORDERS_IDEMPOTENCY_LOCK_SECONDS']
+        self.backend = app.config['ORDERS_IDEMPOTENCY_BACKEND'] or LRUCache(app.config['ORDERS_IDEMPOTENCY_MAX_ENTRIES'])
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'replays': self.replays, 'coalesced': self.coalesced}
+
+    def _claim(self, storeKey, fingerprint):
+        """ returns None when this request now holds the key, otherwise the stored entry (pending or finished) """
+        with self._lock:
+            # a request in this process holds its key even after the marker expired
+            if storeKey in self._running:
+                return {'pending': True, 'fingerprint': self._running[storeKey][1]}
+            if self.backend.add(storeKey, dumps({'fingerprint': fingerprint, 'pending': True}), self.lockSeconds):
+                self._running[storeKey] = (threading.Event(), fingerprint)
+                return None
+        value = self.backend.get(storeKey)
+        # the entry may have expired or been released in between, the caller tries again
+        return json.loads(value) if value is not None else {'pending': True, 'fingerprint': fingerprint}
+
+    def _release(self, storeKey, entry=None):
+        if entry is None:
+            self.backend.delete(storeKey)
+        else:
+            self.backend.set(storeKey, dumps(entry), self.ttl)
+        with self._lock:
+            event, _ = self._running.pop(storeKey, (None, None))
+        if event is not None:
+            event.set()
+
+    def _wait(self, storeKey, deadline):
+        """ blocks until the request holding the key finishes or a moment passes (when another process holds it) """
+        with self._lock:
+            event, _ = self._running.get(storeKey, (None, None))
+        timeout = max(0, deadline - time.monotonic())
+        if event is not None:
+            event.wait(timeout)
+        else:
+            time.sleep(min(POLL_INTERVAL, timeout))
+
+    def idempotent(self, func):
+        """ decorator for flask_restx resource methods that honors the Idempotency-Key request header
+
+        Place it above the flask_accepts decorators so the final response is stored.
+        """
+        @wraps(func)
+        def inner(resource, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not self.enabled or not key:
+                return func(resource, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return dynamic_error(message=f'{HEADER} must be at most {MAX_KEY_LENGTH} characters')
+
+            fingerprint = hashlib.sha256(b'\n'.join([
+                request.method.encode(), request.full_path.encode(), request.get_data()
+            ])).hexdigest()
+            storeKey = f'idempotency:{key}'
+            deadline = time.monotonic() + self.lockSeconds
+            waited = False
+            while True:
+                entry = self._claim(storeKey, fingerprint)
+                if entry is None:
+                    break
+                if entry['fingerprint'] != fingerprint:
+                    return dynamic_error(code=422, description='Unprocessable Entity', message=f'{HEADER} {key} was already used for a different request')
+                if not entry.get('pending'):
+                    with self._lock:
+                        self.replays += 1
+                        self.coalesced += waited
+                    return self._replay(entry)
+                if time.monotonic() >= deadline:
+                    response = dynamic_error(code=409, description='Conflict', message=f'A request with {HEADER} {key} is still running')
+                    response.headers['Retry-After'] = '1'
+                    return response
+                waited = True
+                self._wait(storeKey, deadline)
+
+            try:
+                response = self._make_response(resource, func(resource, *args, **kwargs))
+            except BaseException:
+                self._release(storeKey)
+                raise
+            if response.status_code >= 500 or response.is_streamed:
+                self._release(storeKey)
+            else:
+                self._release(storeKey, {
+                    'fingerprint': fingerprint,
+                    'status': response.status_code,
+                    'body': response.get_data(as_text=True),
+                    'mimetype': response.mimetype,
+                    'headers': {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+                })
+            return response
+        return inner
+
+    @staticmethod
+    def _make_response(resource, rv):
+        # the same conversion flask_restx.Resource.dispatch_request applies to the return value
+        if isinstance(rv, BaseResponse):
+            return rv
+        data, code, headers = unpack(rv)
+        return resource.api.make_response(data, code, headers=headers)
+
+    @staticmethod
+    def _replay(entry):
+        response = current_app.response_class(entry['body'], status=entry['status'], mimetype=entry['mimetype'])
+        response.headers.extend(entry['headers'])
+        response.headers[REPLAYED_HEADER] = 'true'
+        return response
+
+
+# shared idempotency key store for the orders api
+idempotency_store = IdempotencyStore()
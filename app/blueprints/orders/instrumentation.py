@@ -0,0 +1,232 @@
+""" per request SQL instrumentation, Server-Timing headers, prometheus metrics and opt-in profiling
+
+Statements are timed with the engine's cursor events and summed per request
+(Server-Timing) and per endpoint (/orders/_metrics).  A streamed response is
+recorded once the server closes it.  With ORDERS_PROFILING_ENABLED, ?profile=1
+runs a request under cProfile and lists the hottest functions in X-Profile.
+"""
+import cProfile
+import os
+import pstats
+import re
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+DEFAULT_CONFIG = {
+    'ORDERS_INSTRUMENTATION_ENABLED': True,
+    # allow ?profile=1 to run a request under cProfile, keep it off on public deployments
+    'ORDERS_PROFILING_ENABLED': False,
+    # number of functions listed in the X-Profile header
+    'ORDERS_PROFILE_TOP': 10,
+    # also write every profile to this folder as a .prof file (for pstats, snakeviz, etc)
+    'ORDERS_PROFILE_DIR': None
+}
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name, prometheus type, help text, RequestMetrics attribute
+METRICS = [
+    ('orders_http_requests_total', 'counter', 'Requests handled', 'requests'),
+    ('orders_http_request_errors_total', 'counter', 'Requests answered with a 4xx or 5xx status', 'errors'),
+    ('orders_http_request_duration_seconds_total', 'counter', 'Time spent handling requests', 'duration'),
+    ('orders_db_statements_total', 'counter', 'SQL statements executed', 'statements'),
+    ('orders_db_duration_seconds_total', 'counter', 'Time spent executing SQL statements', 'dbTime'),
+    ('orders_db_rows_total', 'counter', 'Rows loaded by the ORM or changed by writes, Core selects are not counted', 'rows'),
+    ('orders_db_slowest_statement_seconds', 'gauge', 'Slowest single SQL statement seen', 'slowest')
+]
+
+
+class RequestStats:
+    """ SQL totals for a single request """
+    __slots__ = ('started', 'statements', 'dbTime', 'slowest', 'slowestStatement', 'rows', 'profile')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.dbTime = 0.0
+        self.slowest = 0.0
+        self.slowestStatement = None
+        self.rows = 0
+        self.profile = None
+
+    def server_timing(self, total):
+        """ formats the Server-Timing header value (durations in milliseconds) """
+        return (f'db;dur={self.dbTime * 1000:.2f};desc="{self.statements} statements, {self.rows} orm rows", '
+                f'db-slowest;dur={self.slowest * 1000:.2f}, '
+                f'total;dur={total * 1000:.2f}')
+
+
+class RequestMetrics:
+    """ running totals for one endpoint """
+    __slots__ = ('requests', 'errors', 'duration', 'statements', 'dbTime', 'rows', 'slowest')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.duration = 0.0
+        self.statements = 0
+        self.dbTime = 0.0
+        self.rows = 0
+        self.slowest = 0.0
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _current_stats():
+    if has_request_context():
+        return g.get('_orders_stats')
+    return None
+
+
+class Instrumentation:
+    """ collects SQL statistics per request and aggregates them per endpoint """
+    def __init__(self):
+        self.enabled = DEFAULT_CONFIG['ORDERS_INSTRUMENTATION_ENABLED']
+        self.profiling = DEFAULT_CONFIG['ORDERS_PROFILING_ENABLED']
+        self.profileTop = DEFAULT_CONFIG['ORDERS_PROFILE_TOP']
+        self.profileDir = DEFAULT_CONFIG['ORDERS_PROFILE_DIR']
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._listening = False
+
+    def init_app(self, app):
+        """ reads the settings from the app config and registers the request hooks and engine events """
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.enabled = app.config['ORDERS_INSTRUMENTATION_ENABLED']
+        self.profiling = app.config['ORDERS_PROFILING_ENABLED']
+        self.profileTop = app.config['ORDERS_PROFILE_TOP']
+        self.profileDir = app.config['ORDERS_PROFILE_DIR']
+
+        # listen on the Engine class so engines rebound later (scratch databases, replicas) are covered too
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(Mapper, 'load', self._on_load)
+            self._listening = True
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    #***********************************************************************************************************##
+    #  ENGINE EVENTS                                                                                             ##
+    #***********************************************************************************************************##
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if _current_stats() is not None:
+            conn.info.setdefault('orders_query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = _current_stats()
+        starts = conn.info.get('orders_query_start')
+        if stats is None or not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        stats.statements += 1
+        stats.dbTime += elapsed
+        if elapsed > stats.slowest:
+            stats.slowest = elapsed
+            stats.slowestStatement = statement
+        # rows returned by a SELECT are counted as the ORM loads them, the rowcount covers writes
+        if cursor.rowcount > 0 and not statement.lstrip()[:6].upper() == 'SELECT':
+            stats.rows += cursor.rowcount
+
+    def _on_load(self, target, context):
+        stats = _current_stats()
+        if stats is not None:
+            stats.rows += 1
+
+    #***********************************************************************************************************##
+    #  REQUEST HOOKS                                                                                             ##
+    #***********************************************************************************************************##
+    def _before_request(self):
+        if not self.enabled:
+            return
+        stats = g._orders_stats = RequestStats()
+        if self.profiling and request.args.get('profile') in ('1', 'true'):
+            stats.profile = cProfile.Profile()
+            stats.profile.enable()
+
+    def _after_request(self, response):
+        stats = g.get('_orders_stats')
+        if stats is None:
+            return response
+        if stats.profile is not None:
+            stats.profile.disable()
+            response.headers['X-Profile'] = self.profile_summary(stats.profile)
+            if self.profileDir:
+                self.dump_profile(stats.profile)
+
+        response.headers['Server-Timing'] = stats.server_timing(time.perf_counter() - stats.started)
+        key = (request.method, request.url_rule.rule if request.url_rule else 'unmatched')
+        if response.is_streamed:
+            # the body runs its queries while it is sent, the stats stay on g (kept by stream_with_context) until it is closed
+            response.call_on_close(lambda: self._record(key, response.status_code, stats))
+        else:
+            g.pop('_orders_stats')
+            self._record(key, response.status_code, stats)
+        return response
+
+    def _record(self, key, status, stats):
+        """ adds a finished request to the totals of its endpoint """
+        total = time.perf_counter() - stats.started
+        with self._lock:
+            metrics = self._metrics.get(key)
+            if metrics is None:
+                metrics = self._metrics[key] = RequestMetrics()
+            metrics.requests += 1
+            metrics.errors += status >= 400
+            metrics.duration += total
+            metrics.statements += stats.statements
+            metrics.dbTime += stats.dbTime
+            metrics.rows += stats.rows
+            metrics.slowest = max(metrics.slowest, stats.slowest)
+
+    #***********************************************************************************************************##
+    #  OUTPUT                                                                                                    ##
+    #***********************************************************************************************************##
+    def profile_summary(self, profile):
+        """ one line summary of a profile: the totals and the functions with the most internal time
+
+        Returns:
+            str: e.g. "1523 calls in 12.31ms; 3.02ms sqlite3.Cursor.execute; 1.10ms serializers.py:81(dump)"
+        """
+        stats = pstats.Stats(profile)
+        stats.sort_stats('tottime')
+        parts = [f'{stats.total_calls} calls in {stats.total_tt * 1000:.2f}ms']
+        for func in stats.fcn_list[:self.profileTop]:
+            filename, line, name = func
+            internal = stats.stats[func][2]
+            where = f'{os.path.basename(filename)}:{line}({name})' if line else name.strip('<>{}')
+            parts.append(f'{internal * 1000:.2f}ms {where}')
+        return '; '.join(parts)
+
+    def dump_profile(self, profile):
+        """ writes a profile to ORDERS_PROFILE_DIR, named after the time and the request """
+        os.makedirs(self.profileDir, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', f'{request.method}{request.path}').strip('_')
+        profile.dump_stats(os.path.join(self.profileDir, f'{time.time_ns()}-{name}.prof'))
+
+    def render(self):
+        """ the per endpoint metrics in the prometheus text exposition format """
+        with self._lock:
+            snapshot = sorted(self._metrics.items())
+            lines = []
+            for name, kind, description, attr in METRICS:
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                for (method, endpoint), metrics in snapshot:
+                    lines.append(f'{name}{{method="{_label(method)}",endpoint="{_label(endpoint)}"}} {getattr(metrics, attr)}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+instrumentation = Instrumentation()
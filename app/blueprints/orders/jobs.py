@@ -0,0 +1,193 @@
+""" background jobs for long running operations, kept in the Job table of the orders database
+
+A job is a row in the Job table plus a registered function.  Submitting one
+inserts the row as "queued" and hands its id to a thread pool; a worker claims
+it with a conditional UPDATE (so a job only ever runs once, even with several
+processes sharing the database), runs the function and records the result or
+the error.  Functions report progress through the callable they are passed,
+which also keeps the row's UpdatedAt current.  Jobs still queued when a process
+starts are picked up again and running jobs that stopped reporting are failed.
+"""
+import datetime
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func, select
+from .database import session
+from .models import Job
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    # worker threads per process, 0 runs jobs inside the request that submits them
+    'ORDERS_JOB_WORKERS': 2,
+    # running jobs that have not reported progress for this many seconds are failed on startup
+    'ORDERS_JOB_STALE_AFTER': 600
+}
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+
+WORKER_NAME = f'{socket.gethostname()}:{os.getpid()}'
+
+
+class UnknownJobType(ValueError):
+    pass
+
+
+class JobQueue:
+    """ registry of job types and the thread pool that runs them """
+    def __init__(self):
+        self.types = {}
+        self.app = None
+        self.workers = DEFAULT_CONFIG['ORDERS_JOB_WORKERS']
+        self.staleAfter = DEFAULT_CONFIG['ORDERS_JOB_STALE_AFTER']
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.app = app
+        self.workers = app.config['ORDERS_JOB_WORKERS']
+        self.staleAfter = app.config['ORDERS_JOB_STALE_AFTER']
+
+    def job(self, name, schema=None, exclusive=False):
+        """ decorator that registers a job type
+
+        The function is called as func(progress, **params) and returns a json
+        serializable result.  progress(fraction=None, message=None) records how far along it is.
+
+        Args:
+            name (str): the job type, e.g. "create-sample-data"
+            schema (Schema, optional): validates and loads the params when the job is submitted
+            exclusive (bool, optional): only one job of this type can be queued or running at a time
+        """
+        def decorator(func):
+            self.types[name] = (func, schema, exclusive)
+            return func
+        return decorator
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='orders-job')
+            return self._executor
+
+    #***********************************************************************************************************##
+    #  SUBMITTING                                                                                                ##
+    #***********************************************************************************************************##
+    def submit(self, jobType, params=None):
+        """ validates the params, stores the job and schedules it, an exclusive job type that already has a
+        queued or running job returns that job instead
+
+        Args:
+            jobType (str): a registered job type
+            params (dict, optional): the job params
+
+        Raises:
+            UnknownJobType: for a type that is not registered
+            ValidationError: when the params do not match the job's schema
+
+        Returns:
+            int: the JobID
+        """
+        if jobType not in self.types:
+            raise UnknownJobType(f'Unknown job type: {jobType}, expected one of {", ".join(sorted(self.types))}')
+        schema, exclusive = self.types[jobType][1:]
+        params = schema.load(params or {}) if schema is not None else (params or {})
+
+        table = Job.__table__
+        with session.get_bind().connect() as conn:
+            with conn.begin() as trans:
+                jobId = conn.execute(table.insert().values(
+                    Type=jobType, Status=QUEUED, Params=params, Progress=0, CreatedAt=datetime.datetime.utcnow()
+                )).inserted_primary_key[0]
+                if exclusive:
+                    # the insert holds the sqlite write lock until commit, so a concurrent submit of the same type
+                    # has either committed its job already or waits and finds this one
+                    firstId = conn.execute(select([func.min(table.c.JobID)]).where(table.c.Type == jobType).where(
+                        table.c.Status.in_((QUEUED, RUNNING))
+                    )).scalar()
+                    if firstId != jobId:
+                        trans.rollback()
+                        return firstId
+        self._dispatch(jobId)
+        return jobId
+
+    def _dispatch(self, jobId):
+        if self.workers:
+            self._pool().submit(self._run_in_context, jobId)
+        else:
+            self.run(jobId)
+
+    def recover(self):
+        """ fails running jobs that stopped reporting progress and schedules the queued ones again
+
+        Returns:
+            list: the ids of the queued jobs that were scheduled
+        """
+        table = Job.__table__
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.staleAfter)
+        with session.get_bind().begin() as conn:
+            conn.execute(table.update().where(table.c.Status == RUNNING).where(table.c.UpdatedAt < stale).values(
+                Status=FAILED, Message='The worker stopped before the job finished', FinishedAt=datetime.datetime.utcnow()
+            ))
+            queued = [row[0] for row in conn.execute(select([table.c.JobID]).where(table.c.Status == QUEUED).order_by(table.c.JobID))]
+        for jobId in queued:
+            self._dispatch(jobId)
+        return queued
+
+    #***********************************************************************************************************##
+    #  RUNNING                                                                                                   ##
+    #***********************************************************************************************************##
+    def _run_in_context(self, jobId):
+        try:
+            if self.app is not None:
+                with self.app.app_context():
+                    self.run(jobId)
+            else:
+                self.run(jobId)
+        finally:
+            session.remove()
+
+    def _update(self, jobId, **values):
+        table = Job.__table__
+        with session.get_bind().begin() as conn:
+            return conn.execute(table.update().where(table.c.JobID == jobId).values(**values)).rowcount
+
+    def run(self, jobId):
+        """ claims a queued job and runs it in the current thread, does nothing if another worker claimed it first """
+        table = Job.__table__
+        now = datetime.datetime.utcnow()
+        with session.get_bind().begin() as conn:
+            claimed = conn.execute(table.update().where(table.c.JobID == jobId).where(table.c.Status == QUEUED).values(
+                Status=RUNNING, Worker=WORKER_NAME, StartedAt=now, UpdatedAt=now
+            )).rowcount
+            if not claimed:
+                return
+            jobType, params = conn.execute(select([table.c.Type, table.c.Params]).where(table.c.JobID == jobId)).first()
+
+        def progress(fraction=None, message=None):
+            values = {'UpdatedAt': datetime.datetime.utcnow()}
+            if fraction is not None:
+                values['Progress'] = max(0.0, min(float(fraction), 1.0))
+            if message is not None:
+                values['Message'] = str(message)[:255]
+            self._update(jobId, **values)
+
+        try:
+            if jobType not in self.types:
+                raise UnknownJobType(f'Unknown job type: {jobType}')
+            result = self.types[jobType][0](progress, **(params or {}))
+        except Exception as e:
+            log.exception('job %s (%s) failed', jobId, jobType)
+            session.rollback()
+            self._update(jobId, Status=FAILED, Message=str(e)[:255], FinishedAt=datetime.datetime.utcnow())
+        else:
+            now = datetime.datetime.utcnow()
+            self._update(jobId, Status=SUCCEEDED, Progress=1, Result=result, UpdatedAt=now, FinishedAt=now)
+
+
+job_queue = JobQueue()
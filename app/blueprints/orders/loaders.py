@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+from marshmallow import fields
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import selectinload
+
+
+def _nested_schema(field):
+    """ returns the nested schema for a Nested or List(Nested) field, if any """
+    if isinstance(field, fields.List):
+        field = field.inner
+    if isinstance(field, fields.Nested):
+        return field.schema
+    return None
+
+
+def schema_loader_options(model, schema, parent=None):
+    """ builds eager loader options for every relationship a schema will dump
+
+    Each nested field that maps to a relationship on the model is loaded with
+    selectinload(), which issues one extra SELECT per relationship instead of one
+    per parent row.  Nested schemas are walked recursively so grandchildren
+    (e.g. Customer -> orders -> orderItems) are loaded the same way.
+
+    Args:
+        model (Base): the mapped class being queried
+        schema (Schema): the marshmallow schema that will dump the results
+        parent (Load, optional): the parent loader option when recursing
+
+    Returns:
+        list: loader options to pass to Query.options()
+    """
+    relationships = inspect(model).relationships
+    options = []
+    for name, field in schema.dump_fields.items():
+        nested = _nested_schema(field)
+        if nested is None:
+            continue
+        rel = relationships.get(field.attribute or name)
+        if rel is None:
+            continue
+        attr = getattr(model, rel.key)
+        loader = parent.selectinload(attr) if parent is not None else selectinload(attr)
+        options.append(loader)
+        options.extend(schema_loader_options(rel.mapper.class_, nested, loader))
+    return options
+
+
+def query_for_schema(session, model, schema):
+    """ creates a query for a model with the eager loading policy for a schema
+
+    Args:
+        session (Session): the database session
+        model (Base): the mapped class to query
+        schema (Schema): the marshmallow schema that will dump the results
+
+    Returns:
+        Query: the query
+    """
+    return session.query(model).options(*schema_loader_options(model, schema))
+
+
+@contextmanager
+def count_queries(engine):
+    """ context manager that records every SQL statement executed on an engine
+
+    Usage:
+        with count_queries(engine) as statements:
+            client.get('/orders')
+        print(len(statements))
+
+    Args:
+        engine (Engine): the engine to listen on
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def assert_query_count(engine, expected):
+    """ asserts that exactly the expected number of SQL statements run inside the block
+
+    Args:
+        engine (Engine): the engine to listen on
+        expected (int): the expected number of statements
+    """
+    with count_queries(engine) as statements:
+        yield statements
+    if len(statements) != expected:
+        raise AssertionError(
+            f'expected {expected} statements but {len(statements)} were executed:\n' + '\n'.join(statements)
+        )
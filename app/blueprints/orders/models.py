@@ -1,5 +1,5 @@
 # we can use a module called sqlalchemy to act as our ORM
-from sqlalchemy import Column, ForeignKey, Integer, String, Float, DateTime, event
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Float, DateTime, JSON, event, func, select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Sequence
@@ -14,11 +14,17 @@ TAX_RATE = 0.075
 # create classes and inherit from our declarative base context
 class Customer(Base):
     __tablename__ = 'Customer'
+    # ids of deleted rows are never handed out again, so an ETag can not match a newer row with the same id
+    __table_args__ = {'sqlite_autoincrement': True}
     # make sure we set our PK, setting autoincrement to True will ensure future records increment properly
     CustomerID = Column(Integer, primary_key=True, autoincrement=True)
-    FirstName = Column(String(50))
-    LastName = Column(String(50))
+    FirstName = Column(String(50), index=True)
+    LastName = Column(String(50), index=True)
     ShipToState = Column(String(2))
+    # row version, bumped by the ORM on every update and used for ETags and If-Match
+    Version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': Version}
     
     # reference OrderHeader relationship
     # also can set cascade to remove all child orders if this is deleted
@@ -28,15 +34,33 @@ class Customer(Base):
     def FullName(self):
         return f'{self.FirstName} {self.LastName}'
     
+# product catalog, cached in memory by catalog.ProductCatalog
+class Product(Base):
+    __tablename__ = 'Product'
+    __table_args__ = {'sqlite_autoincrement': True}
+    ProductID = Column(Integer, primary_key=True, autoincrement=True)
+    Name = Column(String(100), nullable=False, unique=True)
+    # list price, used for new items that do not send a UnitPrice
+    UnitPrice = Column(Float, nullable=False, default=0)
+    Version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': Version}
+
 class OrderItem(Base):
     __tablename__ = 'OrderItem'
+    __table_args__ = {'sqlite_autoincrement': True}
     OrderItemID = Column(Integer, Sequence('OrderItem_aid_seq', start=100, increment=1), primary_key=True)
     # reference foreign keys
-    OrderHeaderID = Column(Integer, ForeignKey('OrderHeader.OrderHeaderID'))
-    ProductName = Column(String(100))
+    OrderHeaderID = Column(Integer, ForeignKey('OrderHeader.OrderHeaderID'), index=True)
+    # the catalog product, ProductName is kept as the label the item was sold under
+    ProductID = Column(Integer, ForeignKey('Product.ProductID'), index=True)
+    ProductName = Column(String(100), index=True)
     Quantity = Column(Integer, default=1)
     UnitPrice = Column(Float, default=0)
     ItemTotal = Column(Float, default=0)
+    Version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': Version}
 
     @property
     def _itemTotal(self):
@@ -52,17 +76,23 @@ class OrderItem(Base):
 # OrderHeader ORM object
 class OrderHeader(Base):
     __tablename__ = 'OrderHeader'
+    # per customer order history, also serves lookups on CustomerID alone
+    __table_args__ = (Index('ix_OrderHeader_CustomerID_CreationDate', 'CustomerID', 'CreationDate'), {'sqlite_autoincrement': True})
     # set PK 
     OrderHeaderID = Column(Integer, primary_key=True, autoincrement=True)
     # create a foreign key reference to our Customer Table
     CustomerID = Column(Integer, ForeignKey('Customer.CustomerID'))
-    Product = Column(String(100))
-    # default creation date to UTC time at creation
-    CreationDate = Column(DateTime, default=datetime.datetime.utcnow())
+    Product = Column(String(100), index=True)
+    # default creation date to UTC time at creation, indexed for date range reports
+    CreationDate = Column(DateTime, default=datetime.datetime.utcnow, index=True)
     ItemTotal = Column(Float, default=0)
     TaxTotal = Column(Float, default=0)
     ShippingTotal = Column(Float, default=0)
     GrandTotal = Column(Float, default=0)
+    # also bumped by recalculate_order_totals(), so it changes whenever any of the order's items change
+    Version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': Version}
 
     @property
     def _orderItemsTotal(self):
@@ -118,6 +148,146 @@ class OrderHeader(Base):
     orderItems = relationship('OrderItem', back_populates='orderHeader', cascade='all, delete-orphan')
 
 
+# reporting summaries, one row per month (YYYY-MM) and state, maintained by reports.ReportSummaries
+class OrderSummary(Base):
+    __tablename__ = 'OrderSummary'
+    Period = Column(String(7), primary_key=True)
+    ShipToState = Column(String(2), primary_key=True)
+    Orders = Column(Integer, default=0)
+    ItemTotal = Column(Float, default=0)
+    TaxTotal = Column(Float, default=0)
+    ShippingTotal = Column(Float, default=0)
+    GrandTotal = Column(Float, default=0)
+
+class ProductSummary(Base):
+    __tablename__ = 'ProductSummary'
+    Period = Column(String(7), primary_key=True)
+    ShipToState = Column(String(2), primary_key=True)
+    ProductName = Column(String(100), primary_key=True)
+    Quantity = Column(Integer, default=0)
+    Revenue = Column(Float, default=0)
+
+# log of months whose summaries are stale, a Period of "*" means everything
+class SummaryChange(Base):
+    __tablename__ = 'SummaryChange'
+    SummaryChangeID = Column(Integer, primary_key=True, autoincrement=True)
+    Period = Column(String(7))
+
+# background jobs, see jobs.JobQueue
+class Job(Base):
+    __tablename__ = 'Job'
+    JobID = Column(Integer, primary_key=True, autoincrement=True)
+    Type = Column(String(50), nullable=False)
+    # queued -> running -> succeeded | failed
+    Status = Column(String(10), nullable=False, default='queued', index=True)
+    Params = Column(JSON)
+    Result = Column(JSON)
+    # 0 to 1, and a short description of the current step
+    Progress = Column(Float, default=0)
+    Message = Column(String(255))
+    # host:pid of the process running the job
+    Worker = Column(String(100))
+    CreatedAt = Column(DateTime, default=datetime.datetime.utcnow)
+    StartedAt = Column(DateTime)
+    # bumped by every progress report, running jobs that stop reporting are failed on the next startup
+    UpdatedAt = Column(DateTime)
+    FinishedAt = Column(DateTime)
+
+
+# append only log of customer, order and item changes, written by triggers, see changes.py
+class Change(Base):
+    __tablename__ = 'Change'
+    # ids are never reused, so ChangeID works as a cursor for consumers
+    __table_args__ = {'sqlite_autoincrement': True}
+    ChangeID = Column(Integer, primary_key=True, autoincrement=True)
+    # customer, order or item, "*" for a reset of the whole database
+    Entity = Column(String(10), nullable=False)
+    EntityID = Column(Integer)
+    # the CustomerID of an order or the OrderHeaderID of an item
+    ParentID = Column(Integer)
+    # create, update, delete, archive (moved to the archive tables) or reset
+    Action = Column(String(10), nullable=False)
+    CreatedAt = Column(DateTime, server_default=func.current_timestamp())
+
+
+# one row per recreate of the tables, the newest EpochID is part of every ETag, see conditional.py
+class Epoch(Base):
+    __tablename__ = 'Epoch'
+    __table_args__ = {'sqlite_autoincrement': True}
+    EpochID = Column(Integer, primary_key=True, autoincrement=True)
+    CreatedAt = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+# shard directory, kept in the primary database when the orders are sharded, see sharding.py
+class CustomerShard(Base):
+    __tablename__ = 'CustomerShard'
+    # hands out the CustomerIDs for every shard, so they are never reused
+    __table_args__ = {'sqlite_autoincrement': True}
+    CustomerID = Column(Integer, primary_key=True, autoincrement=True)
+    Shard = Column(Integer, nullable=False, index=True)
+
+# per shard id sequences for orders and items, an id is NextID * ID_STRIDE + the shard number
+class ShardSequence(Base):
+    __tablename__ = 'ShardSequence'
+    Name = Column(String(50), primary_key=True)
+    NextID = Column(Integer, nullable=False, default=1)
+
+
+# one row per year of archived orders, the orders are in OrderHeader_<year> and OrderItem_<year>, see archive.py
+class ArchivePartition(Base):
+    __tablename__ = 'ArchivePartition'
+    Year = Column(Integer, primary_key=True, autoincrement=False)
+    # the latest cutoff the year was archived with, reads of later dates skip the year
+    ArchivedBefore = Column(DateTime, nullable=False)
+    Orders = Column(Integer, nullable=False, default=0)
+    Items = Column(Integer, nullable=False, default=0)
+
+
+# SQL level recalculation of order totals, mirrors OrderHeader.updateOrder() without loading items
+def _order_totals_values(bumpVersion=True):
+    # correlated subquery that sums the items for the row being updated
+    itemTotal = select([func.coalesce(func.sum(OrderItem.UnitPrice * OrderItem.Quantity), 0)]).where(
+        OrderItem.OrderHeaderID == OrderHeader.OrderHeaderID
+    ).as_scalar()
+    shippingTotal = func.coalesce(OrderHeader.ShippingTotal, 0)
+    taxTotal = (itemTotal + shippingTotal) * TAX_RATE
+    values = {
+        OrderHeader.ItemTotal: itemTotal,
+        OrderHeader.TaxTotal: taxTotal,
+        OrderHeader.GrandTotal: itemTotal + shippingTotal + taxTotal
+    }
+    if bumpVersion:
+        values[OrderHeader.Version] = OrderHeader.Version + 1
+    return values
+
+def recalculate_order_totals(bind, orderIds=None, chunkSize=500, bumpVersion=True):
+    """ recalculates ItemTotal, TaxTotal and GrandTotal in the database with a single aggregate UPDATE
+
+    The Version of every recalculated order is bumped as well, since its items changed.
+    Run this after the ORM changes are flushed, a loaded OrderHeader is stale afterwards.
+
+    Args:
+        bind (Session|Connection): the session or connection to execute on
+        orderIds (list, optional): the order ids to recalculate, all orders are recalculated when None
+        chunkSize (int, optional): max number of ids per statement to stay under parameter limits
+        bumpVersion (bool, optional): False when the orders themselves were just updated through the ORM,
+            which already bumped their Version in the flush
+
+    Returns:
+        int: the number of orders updated
+    """
+    stmt = OrderHeader.__table__.update().values(_order_totals_values(bumpVersion))
+    if orderIds is None:
+        return bind.execute(stmt).rowcount
+
+    orderIds = list(orderIds)
+    updated = 0
+    for i in range(0, len(orderIds), chunkSize):
+        chunk = orderIds[i:i + chunkSize]
+        updated += bind.execute(stmt.where(OrderHeader.OrderHeaderID.in_(chunk))).rowcount
+    return updated
+
+
 # ORM level triggers, calculate ItemTotal before insert and update based on values
 @event.listens_for(OrderItem, 'before_insert')
 def update_item(mapper, connection, item):
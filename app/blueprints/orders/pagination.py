@@ -0,0 +1,113 @@
+from urllib.parse import urlencode
+from flask import Response, request, after_this_request, stream_with_context
+from flask_restx import inputs
+from .serializers import dumps
+
+# page size when no limit is requested, stream=true is the only way to read a whole collection at once
+DEFAULT_PAGE_SIZE = 100
+
+# upper bound for a single page, regardless of the requested limit
+MAX_PAGE_SIZE = 1000
+
+# the response headers of a page, see set_next_cursor(), documented in swagger with next_page_headers()
+NEXT_PAGE_HEADERS = {
+    'X-Next-Cursor': {'type': 'string', 'description': 'pass it back as "after" for the next page, only sent when there is one'},
+    'Link': {'type': 'string', 'description': 'the url of the next page (rel="next"), only sent when there is one'}
+}
+
+# number of rows fetched per round trip when streaming
+STREAM_BATCH_SIZE = 500
+
+
+def add_pagination_args(parser):
+    """ adds the keyset pagination and streaming args to a request parser
+
+    Args:
+        parser (RequestParser): the namespace parser for a collection endpoint
+    """
+    parser.add_argument('limit', type=int, help=f'max number of records to return (default {DEFAULT_PAGE_SIZE}, up to {MAX_PAGE_SIZE})')
+    parser.add_argument('after', type=int, help='cursor from a previous page (the X-Next-Cursor header), only records with a greater id are returned')
+    parser.add_argument('stream', type=inputs.boolean, help='stream all matching records as newline delimited json')
+    return parser
+
+
+def next_page_headers(ns):
+    """ documents the X-Next-Cursor and Link headers of a paginated endpoint in swagger
+
+    Usage:
+        @next_page_headers(orders_ns)
+        def get(self):
+
+    Args:
+        ns (Namespace): the namespace of the endpoint
+    """
+    return ns.response(200, 'Success', headers=NEXT_PAGE_HEADERS)
+
+
+def set_next_cursor(cursor, arg='after'):
+    """ adds the next page cursor to the outgoing response headers
+
+    Args:
+        cursor (int): the last primary key value of the current page
+        arg (str, optional): the query arg the cursor is passed back in
+    """
+    args = request.args.copy()
+    args[arg] = cursor
+    nextUrl = f'{request.base_url}?{urlencode(list(args.items(multi=True)))}'
+
+    @after_this_request
+    def add_cursor_headers(response):
+        response.headers['X-Next-Cursor'] = str(cursor)
+        response.headers['Link'] = f'<{nextUrl}>; rel="next"'
+        return response
+
+
+def keyset_paginate(query, key, limit=None, after=None):
+    """ applies keyset pagination on a primary key column to a query
+
+    The returned rows are ordered by the key.  When there are more rows than the
+    limit, the next cursor is sent back in the "X-Next-Cursor" and "Link" headers.
+
+    Args:
+        query (Query): the query to paginate
+        key (Column): the primary key column to page by
+        limit (int, optional): the max number of rows to return, DEFAULT_PAGE_SIZE when None
+        after (int, optional): only return rows with a key greater than this value
+
+    Returns:
+        list: the rows for this page
+    """
+    query = query.order_by(key)
+    if after is not None:
+        query = query.filter(key > after)
+    limit = max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+
+    # fetch one extra row to know if there is another page
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        set_next_cursor(getattr(rows[-1], key.key))
+    return rows
+
+
+def stream_ndjson(query, schema, batch_size=STREAM_BATCH_SIZE):
+    """ streams a query as newline delimited json, one record per line
+
+    Rows are fetched with Query.yield_per() so memory stays flat regardless of
+    the size of the result set.
+
+    Args:
+        query (Query|iterable): the query to stream, or rows that are already read in batches
+        schema (Schema): the marshmallow schema used to dump each row (many=False)
+        batch_size (int, optional): the number of rows to fetch per batch
+
+    Returns:
+        flask.Response: a streaming response
+    """
+    rows = query.yield_per(batch_size) if hasattr(query, 'yield_per') else query
+
+    def generate():
+        for row in rows:
+            yield dumps(schema.dump(row)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
@@ -0,0 +1,136 @@
+""" query plan regression check for the filtered endpoints
+
+Seeds a temporary SQLite database, requests every filtered endpoint through the
+flask test client, runs EXPLAIN QUERY PLAN on each SELECT that was executed and
+fails if any of them falls back to a full table SCAN.
+
+usage:
+    python -m app.blueprints.orders.queryplan [--customers 5000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from sqlalchemy import event
+from .catalog import product_catalog
+
+# endpoints whose queries must be served by an index
+PLAN_CHECKS = [
+    '/orders?Product=Ninja',
+    '/orders?CustomerID=7',
+    '/orders?CustomerID=7&limit=5&after=10',
+    '/orders?start=2019-01-01&end=2019-02-01',
+    '/orders/7',
+    '/items?Product=Ninja',
+    '/items?OrderHeaderID=7',
+    '/items/7',
+    '/customers?FirstName=Jen',
+    '/customers?LastName=Simpson',
+    '/customers/7',
+    '/customers/7/orders',
+    '/customers/7/orders?start=2015-01-01'
+]
+
+def seed_database(engine, customers=5000):
+    """ loads generated data and collects planner statistics """
+    from .bulk import load_sample_data
+    from .data.generator import generate_sample_data
+    load_sample_data(engine, generate_sample_data(customers, orders=5, items=3))
+    with engine.connect() as conn:
+        conn.execute('ANALYZE')
+
+
+@contextmanager
+def capture_statements(engine):
+    """ records (statement, parameters) for every statement executed on an engine """
+    captured = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield captured
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def explain(engine, statement, parameters):
+    """ returns the EXPLAIN QUERY PLAN detail lines for a statement """
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def is_scan(detail):
+    """ True for a full table (or full index) scan, e.g. "SCAN OrderHeader" or "SCAN TABLE OrderHeader" """
+    return detail.startswith('SCAN ') and not detail.startswith('SCAN CONSTANT ROW')
+
+
+def check_query_plans(app, engine, urls=PLAN_CHECKS):
+    """ requests each url and checks the plan of every SELECT it ran
+
+    Args:
+        app (Flask): the flask app
+        engine (Engine): the engine the app is bound to
+        urls (list, optional): the urls to check
+
+    Returns:
+        dict: url -> list of (statement, plan detail) for every scan found
+    """
+    failures = {}
+    client = app.test_client()
+
+    # run the before first request hooks outside of the checked requests
+    client.get('/orders/help')
+    # and fill the product catalog, it reads the whole (small) Product table once by design
+    product_catalog.load(engine)
+    for url in urls:
+        with capture_statements(engine) as captured:
+            response = client.get(url)
+        if response.status_code != 200:
+            failures[url] = [('', f'HTTP {response.status_code}')]
+            continue
+        for statement, parameters in captured:
+            if not statement.lstrip().upper().startswith('SELECT'):
+                continue
+            for detail in explain(engine, statement, parameters):
+                if is_scan(detail):
+                    failures.setdefault(url, []).append((statement, detail))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=5000, help='number of customers to seed')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from .database import session, bind_engine, create_engine_from_config
+    from .models import Base
+
+    app = create_app()
+    with tempfile.TemporaryDirectory() as tmp:
+        # rebind the session to a scratch database
+        engine = create_engine_from_config(app.config, f'sqlite:///{os.path.join(tmp, "queryplan.db")}')
+        bind_engine(engine, Base)
+        seed_database(engine, args.customers)
+
+        failures = check_query_plans(app, engine)
+        session.remove()
+        engine.dispose()
+
+    for url in PLAN_CHECKS:
+        print(f'{"FAIL" if url in failures else "ok  "} {url}')
+        for statement, detail in failures.get(url, []):
+            print(f'       {detail}\n       {" ".join(statement.split())}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
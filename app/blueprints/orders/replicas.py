@@ -0,0 +1,209 @@
+""" read replica routing for GET traffic, and a replication stand-in for local sqlite replicas
+
+With ORDERS_REPLICA_URLS set, GET and HEAD requests read from one of the
+replicas (picked round robin, one per request) and everything else uses the
+primary.  A request that flushes a change switches back to the primary.  After
+a successful write, the client gets a cookie that keeps its reads on the
+primary for ORDERS_REPLICA_STICKY_SECONDS, so it reads its own writes while the
+replicas catch up.
+
+Real deployments replicate with the database server.  For sqlite files,
+SQLiteReplicator copies the primary to every replica with the sqlite backup api
+whenever it has changed, which is enough to run and test the routing locally.
+"""
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from .database import RoutingSession, create_engine_from_config, primary_bind
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    # read replica database urls, can also be set as a comma separated ORDERS_REPLICA_URLS environment variable
+    'ORDERS_REPLICA_URLS': [url for url in os.environ.get('ORDERS_REPLICA_URLS', '').split(',') if url],
+    # how long a client reads from the primary after one of its writes
+    'ORDERS_REPLICA_STICKY_SECONDS': 5,
+    # when the primary and replicas are sqlite files, copy changes to the replicas this often (seconds, 0 disables)
+    'ORDERS_SQLITE_REPLICATION_INTERVAL': 1.0
+}
+
+# cookie holding the time until which the client reads from the primary
+STICKY_COOKIE = 'orders-read-primary-until'
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def read_from_primary():
+    """ sends the reads of the rest of the current request to the primary """
+    if has_request_context():
+        g.orders_read_primary = True
+
+
+def _sqlite_path(url):
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:':
+        return url.database
+    return None
+
+
+class SQLiteReplicator:
+    """ replication stand-in: copies a sqlite primary to replica files whenever it changes
+
+    Args:
+        primary (str): the primary database file
+        replicas (list): the replica database files
+        interval (float, optional): seconds between checks for changes in the background thread
+        on_sync (callable, optional): called after every copy, e.g. to clear caches built from the old data
+    """
+    def __init__(self, primary, replicas, interval=1.0, on_sync=None):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.interval = interval
+        self.onSync = on_sync
+        self.syncs = 0
+        self._version = None
+        self._monitor = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _data_version(self):
+        # data_version changes when any other connection commits to the database
+        if self._monitor is None:
+            self._monitor = sqlite3.connect(self.primary, check_same_thread=False)
+        return self._monitor.execute('PRAGMA data_version').fetchone()[0]
+
+    def sync(self, force=False):
+        """ copies the primary to every replica if it changed since the last copy
+
+        Returns:
+            bool: True if the replicas were updated
+        """
+        with self._lock:
+            version = self._data_version()
+            if not force and version == self._version:
+                return False
+            source = sqlite3.connect(self.primary)
+            try:
+                for path in self.replicas:
+                    target = sqlite3.connect(path, timeout=30)
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self._version = version
+            self.syncs += 1
+        if self.onSync is not None:
+            self.onSync()
+        return True
+
+    def start(self):
+        """ copies the primary once and then keeps the replicas up to date from a daemon thread """
+        self.sync(force=True)
+        if self.interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='orders-replicator', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync()
+            except sqlite3.Error:
+                log.exception('replicating %s failed', self.primary)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._monitor is not None:
+            self._monitor.close()
+            self._monitor = None
+
+
+class ReplicaRouter:
+    """ picks the engine for each session: a replica for reads in GET requests, otherwise the primary """
+    def __init__(self):
+        self.replicas = []
+        self.stickySeconds = DEFAULT_CONFIG['ORDERS_REPLICA_STICKY_SECONDS']
+        self.replicator = None
+        self._interval = DEFAULT_CONFIG['ORDERS_SQLITE_REPLICATION_INTERVAL']
+        self._onSync = None
+        self._next = itertools.count()
+        self._listening = False
+
+    def init_app(self, app, on_sync=None):
+        """ creates the replica engines from the app config and registers the request hooks
+
+        Args:
+            app (Flask): the flask app
+            on_sync (callable, optional): called after the sqlite replication stand-in copies new data
+        """
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        urls = app.config['ORDERS_REPLICA_URLS']
+        if isinstance(urls, str):
+            urls = [url for url in urls.split(',') if url]
+        self.stickySeconds = app.config['ORDERS_REPLICA_STICKY_SECONDS']
+        self._interval = app.config['ORDERS_SQLITE_REPLICATION_INTERVAL']
+        self._onSync = on_sync
+        self.replicas = [create_engine_from_config(app.config, url) for url in urls]
+        if not self.replicas:
+            return
+
+        RoutingSession.router = self
+        if not self._listening:
+            event.listen(RoutingSession, 'before_flush', self._before_flush)
+            self._listening = True
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def start_replication(self):
+        """ starts the sqlite replication stand-in when the primary and every replica are sqlite files """
+        if not self.replicas or not self._interval or self.replicator is not None:
+            return None
+        primary = _sqlite_path(primary_bind().url)
+        paths = [_sqlite_path(engine.url) for engine in self.replicas]
+        if primary is None or None in paths:
+            return None
+        self.replicator = SQLiteReplicator(primary, paths, self._interval, self._onSync)
+        self.replicator.start()
+        return self.replicator
+
+    def bind_for(self, session):
+        """ returns the replica for this session's reads, or None to use the primary """
+        if not self.replicas or not has_request_context() or request.method not in READ_METHODS:
+            return None
+        if session._flushing or session.info.get('orders_wrote') or g.get('orders_read_primary'):
+            return None
+        replica = session.info.get('orders_replica')
+        if replica is None:
+            replica = session.info['orders_replica'] = self.replicas[next(self._next) % len(self.replicas)]
+        return replica
+
+    def _before_flush(self, session, flush_context, instances):
+        # reads after a change in the same request must see it
+        session.info['orders_wrote'] = True
+
+    def _before_request(self):
+        try:
+            if float(request.cookies.get(STICKY_COOKIE, 0)) > time.time():
+                g.orders_read_primary = True
+        except ValueError:
+            pass
+
+    def _after_request(self, response):
+        if request.method not in READ_METHODS + ('OPTIONS',) and response.status_code < 400 and self.stickySeconds:
+            response.set_cookie(STICKY_COOKIE, f'{time.time() + self.stickySeconds:.3f}', max_age=self.stickySeconds, httponly=True)
+        return response
+
+
+replica_router = ReplicaRouter()
@@ -0,0 +1,396 @@
+import datetime
+from sqlalchemy import event, func, inspect, or_, select, union_all
+from .database import primary_bind
+from .models import Customer, OrderHeader, OrderItem, OrderSummary, ProductSummary, SummaryChange
+
+# marks every period as stale
+ALL_PERIODS = '*'
+
+DEFAULT_CONFIG = {
+    # maintain monthly summary tables and serve month aligned reports from them
+    'ORDERS_REPORT_SUMMARIES': False
+}
+
+
+def period_of(date):
+    """ returns the YYYY-MM period for a datetime """
+    return date.strftime('%Y-%m') if date else None
+
+
+def period_range(period):
+    """ returns the [start, end) datetimes covered by a YYYY-MM period """
+    start = datetime.datetime.strptime(period, '%Y-%m')
+    end = datetime.datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+
+def period_expr(column, dialect):
+    """ returns a sql expression that formats a datetime column as YYYY-MM for the given dialect name """
+    if dialect == 'sqlite':
+        return func.strftime('%Y-%m', column)
+    if dialect == 'mysql':
+        return func.date_format(column, '%Y-%m')
+    if dialect == 'mssql':
+        return func.format(column, 'yyyy-MM')
+    return func.to_char(column, 'YYYY-MM')
+
+
+def _dialect(bind):
+    if hasattr(bind, 'get_bind'):
+        bind = bind.get_bind()
+    return bind.dialect.name
+
+
+def _where(stmt, filters):
+    for condition in filters:
+        stmt = stmt.where(condition)
+    return stmt
+
+
+def _columnar(columns, rows):
+    """ transposes result rows into {"column": [values...]} """
+    data = {name: [] for name in columns}
+    for row in rows:
+        for name, value in zip(columns, row):
+            data[name].append(value)
+    return {'columns': list(columns), 'data': data, 'count': len(rows)}
+
+
+def _is_month_aligned(date):
+    return date is None or (date.day == 1 and date.time() == datetime.time())
+
+
+def _to_datetime(date):
+    if date is not None and not isinstance(date, datetime.datetime):
+        return datetime.datetime.combine(date, datetime.time())
+    return date
+
+
+#***********************************************************************************************************##
+#  LIVE QUERIES                                                                                             ##
+#***********************************************************************************************************##
+# the columns the reports read, the archive tables have them too
+ORDER_REPORT_COLUMNS = ['OrderHeaderID', 'CustomerID', 'CreationDate', 'ItemTotal', 'TaxTotal', 'ShippingTotal', 'GrandTotal']
+ITEM_REPORT_COLUMNS = ['OrderHeaderID', 'ProductName', 'Quantity', 'ItemTotal']
+
+
+def _no_archive(bind, start=None, end=None):
+    return []
+
+
+def report_tables(bind, start=None, end=None):
+    """ returns the (orders, items) the reports read
+
+    These are the OrderHeader and OrderItem tables, unioned with the archive
+    tables of the years archived in [start, end) when there are any (see
+    archive.py), so moving orders to the archive does not change a report.
+
+    Args:
+        bind (Session|Connection): the database
+        start (datetime, optional): the first creation date the report covers
+        end (datetime, optional): the creation date the report ends before
+    """
+    archived = report_summaries.archived(bind, start, end)
+    if not archived:
+        return OrderHeader.__table__, OrderItem.__table__
+    tables = [(OrderHeader.__table__, OrderItem.__table__)] + list(archived)
+    orders = union_all(*[select([orderTable.c[name] for name in ORDER_REPORT_COLUMNS]) for orderTable, _ in tables])
+    items = union_all(*[select([itemTable.c[name] for name in ITEM_REPORT_COLUMNS]) for _, itemTable in tables])
+    return orders.alias('orders'), items.alias('items')
+
+
+def _order_filters(orders, start=None, end=None, state=None):
+    filters = []
+    if start is not None:
+        filters.append(orders.c.CreationDate >= start)
+    if end is not None:
+        filters.append(orders.c.CreationDate < end)
+    if state:
+        filters.append(Customer.ShipToState == state)
+    return filters
+
+
+def _orders_from(orders):
+    return orders.outerjoin(Customer.__table__, orders.c.CustomerID == Customer.CustomerID)
+
+
+def _items_from(orders, items):
+    return items.join(
+        orders, items.c.OrderHeaderID == orders.c.OrderHeaderID
+    ).outerjoin(Customer.__table__, orders.c.CustomerID == Customer.CustomerID)
+
+
+def _order_totals(orders):
+    return [
+        func.count(orders.c.OrderHeaderID),
+        func.coalesce(func.sum(orders.c.ItemTotal), 0),
+        func.coalesce(func.sum(orders.c.TaxTotal), 0),
+        func.coalesce(func.sum(orders.c.ShippingTotal), 0),
+        func.coalesce(func.sum(orders.c.GrandTotal), 0)
+    ]
+
+
+def _product_totals(items):
+    return [
+        func.coalesce(func.sum(items.c.Quantity), 0),
+        func.coalesce(func.sum(items.c.ItemTotal), 0)
+    ]
+
+
+ORDER_COLUMNS = ['Orders', 'ItemTotal', 'TaxTotal', 'ShippingTotal', 'GrandTotal']
+PRODUCT_COLUMNS = ['ProductName', 'Quantity', 'Revenue']
+
+
+def sales_by_product(bind, start=None, end=None, state=None):
+    """ revenue and quantity per product name, computed from the order items """
+    orders, items = report_tables(bind, start, end)
+    stmt = _where(
+        select([items.c.ProductName] + _product_totals(items)).select_from(_items_from(orders, items)),
+        _order_filters(orders, start, end, state)
+    ).group_by(items.c.ProductName).order_by(items.c.ProductName)
+    return _columnar(PRODUCT_COLUMNS, bind.execute(stmt).fetchall())
+
+
+def sales_by_state(bind, start=None, end=None, state=None):
+    """ order totals per customer ship to state """
+    orders, _ = report_tables(bind, start, end)
+    shipToState = func.coalesce(Customer.ShipToState, '')
+    stmt = _where(
+        select([shipToState] + _order_totals(orders)).select_from(_orders_from(orders)),
+        _order_filters(orders, start, end, state)
+    ).group_by(shipToState).order_by(shipToState)
+    return _columnar(['ShipToState'] + ORDER_COLUMNS, bind.execute(stmt).fetchall())
+
+
+def sales_by_period(bind, start=None, end=None, state=None):
+    """ order totals per month (YYYY-MM) of the order creation date """
+    orders, _ = report_tables(bind, start, end)
+    period = period_expr(orders.c.CreationDate, _dialect(bind))
+    stmt = _where(
+        select([period] + _order_totals(orders)).select_from(_orders_from(orders)),
+        _order_filters(orders, start, end, state)
+    ).group_by(period).order_by(period)
+    return _columnar(['Period'] + ORDER_COLUMNS, bind.execute(stmt).fetchall())
+
+
+#***********************************************************************************************************##
+#  SUMMARY TABLES                                                                                           ##
+#***********************************************************************************************************##
+def _summary_filters(table, start=None, end=None, state=None):
+    filters = []
+    if start is not None:
+        filters.append(table.Period >= period_of(start))
+    if end is not None:
+        filters.append(table.Period < period_of(end))
+    if state:
+        filters.append(table.ShipToState == state)
+    return filters
+
+
+def summary_sales_by_product(bind, start=None, end=None, state=None):
+    stmt = _where(select([
+        ProductSummary.ProductName, func.sum(ProductSummary.Quantity), func.sum(ProductSummary.Revenue)
+    ]), _summary_filters(ProductSummary, start, end, state)).group_by(
+        ProductSummary.ProductName
+    ).order_by(ProductSummary.ProductName)
+    rows = [(name or None, quantity, revenue) for name, quantity, revenue in bind.execute(stmt)]
+    return _columnar(PRODUCT_COLUMNS, rows)
+
+
+def _summary_order_totals():
+    return [
+        func.sum(OrderSummary.Orders),
+        func.sum(OrderSummary.ItemTotal),
+        func.sum(OrderSummary.TaxTotal),
+        func.sum(OrderSummary.ShippingTotal),
+        func.sum(OrderSummary.GrandTotal)
+    ]
+
+
+def summary_sales_by_state(bind, start=None, end=None, state=None):
+    stmt = _where(
+        select([OrderSummary.ShipToState] + _summary_order_totals()),
+        _summary_filters(OrderSummary, start, end, state)
+    ).group_by(OrderSummary.ShipToState).order_by(OrderSummary.ShipToState)
+    return _columnar(['ShipToState'] + ORDER_COLUMNS, bind.execute(stmt).fetchall())
+
+
+def summary_sales_by_period(bind, start=None, end=None, state=None):
+    stmt = _where(
+        select([OrderSummary.Period] + _summary_order_totals()),
+        _summary_filters(OrderSummary, start, end, state)
+    ).group_by(OrderSummary.Period).order_by(OrderSummary.Period)
+    return _columnar(['Period'] + ORDER_COLUMNS, bind.execute(stmt).fetchall())
+
+
+class ReportSummaries:
+    """ incrementally maintained monthly summaries of the order and item totals
+
+    ORM events on OrderHeader and OrderItem (the same ones that keep the order
+    totals up to date) log the month of every changed order to SummaryChange in
+    the same transaction, and so do the bulk writes and the archive.  Before a
+    summary is read, only the logged months are recomputed from the base and
+    archive tables.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        # returns the (orders, items) archive tables of a date range, see archive.OrderArchive.report_tables()
+        self.archived = _no_archive
+        # changes are not logged while disabled, so rebuild everything on first use in each process
+        self._rebuild = True
+
+    def init_app(self, app, archived=None):
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.enabled = app.config['ORDERS_REPORT_SUMMARIES']
+        if archived is not None:
+            self.archived = archived
+
+    def mark(self, bind, dates):
+        """ logs the months of the given datetimes as stale
+
+        Args:
+            bind (Connection|Session): executes the insert, use the flush connection to stay in the same transaction
+            dates (iterable): datetimes, or ALL_PERIODS to mark everything
+        """
+        if not self.enabled:
+            return
+        periods = {ALL_PERIODS if d == ALL_PERIODS else period_of(d) for d in dates if d is not None}
+        if periods:
+            bind.execute(SummaryChange.__table__.insert(), [{'Period': p} for p in periods])
+
+    def _insert_summaries(self, conn, dialect, orders, items, filters):
+        period = period_expr(orders.c.CreationDate, dialect)
+        shipToState = func.coalesce(Customer.ShipToState, '')
+        conn.execute(OrderSummary.__table__.insert().from_select(
+            ['Period', 'ShipToState'] + ORDER_COLUMNS,
+            _where(select([period, shipToState] + _order_totals(orders)).select_from(_orders_from(orders)), filters).group_by(
+                period, shipToState
+            )
+        ))
+        productName = func.coalesce(items.c.ProductName, '')
+        conn.execute(ProductSummary.__table__.insert().from_select(
+            ['Period', 'ShipToState', 'ProductName', 'Quantity', 'Revenue'],
+            _where(select([period, shipToState, productName] + _product_totals(items)).select_from(_items_from(orders, items)), filters).group_by(
+                period, shipToState, productName
+            )
+        ))
+
+    def refresh(self, engine, chunkSize=50):
+        """ recomputes the summaries for every month logged as stale
+
+        Args:
+            engine (Engine): the database engine
+            chunkSize (int, optional): the number of months recomputed per statement
+        """
+        dialect = engine.dialect.name
+        with engine.begin() as conn:
+            lastChange = conn.execute(select([func.max(SummaryChange.SummaryChangeID)])).scalar()
+            periods = set()
+            if lastChange is not None:
+                periods = {row[0] for row in conn.execute(
+                    select([SummaryChange.Period]).where(SummaryChange.SummaryChangeID <= lastChange).distinct()
+                )}
+
+            orders, items = report_tables(conn)
+            if self._rebuild or ALL_PERIODS in periods:
+                conn.execute(OrderSummary.__table__.delete())
+                conn.execute(ProductSummary.__table__.delete())
+                self._insert_summaries(conn, dialect, orders, items, [orders.c.CreationDate.isnot(None)])
+            else:
+                periods = sorted(periods)
+                for i in range(0, len(periods), chunkSize):
+                    chunk = periods[i:i + chunkSize]
+                    conn.execute(OrderSummary.__table__.delete().where(OrderSummary.Period.in_(chunk)))
+                    conn.execute(ProductSummary.__table__.delete().where(ProductSummary.Period.in_(chunk)))
+                    ranges = [period_range(p) for p in chunk]
+                    self._insert_summaries(conn, dialect, orders, items, [or_(*[
+                        (orders.c.CreationDate >= start) & (orders.c.CreationDate < end) for start, end in ranges
+                    ])])
+
+            if lastChange is not None:
+                conn.execute(SummaryChange.__table__.delete().where(SummaryChange.SummaryChangeID <= lastChange))
+        self._rebuild = False
+
+
+# shared summaries for the orders api
+report_summaries = ReportSummaries()
+
+REPORTS = {
+    'sales-by-product': (sales_by_product, summary_sales_by_product),
+    'sales-by-state': (sales_by_state, summary_sales_by_state),
+    'sales-by-period': (sales_by_period, summary_sales_by_period)
+}
+
+
+def run_report(session, name, start=None, end=None, state=None, source=None):
+    """ runs a report from the live tables or from the summary tables
+
+    Summaries only have monthly resolution, so they are used when enabled and the
+    date range starts and ends on the first of a month, unless a source is forced.
+
+    Args:
+        session (Session): the database session
+        name (str): one of the keys in REPORTS
+        start (datetime, optional): include orders created on or after this date
+        end (datetime, optional): include orders created before this date
+        state (str, optional): only include customers shipping to this state
+        source (str, optional): "live" or "summary", picked automatically when None
+
+    Returns:
+        dict: the columnar report
+    """
+    live, summary = REPORTS[name]
+    start, end = _to_datetime(start), _to_datetime(end)
+    if source is None:
+        source = 'summary' if report_summaries.enabled and _is_month_aligned(start) and _is_month_aligned(end) else 'live'
+
+    if source == 'summary':
+        # the summaries are refreshed on demand, so read them where they are written
+        primary = primary_bind()
+        report_summaries.refresh(primary)
+        report = summary(primary, start, end, state)
+    else:
+        report = live(session, start, end, state)
+    report['source'] = source
+    return report
+
+
+#***********************************************************************************************************##
+#  CHANGE TRACKING                                                                                          ##
+#***********************************************************************************************************##
+def _history_dates(target):
+    """ returns the current and previous CreationDate of an order """
+    history = inspect(target).attrs.CreationDate.history
+    return [target.CreationDate] + list(history.deleted or [])
+
+
+@event.listens_for(OrderHeader, 'after_insert')
+@event.listens_for(OrderHeader, 'after_update')
+@event.listens_for(OrderHeader, 'after_delete')
+def mark_order_period(mapper, connection, order):
+    report_summaries.mark(connection, _history_dates(order))
+
+
+@event.listens_for(OrderItem, 'after_insert')
+@event.listens_for(OrderItem, 'after_update')
+@event.listens_for(OrderItem, 'after_delete')
+def mark_item_period(mapper, connection, item):
+    if not report_summaries.enabled or item.OrderHeaderID is None:
+        return
+    order = item.__dict__.get('orderHeader')
+    if order is not None:
+        creationDate = order.CreationDate
+    else:
+        creationDate = connection.execute(
+            select([OrderHeader.CreationDate]).where(OrderHeader.OrderHeaderID == item.OrderHeaderID)
+        ).scalar()
+    report_summaries.mark(connection, [creationDate])
+
+
+@event.listens_for(Customer, 'after_update')
+def mark_customer_state(mapper, connection, customer):
+    # a new state moves all of the customer's orders between summary rows
+    if inspect(customer).attrs.ShipToState.history.has_changes():
+        report_summaries.mark(connection, [ALL_PERIODS])
@@ -1,4 +1,4 @@
-from marshmallow import Schema, EXCLUDE, fields, post_load
+from marshmallow import Schema, EXCLUDE, fields, post_load, validate
 import datetime
 from .models import *
 
@@ -13,9 +13,10 @@ class OrderItemSchema(Schema):
         unknown = EXCLUDE
 
     OrderHeaderID = fields.Integer(description='order id', dump_only=True)
+    ProductID = fields.Integer(description='the catalog product, filled in from the ProductName when omitted')
     ProductName = fields.String(description='the product name')
     Quantity = fields.Integer(description='the item quantity', missing=1)
-    UnitPrice = fields.Float(description='the price for the item', missing=0)
+    UnitPrice = fields.Float(description='the price for the item, defaults to the catalog list price')
     ItemTotal = fields.Float(description='the total base cost (unit cost * quantity)', missing=0, dump_only=True)
 
     @post_load
@@ -61,11 +62,11 @@ class CustomerSchema(Schema):
     FullName = fields.String(description='customer full name', dump_only=True)
     ShipToState = fields.String(description='state for shipping')
 
-    Orders = fields.List(fields.Nested(OrderHeaderSchema), many=True, missing=[])
+    Orders = fields.List(fields.Nested(OrderHeaderSchema), attribute='orders', many=True, missing=[])
 
     @post_load
     def make_object(self, data, **kwargs):
-        customer = Customer(**{k: data.get(k) for k in data.keys() if k != 'Orders'})
+        customer = Customer(**{k: data.get(k) for k in data.keys() if k != 'orders'})
 
         return customer
 
@@ -80,4 +81,96 @@ class UpdateResourceSchema(BaseResourceMutationSchema):
     message = fields.String(description='the update message', default="Successfully Updated Resource")
 
 class DeleteResourceSchema(BaseResourceMutationSchema):
-    message = fields.String(description='the delete message', default="Successfully Deleted Resource")
\ No newline at end of file
+    message = fields.String(description='the delete message', default="Successfully Deleted Resource")
+
+class BulkImportResultSchema(Schema):
+    status = fields.String(description='the operation status (success|error)', default="success")
+    message = fields.String(description='the import message', default="Successfully Imported Orders")
+    created = fields.Integer(description='the number of orders created')
+    failed = fields.Integer(description='the number of rows that were rejected')
+    errors = fields.List(fields.Dict(), description='validation or write errors keyed by the zero based row index')
+
+
+class ItemBatchResultSchema(BaseResourceMutationSchema):
+    message = fields.String(description='the batch message', default="Successfully Updated Order Items")
+    created = fields.List(fields.Integer(), description='ids of the items that were added')
+    updated = fields.List(fields.Integer(), description='ids of the items that were updated')
+    deleted = fields.List(fields.Integer(), description='ids of the items that were removed')
+    ItemTotal = fields.Float(description='the new total base cost for the order')
+    TaxTotal = fields.Float(description='the new tax total for the order')
+    ShippingTotal = fields.Float(description='the shipping total')
+    GrandTotal = fields.Float(description='the new grand total for the order')
+
+
+class CacheStatsSchema(Schema):
+    hits = fields.Integer(description='number of responses served from the cache')
+    misses = fields.Integer(description='number of responses that had to be built')
+    invalidations = fields.Integer(description='number of cached responses removed by writes')
+    hitRatio = fields.Float(description='hits / (hits + misses)')
+
+
+class ReportSchema(Schema):
+    columns = fields.List(fields.String(), description='the report column names')
+    data = fields.Dict(description='the values for each column, keyed by column name')
+    count = fields.Integer(description='the number of rows')
+    source = fields.String(description='where the report was computed from (live|summary)')
+
+
+class SearchResultSchema(Schema):
+    kind = fields.String(description='what matched (customer|order|item)')
+    id = fields.Integer(description='the CustomerID, OrderHeaderID or OrderItemID of the match')
+    text = fields.String(description='the indexed name')
+    score = fields.Float(description='relevance, higher is a better match')
+
+
+class JobSchema(Schema):
+    JobID = fields.Integer(description='the job id')
+    Type = fields.String(description='the job type')
+    Status = fields.String(description='queued, running, succeeded or failed')
+    Progress = fields.Float(description='how far along the job is, from 0 to 1')
+    Message = fields.String(description='the current step, or the error for a failed job')
+    Params = fields.Dict(description='the params the job was submitted with')
+    Result = fields.Raw(description='what the job returned once it succeeded')
+    CreatedAt = SerializableDateTime()
+    StartedAt = SerializableDateTime()
+    FinishedAt = SerializableDateTime()
+
+
+class ChangeSchema(Schema):
+    ChangeID = fields.Integer(description='the change id, pass the last one seen as the since cursor')
+    Entity = fields.String(description='customer, order or item, "*" for a reset of the whole database')
+    EntityID = fields.Integer(description='the CustomerID, OrderHeaderID or OrderItemID that changed')
+    ParentID = fields.Integer(description='the CustomerID of an order or the OrderHeaderID of an item')
+    Action = fields.String(description='create, update, delete, archive or reset')
+    CreatedAt = SerializableDateTime()
+
+
+class SubmitJobSchema(Schema):
+    type = fields.String(required=True, description='the job type, e.g. create-sample-data')
+    params = fields.Dict(missing=dict, description='the job params')
+
+
+class SampleDataJobSchema(Schema):
+    customers = fields.Integer(validate=validate.Range(min=1), description='generate this many customers instead of loading the sample data')
+    orders = fields.Integer(missing=10, validate=validate.Range(min=0), description='orders per generated customer')
+    items = fields.Integer(missing=3, validate=validate.Range(min=0), description='items per generated order')
+    seed = fields.Integer(missing=0, description='random seed for the generated data')
+
+
+class ArchiveJobSchema(Schema):
+    before = fields.String(validate=validate.Regexp(r'^\d{4}-\d{2}-\d{2}$'), description='archive the orders created before this date (YYYY-MM-DD)')
+    days = fields.Integer(validate=validate.Range(min=0), description='archive the orders older than this many days, when before is not given')
+    batchSize = fields.Integer(validate=validate.Range(min=1), description='orders moved per transaction')
+
+
+class ProductSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    ProductID = fields.Integer(description='the product id', dump_only=True)
+    Name = fields.String(description='the product name', required=True)
+    UnitPrice = fields.Float(description='the list price, used for new items sent without a UnitPrice', missing=0)
+
+    @post_load
+    def make_object(self, data, **kwargs):
+        return Product(**data)
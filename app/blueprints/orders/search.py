@@ -0,0 +1,226 @@
+""" ranked prefix search over product and customer names
+
+On sqlite the names are indexed in a FTS5 virtual table, SearchIndex, that is
+kept in sync by triggers on the Customer, OrderHeader and OrderItem tables, so
+rows written by the ORM, the bulk loaders and plain SQL are all covered.  Each
+row's rowid encodes the source row (id * 3 + kind), which keeps the triggers to
+single rowid lookups.  Every word of a query is matched as a prefix and the
+results are ranked with bm25.  Other databases, or sqlite builds without FTS5,
+fall back to a LIKE search on word prefixes.
+"""
+import re
+from sqlalchemy import event, func, literal, or_, select, text, union_all
+from .models import Customer, OrderHeader, OrderItem
+
+SEARCH_TABLE = 'SearchIndex'
+
+# kind -> (code stored in the rowid, model, primary key, indexed columns)
+SOURCES = {
+    'customer': (0, Customer, 'CustomerID', ('FirstName', 'LastName')),
+    'order': (1, OrderHeader, 'OrderHeaderID', ('Product',)),
+    'item': (2, OrderItem, 'OrderItemID', ('ProductName',))
+}
+KINDS = sorted(SOURCES, key=lambda kind: SOURCES[kind][0])
+
+# default number of results per page
+SEARCH_PAGE_SIZE = 25
+
+
+def query_terms(q):
+    """ splits a search string into words, e.g. "jen sim" -> ['jen', 'sim'] """
+    return re.findall(r'\w+', q or '')
+
+
+def fts_query(terms):
+    """ builds the FTS5 MATCH expression that requires every term as a word prefix """
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _text_sql(kind, row):
+    """ the sql expression for the indexed text of a row, row is "new", "old" or the table name """
+    columns = SOURCES[kind][3]
+    return " || ' ' || ".join(f"coalesce({row}.{column}, '')" for column in columns)
+
+
+def _text_expr(kind):
+    """ the indexed text of a row as a sqlalchemy expression """
+    model, columns = SOURCES[kind][1], SOURCES[kind][3]
+    expr = func.coalesce(getattr(model, columns[0]), '')
+    for column in columns[1:]:
+        expr = expr + ' ' + func.coalesce(getattr(model, column), '')
+    return expr
+
+
+def _rowid_sql(kind, row):
+    code, _, pk, _ = SOURCES[kind]
+    return f'{row}.{pk} * {len(SOURCES)} + {code}'
+
+
+#***********************************************************************************************************##
+#  INDEX MAINTENANCE                                                                                        ##
+#***********************************************************************************************************##
+def fts5_available(conn):
+    """ returns True when the connection is sqlite with the FTS5 extension compiled in """
+    if conn.dialect.name != 'sqlite':
+        return False
+    available = conn.info.get('orders_fts5')
+    if available is None:
+        options = {row[0] for row in conn.execute('PRAGMA compile_options')}
+        available = conn.info['orders_fts5'] = 'ENABLE_FTS5' in options
+    return available
+
+
+def _has_search_table(conn):
+    return conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), name=SEARCH_TABLE).scalar() is not None
+
+
+def _trigger_statements(kind):
+    table = SOURCES[kind][1].__tablename__
+    columns = ', '.join(SOURCES[kind][3])
+    prefix = f'{SEARCH_TABLE}_{table}'
+    return [
+        f'CREATE TRIGGER IF NOT EXISTS {prefix}_insert AFTER INSERT ON {table} BEGIN '
+        f'INSERT INTO {SEARCH_TABLE} (rowid, text) VALUES ({_rowid_sql(kind, "new")}, {_text_sql(kind, "new")}); END',
+        f'CREATE TRIGGER IF NOT EXISTS {prefix}_update AFTER UPDATE OF {columns} ON {table} BEGIN '
+        f'UPDATE {SEARCH_TABLE} SET text = {_text_sql(kind, "new")} WHERE rowid = {_rowid_sql(kind, "old")}; END',
+        f'CREATE TRIGGER IF NOT EXISTS {prefix}_delete AFTER DELETE ON {table} BEGIN '
+        f'DELETE FROM {SEARCH_TABLE} WHERE rowid = {_rowid_sql(kind, "old")}; END'
+    ]
+
+
+def _create_search_table(conn):
+    conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(text, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+
+
+def _index_source(conn, kind):
+    """ creates the triggers for one source table and indexes the rows it already has """
+    for statement in _trigger_statements(kind):
+        conn.execute(statement)
+    table = SOURCES[kind][1].__tablename__
+    conn.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid % {len(SOURCES)} = {SOURCES[kind][0]}')
+    conn.execute(f'INSERT INTO {SEARCH_TABLE} (rowid, text) SELECT {_rowid_sql(kind, table)}, {_text_sql(kind, table)} FROM {table}')
+
+
+def create_search_index(engine, rebuild=False):
+    """ creates and fills the search index and its triggers when they do not exist yet
+
+    Args:
+        engine (Engine): the engine
+        rebuild (bool, optional): reindex every row even if the index already exists
+
+    Returns:
+        bool: True if the FTS5 index is used, False if searches fall back to LIKE
+    """
+    with engine.begin() as conn:
+        if not fts5_available(conn):
+            return False
+        if rebuild or not _has_search_table(conn):
+            _create_search_table(conn)
+            for kind in KINDS:
+                _index_source(conn, kind)
+        else:
+            # tables recreated by drop_all()/create_all() lose their triggers
+            for kind in KINDS:
+                for statement in _trigger_statements(kind):
+                    conn.execute(statement)
+    return True
+
+
+def _after_create(kind):
+    def listener(target, connection, **kw):
+        if fts5_available(connection):
+            _create_search_table(connection)
+            _index_source(connection, kind)
+    return listener
+
+
+def _before_drop(kind):
+    def listener(target, connection, **kw):
+        if fts5_available(connection) and _has_search_table(connection):
+            connection.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid % {len(SOURCES)} = {SOURCES[kind][0]}')
+    return listener
+
+
+def _register_table_events():
+    """ keeps the index in step with tables created and dropped through the metadata (new databases, create_sample_data) """
+    for kind, source in SOURCES.items():
+        event.listen(source[1].__table__, 'after_create', _after_create(kind))
+        event.listen(source[1].__table__, 'before_drop', _before_drop(kind))
+
+
+_register_table_events()
+
+
+#***********************************************************************************************************##
+#  QUERIES                                                                                                  ##
+#***********************************************************************************************************##
+def fts_search(conn, terms, kind=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """ ranked search on the FTS5 index
+
+    Returns:
+        list: dicts with kind, id, text and score (higher is a better match)
+    """
+    sql = f'SELECT rowid, text, bm25({SEARCH_TABLE}) AS score FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :query'
+    params = {'query': fts_query(terms), 'limit': limit, 'offset': offset}
+    if kind:
+        sql += f' AND rowid % {len(SOURCES)} = :code'
+        params['code'] = SOURCES[kind][0]
+    sql += ' ORDER BY score, rowid LIMIT :limit OFFSET :offset'
+    return [
+        {'kind': KINDS[rowid % len(SOURCES)], 'id': rowid // len(SOURCES), 'text': value, 'score': -score}
+        for rowid, value, score in conn.execute(text(sql), params)
+    ]
+
+
+def like_search(conn, terms, kind=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """ the same word prefix search with LIKE, for databases without FTS5 (every row is scanned)
+
+    Returns:
+        list: dicts with kind, id, text and score (always 0), ordered by kind and id
+    """
+    selects = []
+    for name in KINDS:
+        if kind and name != kind:
+            continue
+        code, model, pk, _ = SOURCES[name]
+        value = _text_expr(name)
+        stmt = select([literal(code).label('code'), getattr(model, pk).label('id'), value.label('text')])
+        for term in terms:
+            stmt = stmt.where(or_(value.ilike(f'{term}%'), value.ilike(f'% {term}%')))
+        selects.append(stmt)
+
+    stmt = union_all(*selects).order_by('code', 'id').limit(limit).offset(offset)
+    return [{'kind': KINDS[code], 'id': id, 'text': value, 'score': 0.0} for code, id, value in conn.execute(stmt)]
+
+
+def _use_fts(conn):
+    # cached per pooled connection once the index exists, it is never dropped while the app runs
+    if conn.info.get('orders_search_table'):
+        return True
+    found = fts5_available(conn) and _has_search_table(conn)
+    if found:
+        conn.info['orders_search_table'] = True
+    return found
+
+
+def search(conn, q, kind=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """ searches product and customer names, matching every word of the query as a word prefix
+
+    Args:
+        conn (Connection|Session): the connection or session to query with
+        q (str): the search text, e.g. "nin" or "jen sim"
+        kind (str, optional): only return "customer", "order" or "item" results
+        limit (int, optional): the max number of results
+        offset (int, optional): the number of results to skip
+
+    Returns:
+        list: dicts with kind, id, text and score, best matches first
+    """
+    terms = query_terms(q)
+    if not terms:
+        return []
+    if hasattr(conn, 'get_bind'):
+        conn = conn.connection()
+    if _use_fts(conn):
+        return fts_search(conn, terms, kind, limit, offset)
+    return like_search(conn, terms, kind, limit, offset)
@@ -0,0 +1,135 @@
+from collections.abc import Mapping
+from flask import current_app, make_response
+from marshmallow import fields, missing
+from flask_restx.representations import dumps as restx_dumps
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = ['compile_dump', 'compiled', 'dumps', 'output_json']
+
+
+def dumps(data, **settings):
+    """ encodes json with orjson when it is installed, otherwise with the flask-restx encoder (ujson or json)
+
+    Every response body goes through this (see output_json()), so bodies built
+    by hand for the cache, streams and the async app match the flask-restx ones.
+    Custom settings (e.g. indent) and values orjson cannot encode use the fallback.
+    """
+    if orjson is not None and not settings:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            pass
+    return restx_dumps(data, **settings)
+
+
+def output_json(data, code, headers=None):
+    """ the flask-restx json representation, encoded with dumps() """
+    settings = dict(current_app.config.get('RESTX_JSON', {}))
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+    response = make_response(dumps(data, **settings) + '\n', code)
+    response.headers.extend(headers or {})
+    return response
+
+
+def _getter(attr):
+    """ returns a function that reads a dotted attribute like Schema.get_attribute(), or None for a plain name """
+    if '.' in attr:
+        from marshmallow.utils import get_value
+        return lambda obj: get_value(obj, attr, missing)
+    return None
+
+
+def _formatter(field):
+    """ returns a function that formats a value exactly like field._serialize(), or None to fall back to the field """
+    if isinstance(field, fields.Number) and not field.as_string and type(field) in (fields.Integer, fields.Float):
+        numType = field.num_type
+        return lambda value: None if value is None else numType(value)
+    if type(field) is fields.String:
+        return lambda value: None if value is None else str(value)
+    if isinstance(field, fields.DateTime) and (field.format or field.DEFAULT_FORMAT) == 'iso' and type(field)._serialize is fields.DateTime._serialize:
+        return lambda value: None if value is None else value.isoformat()
+    if isinstance(field, fields.List) and type(field)._serialize is fields.List._serialize:
+        inner = field.inner
+        if isinstance(inner, fields.Nested) and type(inner)._serialize is fields.Nested._serialize and not (inner.many or inner.schema.many):
+            dumpNested = compile_dump(inner.schema)
+            return lambda value: None if value is None else [dumpNested(each) for each in value]
+        formatInner = _formatter(inner)
+        if formatInner is not None:
+            return lambda value: None if value is None else [formatInner(each) for each in value]
+    if isinstance(field, fields.Nested) and type(field)._serialize is fields.Nested._serialize and not (field.many or field.schema.many):
+        dumpNested = compile_dump(field.schema)
+        return lambda value: None if value is None else dumpNested(value)
+    return None
+
+
+def compile_dump(schema):
+    """ precomputes a dump function for a schema instance, its output is identical to schema.dump(obj)
+
+    Args:
+        schema (Schema): the marshmallow schema instance (its only/exclude are honored)
+
+    Returns:
+        callable: a function that dumps a single object to a dict
+    """
+    if schema._has_processors('pre_dump') or schema._has_processors('post_dump'):
+        return lambda obj: schema.dump(obj, many=False)
+
+    plan = []
+    for name, field in schema.dump_fields.items():
+        key = field.data_key if field.data_key is not None else name
+        attr = field.attribute or name
+        formatValue = _formatter(field)
+        if formatValue is None:
+            formatValue = (lambda f, n: lambda value, obj: f._serialize(value, n, obj))(field, name)
+            plan.append((key, attr, _getter(attr), field.default, formatValue, True))
+        else:
+            plan.append((key, attr, _getter(attr), field.default, formatValue, False))
+
+    def dump(obj):
+        ret = {}
+        isMapping = isinstance(obj, Mapping)
+        for key, attr, get, default, formatValue, needsObj in plan:
+            if get is not None:
+                value = get(obj)
+            elif isMapping:
+                value = obj.get(attr, missing)
+            else:
+                value = getattr(obj, attr, missing)
+            if value is missing:
+                if default is missing:
+                    continue
+                value = default() if callable(default) else default
+            ret[key] = formatValue(value, obj) if needsObj else formatValue(value)
+        return ret
+
+    return dump
+
+
+def compiled(schema):
+    """ replaces schema.dump with a compiled version, for use with flask_accepts.responds()
+
+    Usage:
+        @flask_accepts.responds(schema=compiled(OrderHeaderSchema(many=True)), api=orders_ns)
+
+    Args:
+        schema (Schema): the marshmallow schema instance
+
+    Returns:
+        Schema: the same schema instance
+    """
+    dumpOne = compile_dump(schema)
+
+    def dump(obj, *, many=None):
+        many = schema.many if many is None else bool(many)
+        if many:
+            return None if obj is None else [dumpOne(each) for each in obj]
+        return dumpOne(obj)
+
+    schema.dump = dump
+    schema.dump_one = dumpOne
+    return schema
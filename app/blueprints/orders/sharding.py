@@ -0,0 +1,685 @@
+""" horizontal sharding of customers, orders and items by CustomerID across several databases
+
+With ORDERS_SHARD_URLS set, each customer lives with its orders and items on
+one of the primary (shard 0) and the databases of the urls, so writers to
+different shards never wait for the same lock.  Every other table is only used
+on the primary.  The CustomerShard directory on the primary records where each
+customer lives, and order and item ids are sequence * ID_STRIDE + shard number.
+Queries not limited to one customer run on every shard at once and the rows are
+merged by their ORDER BY.  Routes that need OFFSET or aggregates across shards
+answer 501 while the orders are sharded.
+"""
+import heapq
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+from sqlalchemy import bindparam, event, exists, func, inspect, literal, select
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList, UnaryExpression
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.sql.util import find_tables
+from .database import RoutingSession, create_engine_from_config, use_session_class
+from .models import Customer, CustomerShard, OrderHeader, OrderItem, ShardSequence
+from .utils import dynamic_error
+
+DEFAULT_CONFIG = {
+    # databases for shards 1 to n (shard 0 is ORDERS_DATABASE_URL), can also be set as a comma separated
+    # ORDERS_SHARD_URLS environment variable, the orders are not sharded when this is empty
+    'ORDERS_SHARD_URLS': [url for url in os.environ.get('ORDERS_SHARD_URLS', '').split(',') if url],
+    # threads that run a query on every shard at once
+    'ORDERS_SHARD_WORKERS': 8
+}
+
+# the shard that also holds the directory and every table that is not sharded
+PRIMARY = 0
+
+# order and item ids are sequence * ID_STRIDE + shard number, which allows up to this many shards
+ID_STRIDE = 64
+
+SHARDED = (Customer, OrderHeader, OrderItem)
+SHARDED_TABLES = {model.__table__ for model in SHARDED}
+
+# tables whose ids come from the ShardSequence of their shard -> primary key column
+SEQUENCES = {OrderHeader.__table__: 'OrderHeaderID', OrderItem.__table__: 'OrderItemID'}
+
+# number of customers spread over the shards at a time when seeding
+SEED_CHUNK_SIZE = 10000
+
+# tables whose CustomerID column limits a query to one shard
+CUSTOMER_TABLES = {Customer.__table__, OrderHeader.__table__}
+
+# session.info keys: CustomerID -> shard lookups of the session, and the shard whose rows are being
+# loaded (their related rows, e.g. the items of its orders, are on the same shard)
+DIRECTORY_KEY = 'orders_customer_shards'
+LOADING_KEY = 'orders_loading_shard'
+
+_sequenceTable = ShardSequence.__table__
+_reserve = _sequenceTable.update().where(_sequenceTable.c.Name == bindparam('name')).values(
+    NextID=_sequenceTable.c.NextID + bindparam('count')
+)
+_nextId = select([_sequenceTable.c.NextID]).where(_sequenceTable.c.Name == bindparam('name'))
+
+
+class UnknownShard(LookupError):
+    pass
+
+
+def _token(obj):
+    """ returns the shard an instance was loaded from or assigned to """
+    state = inspect(obj)
+    return state.key[2] if state.key else state.identity_token
+
+
+@contextmanager
+def _loading(target, shard):
+    previous = target.info.get(LOADING_KEY)
+    target.info[LOADING_KEY] = shard
+    try:
+        yield
+    finally:
+        if previous is None:
+            target.info.pop(LOADING_KEY, None)
+        else:
+            target.info[LOADING_KEY] = previous
+
+
+def _customer_criterion(criterion):
+    """ returns x for a WHERE clause that is (or is AND-ed with) CustomerID = x, otherwise None """
+    if criterion is None:
+        return None
+    clauses = criterion.clauses if isinstance(criterion, BooleanClauseList) and criterion.operator is operators.and_ else [criterion]
+    for clause in clauses:
+        if isinstance(clause, BinaryExpression) and clause.operator is operators.eq:
+            for column, value in ((clause.left, clause.right), (clause.right, clause.left)):
+                if getattr(column, 'table', None) in CUSTOMER_TABLES and column.key == 'CustomerID' and isinstance(value, BindParameter):
+                    return value.effective_value
+    return None
+
+
+#***********************************************************************************************************##
+#  SHARD MAP                                                                                                ##
+#***********************************************************************************************************##
+class ShardMap:
+    """ the shard engines and the rules that pick one for each customer, order, item and query """
+    def __init__(self):
+        self.binds = {}
+        self.workers = DEFAULT_CONFIG['ORDERS_SHARD_WORKERS']
+        self._numbers = {}
+        self._executor = None
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, primary):
+        """ creates the shard engines from the app config and switches the session to sharding
+
+        Args:
+            app (Flask): the flask app
+            primary (Engine): the engine of ORDERS_DATABASE_URL, which becomes shard 0
+        """
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        urls = app.config['ORDERS_SHARD_URLS']
+        if isinstance(urls, str):
+            urls = [url for url in urls.split(',') if url]
+        self.workers = app.config['ORDERS_SHARD_WORKERS']
+        if not urls:
+            return
+        if len(urls) >= ID_STRIDE:
+            raise ValueError(f'at most {ID_STRIDE} shards are supported, got {len(urls) + 1}')
+
+        self.binds = {PRIMARY: primary}
+        self.binds.update({number: create_engine_from_config(app.config, url) for number, url in enumerate(urls, 1)})
+        self._numbers = {engine: number for number, engine in self.binds.items()}
+        for engine in self.binds.values():
+            if not event.contains(engine, 'before_execute', _assign_ids):
+                event.listen(engine, 'before_execute', _assign_ids, retval=True)
+        use_session_class(ShardSession)
+
+    @property
+    def enabled(self):
+        return bool(self.binds)
+
+    @property
+    def shard_ids(self):
+        return sorted(self.binds)
+
+    def engines(self):
+        """ returns the engine of every shard, the primary first """
+        return [self.binds[shard] for shard in self.shard_ids]
+
+    def number(self, engine):
+        """ returns the shard number of an engine """
+        return self._numbers[engine]
+
+    def pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='orders-shard')
+            return self._executor
+
+    #***********************************************************************************************************##
+    #  CHOOSERS                                                                                                  ##
+    #***********************************************************************************************************##
+    def shard_for(self, target, mapper, instance, clause=None):
+        """ picks the shard for a new instance or a statement (the ShardedSession shard_chooser)
+
+        Statements on the sharded tables that are not a query (e.g. the
+        UPDATE of recalculate_order_totals) run on the one shard the session has
+        loaded or added customers, orders and items from.
+        """
+        if instance is not None:
+            return self._place(target, instance) if isinstance(instance, SHARDED) else PRIMARY
+        if mapper is not None:
+            sharded = mapper.local_table in SHARDED_TABLES
+        else:
+            sharded = clause is not None and any(table in SHARDED_TABLES for table in find_tables(clause, include_crud=True))
+        if not sharded:
+            return PRIMARY
+
+        shards = {key[2] for key in target.identity_map.keys() if issubclass(key[0], SHARDED)}
+        shards.update(inspect(obj).identity_token for obj in target.new if isinstance(obj, SHARDED))
+        shards.discard(None)
+        if len(shards) != 1:
+            raise UnknownShard(f'Cannot tell which shard to run the statement on, the session has rows from {len(shards)} shards')
+        return shards.pop()
+
+    def _place(self, target, instance):
+        """ picks the shard for a new customer (round robin) or the shard of the customer an order or item belongs to """
+        state = inspect(instance)
+        if isinstance(instance, Customer):
+            shard = self.shard_ids[next(self._next) % len(self.binds)]
+            values = {'Shard': shard}
+            if state.dict.get('CustomerID') is not None:
+                values['CustomerID'] = state.dict['CustomerID']
+            customerId = target.connection(shard_id=PRIMARY).execute(
+                CustomerShard.__table__.insert().values(**values)
+            ).inserted_primary_key[0]
+            state.dict['CustomerID'] = customerId
+            target.info.setdefault(DIRECTORY_KEY, {})[customerId] = shard
+            return shard
+
+        if isinstance(instance, OrderHeader):
+            parent, model, parentId = state.dict.get('customer'), Customer, state.dict.get('CustomerID')
+        else:
+            parent, model, parentId = state.dict.get('orderHeader'), OrderHeader, state.dict.get('OrderHeaderID')
+        if parent is not None and _token(parent) is not None:
+            return _token(parent)
+        shard = self.locate(target, model, parentId) if parentId is not None else None
+        if shard is None:
+            raise UnknownShard(f'Cannot place {type(instance).__name__} without an existing {model.__name__}')
+        return shard
+
+    def locate(self, target, model, id):
+        """ returns the shard a customer, order or item is on, or None if it does not exist
+
+        Args:
+            target (Session): the session, its identity map and directory lookups are used first
+            model (type): Customer, OrderHeader or OrderItem
+            id (int): the primary key
+        """
+        if model is Customer:
+            directory = target.info.setdefault(DIRECTORY_KEY, {})
+            if id not in directory:
+                directory[id] = target.connection(shard_id=PRIMARY).execute(
+                    select([CustomerShard.Shard]).where(CustomerShard.CustomerID == id)
+                ).scalar()
+            return directory[id]
+
+        for key in target.identity_map.keys():
+            if key[0] is model and key[1] == (id,):
+                return key[2]
+        column = model.__mapper__.primary_key[0]
+        for shard in self.id_shards(id):
+            if target.connection(shard_id=shard).execute(select([column]).where(column == id)).first() is not None:
+                return shard
+        return None
+
+    def id_shards(self, id):
+        """ returns every shard, the one an order or item id was created on first """
+        home = id % ID_STRIDE
+        shards = self.shard_ids
+        return [home] + [shard for shard in shards if shard != home] if home in self.binds else shards
+
+    def id_chooser(self, query, ident):
+        """ returns the shards to look for a primary key on, in order """
+        mapper = query._bind_mapper()
+        if mapper is None or mapper.local_table not in SHARDED_TABLES:
+            return [PRIMARY]
+        if mapper.class_ is Customer:
+            shard = self.locate(query.session, Customer, ident[0])
+            return [] if shard is None else [shard]
+        return self.id_shards(ident[0])
+
+    def query_chooser(self, query):
+        """ returns the shards to run a query on: one for a single customer's rows, otherwise all of them """
+        mapper = query._bind_mapper()
+        if mapper is None or mapper.local_table not in SHARDED_TABLES:
+            return [PRIMARY]
+        loading = query.session.info.get(LOADING_KEY)
+        if loading is not None:
+            return [loading]
+        if query.lazy_loaded_from is not None:
+            return [_token(query.lazy_loaded_from.obj())]
+        customerId = _customer_criterion(query._criterion)
+        if customerId is not None:
+            shard = self.locate(query.session, Customer, customerId)
+            return [] if shard is None else [shard]
+        return self.shard_ids
+
+    #***********************************************************************************************************##
+    #  IDS                                                                                                       ##
+    #***********************************************************************************************************##
+    def reserve(self, conn, table, count=1):
+        """ reserves ids for new orders or items on the connection's shard
+
+        Args:
+            conn (Connection): a connection to the shard, the reservation commits with it
+            table (Table): OrderHeader or OrderItem
+            count (int, optional): the number of ids
+
+        Returns:
+            range: the ids
+        """
+        shard = self.number(conn.engine)
+        if not conn.execute(_reserve, name=table.name, count=count).rowcount:
+            raise UnknownShard(f'Shard {shard} has no id sequence for {table.name}, run "flask orders migrate"')
+        last = conn.execute(_nextId, name=table.name).scalar()
+        return range((last - count) * ID_STRIDE + shard, last * ID_STRIDE + shard, ID_STRIDE)
+
+    def prepare(self):
+        """ adds the customers from before the orders were sharded (all on the primary) to the directory and starts
+        every id sequence above the ids that already exist on any shard """
+        customers = Customer.__table__
+        directory = CustomerShard.__table__
+        with self.binds[PRIMARY].begin() as conn:
+            conn.execute(directory.insert().from_select(
+                ['CustomerID', 'Shard'],
+                select([customers.c.CustomerID, literal(PRIMARY)]).where(~exists().where(directory.c.CustomerID == customers.c.CustomerID))
+            ))
+
+        for table, key in SEQUENCES.items():
+            highest = max(engine.execute(select([func.coalesce(func.max(table.c[key]), 0)])).scalar() for engine in self.engines())
+            start = highest // ID_STRIDE + 1
+            for engine in self.engines():
+                with engine.begin() as conn:
+                    current = conn.execute(_nextId, name=table.name).scalar()
+                    if current is None:
+                        conn.execute(_sequenceTable.insert().values(Name=table.name, NextID=start))
+                    elif current < start:
+                        conn.execute(_sequenceTable.update().where(_sequenceTable.c.Name == table.name).values(NextID=start))
+
+    #***********************************************************************************************************##
+    #  SEEDING AND REBALANCING                                                                                   ##
+    #***********************************************************************************************************##
+    def load_sample_data(self, data, progress=None, chunk_size=SEED_CHUNK_SIZE):
+        """ spreads the sample data shape over the shards round robin and loads the shards at the same time
+
+        The customers are read in chunks, so generated data sets never have to fit
+        in memory.  The tables must be empty, see controller.create_sample_data.
+
+        Args:
+            data (dict): {"customers": [...]} where each customer has "Orders" and each order has "Items"
+            progress (callable, optional): called with the running counts of all shards
+            chunk_size (int, optional): the number of customers spread over the shards at a time
+
+        Returns:
+            dict: the number of customers, orders and items created
+        """
+        from .bulk import load_sample_data
+        from .catalog import resolve_products
+
+        self.prepare()
+        shards = self.shard_ids
+        totals = {'customers': 0, 'orders': 0, 'items': 0}
+        lock = threading.Lock()
+
+        def load(position, part, firstId, products):
+            engine = self.binds[shards[position]]
+            orders = [order for customer in part for order in customer.get('Orders', [])]
+            with engine.begin() as conn:
+                orderIds = self.reserve(conn, OrderHeader.__table__, len(orders))
+                itemIds = self.reserve(conn, OrderItem.__table__, sum(len(order.get('Items', [])) for order in orders))
+            ids = {
+                Customer.__tablename__: (firstId, len(shards)),
+                OrderHeader.__tablename__: (orderIds.start, ID_STRIDE),
+                OrderItem.__tablename__: (itemIds.start, ID_STRIDE)
+            }
+            reported = dict.fromkeys(totals, 0)
+
+            def report(counts):
+                with lock:
+                    for key in totals:
+                        totals[key] += counts[key] - reported[key]
+                    reported.update(counts)
+                    if progress is not None:
+                        progress(dict(totals))
+
+            load_sample_data(engine, {'customers': part}, progress=report, ids=ids, products=products)
+
+        customers = iter(data['customers'])
+        customerId = 0
+        with ThreadPoolExecutor(len(shards), thread_name_prefix='orders-seed') as pool:
+            while True:
+                chunk = list(itertools.islice(customers, chunk_size))
+                if not chunk:
+                    break
+
+                # the products and the directory are written to the primary first, the shards only reference them
+                names = {}
+                for customer in chunk:
+                    for order in customer.get('Orders', []):
+                        for item in order.get('Items', []):
+                            names.setdefault(item.get('ProductName'), item.get('UnitPrice', 0))
+                names.pop(None, None)
+                products = [{'ProductName': name, 'UnitPrice': price} for name, price in names.items()]
+                with self.binds[PRIMARY].begin() as conn:
+                    resolve_products(conn, products)
+                    conn.execute(CustomerShard.__table__.insert(), [
+                        {'CustomerID': customerId + i + 1, 'Shard': shards[i % len(shards)]} for i in range(len(chunk))
+                    ])
+                products = {product['ProductName']: product['ProductID'] for product in products}
+
+                futures = [
+                    pool.submit(load, position, chunk[position::len(shards)], customerId + position + 1, products)
+                    for position in range(min(len(shards), len(chunk)))
+                ]
+                for future in futures:
+                    future.result()
+                customerId += len(chunk)
+        return totals
+
+    def counts(self):
+        """ returns the number of customers on each shard """
+        return {shard: engine.execute(select([func.count()]).select_from(Customer.__table__)).scalar() for shard, engine in self.binds.items()}
+
+    def move_customer(self, customerId, shard):
+        """ moves a customer with all of its orders and items to another shard, the rows keep their ids
+
+        The customer's Version is bumped first, which takes the write lock on the
+        source shard, so no order can be added in the middle of the move.  The
+        rows are copied and committed on the target, the directory is updated and
+        then the rows are deleted from the source.  If the move is interrupted
+        before the directory is updated the source still has everything, and
+        running it again replaces the partial copy.
+
+        Args:
+            customerId (int): the customer
+            shard (int): the target shard
+
+        Raises:
+            UnknownShard: for a shard or customer that does not exist
+
+        Returns:
+            bool: False if the customer already was on that shard
+        """
+        if shard not in self.binds:
+            raise UnknownShard(f'There is no shard {shard}, expected one of {self.shard_ids}')
+        directory = CustomerShard.__table__
+        with self.binds[PRIMARY].connect() as conn:
+            source = conn.execute(select([directory.c.Shard]).where(directory.c.CustomerID == customerId)).scalar()
+        if source is None:
+            raise UnknownShard(f'No Customer found with ID: {customerId}')
+        if source == shard:
+            return False
+
+        customers, headers, items = Customer.__table__, OrderHeader.__table__, OrderItem.__table__
+        orderIds = select([headers.c.OrderHeaderID]).where(headers.c.CustomerID == customerId)
+        with self.binds[source].begin() as src:
+            src.execute(customers.update().where(customers.c.CustomerID == customerId).values(Version=customers.c.Version + 1))
+            rows = [
+                (table, [dict(row) for row in src.execute(select([table]).where(where))])
+                for table, where in (
+                    (customers, customers.c.CustomerID == customerId),
+                    (headers, headers.c.CustomerID == customerId),
+                    (items, items.c.OrderHeaderID.in_(orderIds))
+                )
+            ]
+            relocate = directory.update().where(directory.c.CustomerID == customerId).values(Shard=shard)
+            with self.binds[shard].begin() as dst:
+                for table, values in rows:
+                    if values:
+                        dst.execute(table.insert().prefix_with('OR REPLACE'), values)
+                if shard == PRIMARY:
+                    dst.execute(relocate)
+            # the primary is only written on one connection at a time, it may be the source or the target
+            if source == PRIMARY:
+                src.execute(relocate)
+            elif shard != PRIMARY:
+                with self.binds[PRIMARY].begin() as conn:
+                    conn.execute(relocate)
+            for table, where in ((items, items.c.OrderHeaderID.in_(orderIds)), (headers, headers.c.CustomerID == customerId),
+                                 (customers, customers.c.CustomerID == customerId)):
+                src.execute(table.delete().where(where))
+        return True
+
+    def rebalance(self, limit=None, progress=None):
+        """ moves customers from the fullest to the emptiest shards until they differ by at most one customer
+
+        Args:
+            limit (int, optional): the max number of customers to move
+            progress (callable, optional): called with (customerId, source, target) after every move
+
+        Returns:
+            int: the number of customers moved
+        """
+        counts = self.counts()
+        moved = 0
+        while limit is None or moved < limit:
+            source = max(counts, key=counts.get)
+            target = min(counts, key=counts.get)
+            if counts[source] - counts[target] <= 1:
+                break
+            customers = Customer.__table__
+            customerId = self.binds[source].execute(select([func.max(customers.c.CustomerID)])).scalar()
+            self.move_customer(customerId, target)
+            counts[source] -= 1
+            counts[target] += 1
+            moved += 1
+            if progress is not None:
+                progress(customerId, source, target)
+        return moved
+
+
+shard_map = ShardMap()
+
+
+class ShardSession(ShardedSession, RoutingSession):
+    """ the session while the orders are sharded, a horizontal_shard.ShardedSession over the shards of shard_map """
+    def __init__(self, **kwargs):
+        super().__init__(
+            partial(shard_map.shard_for, self), shard_map.id_chooser, shard_map.query_chooser,
+            shards=shard_map.binds, query_cls=FanOutQuery, **kwargs
+        )
+
+    def get_bind(self, mapper=None, **kwargs):
+        # session.get_bind() without a mapper is the primary, like on an unsharded session
+        return super().get_bind(mapper, **kwargs)
+
+
+def single_database(func):
+    """ decorator for routes that only work on one database, they answer 501 while the orders are sharded """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if shard_map.enabled:
+            return dynamic_error(code=501, description='Not Implemented', message='This endpoint is not available while the orders are sharded')
+        return func(*args, **kwargs)
+    return inner
+
+
+def _assign_ids(conn, clauseelement, multiparams, params):
+    """ gives new orders and items an id from the sequence of the shard they are inserted into (before_execute) """
+    if not isinstance(clauseelement, Insert) or clauseelement.table not in SEQUENCES or clauseelement.select is not None:
+        return clauseelement, multiparams, params
+    key = SEQUENCES[clauseelement.table]
+    if multiparams and isinstance(multiparams[0], (list, tuple)):
+        rows = list(multiparams[0])
+    elif multiparams:
+        rows = list(multiparams)
+    else:
+        rows = [params] if params else []
+
+    if not rows:
+        values = clauseelement.parameters
+        if isinstance(values, dict) and not any(getattr(column, 'key', column) == key for column in values):
+            clauseelement = clauseelement.values({key: shard_map.reserve(conn, clauseelement.table)[0]})
+        return clauseelement, multiparams, params
+
+    missing = [i for i, row in enumerate(rows) if row.get(key) is None]
+    if not missing:
+        return clauseelement, multiparams, params
+    for i, rowId in zip(missing, shard_map.reserve(conn, clauseelement.table, len(missing))):
+        rows[i] = dict(rows[i], **{key: rowId})
+    return clauseelement, ((rows,) if len(rows) > 1 else (rows[0],)), {}
+
+
+#***********************************************************************************************************##
+#  FAN OUT QUERIES                                                                                          ##
+#***********************************************************************************************************##
+class _Fetched:
+    """ a result whose rows were already fetched (on a worker thread), for Query.instances() """
+    def __init__(self, result, rows):
+        self.result = result
+        self.rows = rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.result, name)
+
+
+def _fetch(conn, statement, params):
+    result = conn.execute(statement, params)
+    return _Fetched(result, result.fetchall())
+
+
+def _order_keys(query):
+    """ returns (column, attribute name, descending) for each ORDER BY column, or [] when the rows cannot be sorted by them """
+    keys = []
+    for clause in query._order_by or ():
+        descending = isinstance(clause, UnaryExpression) and clause.modifier is operators.desc_op
+        if isinstance(clause, UnaryExpression):
+            clause = clause.element
+        name = getattr(clause, 'key', None)
+        if not isinstance(name, str):
+            return []
+        keys.append((clause, name, descending))
+    return keys
+
+
+def _sort_key(name):
+    # nulls first, like sqlite sorts them
+    def key(row):
+        value = getattr(row, name)
+        return (value is not None, value)
+    return key
+
+
+def _column_key(column):
+    # the same for a raw row, read by the column so the rows can be merged before any object is built
+    def key(entry):
+        value = entry[1][column]
+        return (value is not None, value)
+    return key
+
+
+def _merge_rows(parts, keys, limit):
+    """ merges the raw rows of every shard by the ORDER BY and applies the LIMIT
+
+    Returns:
+        list: the shard of each row that made the page, in order
+    """
+    tagged = [(shard, row) for shard, result in parts for row in result.rows]
+    for column, _, descending in reversed(keys):
+        tagged.sort(key=_column_key(column), reverse=descending)
+    if limit is not None:
+        tagged = tagged[:limit]
+    for shard, result in parts:
+        result.rows = [row for rowShard, row in tagged if rowShard == shard]
+    return [shard for shard, _ in tagged]
+
+
+class FanOutQuery(ShardedQuery):
+    """ ShardedQuery that runs on its shards in parallel and merges the rows by the ORDER BY (then applies the LIMIT) """
+    def _execute_and_instances(self, context):
+        if context.identity_token is not None:
+            shards = [context.identity_token]
+        elif self._shard_id is not None:
+            shards = [self._shard_id]
+        else:
+            shards = list(self.query_chooser(self))
+
+        if self._yield_per:
+            return self._stream(shards)
+        if len(shards) > 1 and self._offset:
+            raise NotImplementedError('OFFSET is not supported across shards, page with a keyset instead')
+
+        mapper = self._bind_mapper()
+        connections = [self._connection_from_session(mapper=mapper, shard_id=shard) for shard in shards]
+        if len(connections) > 1:
+            results = [future.result() for future in [
+                shard_map.pool().submit(_fetch, conn, context.statement, self._params) for conn in connections
+            ]]
+        else:
+            results = [_fetch(conn, context.statement, self._params) for conn in connections]
+
+        parts = list(zip(shards, results))
+        keys = _order_keys(self)
+        order = None
+        # joined collection loads spread an object over several rows, those are merged as objects below
+        if len(parts) > 1 and keys and not context.multi_row_eager_loaders:
+            # only the rows on the page become objects, so the items of the rows dropped by the LIMIT are never loaded
+            try:
+                order = _merge_rows(parts, keys, self._limit)
+            except KeyError:
+                # an ORDER BY column that is not selected
+                pass
+
+        loaded = {}
+        for shard, result in parts:
+            context.attributes['shard_id'] = context.identity_token = shard
+            # the related rows loaded with these (selectinload) are on the same shard
+            with _loading(self.session, shard):
+                loaded[shard] = list(self.instances(result, context))
+        if len(parts) == 1:
+            return iter(loaded[shards[0]])
+        if order is not None:
+            iterators = {shard: iter(rows) for shard, rows in loaded.items()}
+            return iter([next(iterators[shard]) for shard in order])
+
+        rows = [row for shard in shards for row in loaded[shard]]
+        for _, name, descending in reversed(keys):
+            rows.sort(key=_sort_key(name), reverse=descending)
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return iter(rows)
+
+    def _stream(self, shards):
+        """ yield_per queries read the shards side by side and merge them lazily when they are ordered one way """
+        iterators = []
+        for shard in shards:
+            context = self._compile_context()
+            context.statement.use_labels = True
+            context.attributes['shard_id'] = context.identity_token = shard
+            result = self._connection_from_session(mapper=self._bind_mapper(), shard_id=shard).execute(context.statement, self._params)
+            iterators.append(self._loaded(shard, self.instances(result, context)))
+
+        keys = _order_keys(self)
+        if len(iterators) > 1 and keys and len({descending for _, _, descending in keys}) == 1:
+            getters = [_sort_key(name) for _, name, _ in keys]
+            return heapq.merge(*iterators, key=lambda row: tuple(getter(row) for getter in getters), reverse=keys[0][2])
+        return itertools.chain(*iterators)
+
+    def _loaded(self, shard, rows):
+        while True:
+            with _loading(self.session, shard):
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+            yield row
@@ -1,24 +1,6 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
 from werkzeug.exceptions import HTTPException
 from flask import jsonify
 
-def create_session(conn_str, Base):
-    """ creates a database session
-
-    Args:
-        conn_str (str): the connection string
-        Base (declarative_base): the sqlalchemy declarative_base
-    """
-    engine = create_engine(conn_str)
-
-    # create all tables
-    Base.metadata.create_all(engine)
-    Base.metadata.bind = engine
-
-    return scoped_session(sessionmaker(bind=engine))
-
-
 def success(message='success', **kwargs):
     """ returns a Response() object as JSON
     :param msg: message to send
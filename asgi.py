@@ -0,0 +1,9 @@
+from wsgi import app
+from app.blueprints.orders.aio import OrdersASGI
+
+# async entry point, serve with any ASGI server: uvicorn asgi:application
+application = OrdersASGI(app)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application)
@@ -0,0 +1,144 @@
+""" order entry latency while analytics clients flood the bulk list routes, with admission control off and on
+
+--readers threads page through GET /items and /orders as fast as they can
+under one X-Client-ID while a single writer creates orders for random
+customers, all through a real threaded WSGI server.  Without admission control
+every request competes for the connection pool and the GIL; with it the bulk
+reads are rate limited (--read-rate), hold at most --bulk-slots slots and wait
+behind the writes.  The write latency and the reads served, limited (429) and
+shed (503) are reported for each mode.
+
+usage:
+    python -m benchmarks.admission --customers 2000 --readers 16 --duration 10 --output results.json
+"""
+import argparse
+import http.client
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+from .common import metadata, peak_rss_kb, scratch_database, summarize, write_results, wsgi_server
+
+READ_URLS = ['/items?limit=500&after={after}', '/orders?limit=200&after={after}']
+
+
+def reader(base_url, stop, counts, lock, seed):
+    """ requests the bulk routes until stop is set and counts the responses by status """
+    conn = http.client.HTTPConnection(urlsplit(base_url).netloc)
+    rng = random.Random(seed)
+    try:
+        while not stop.is_set():
+            conn.request('GET', rng.choice(READ_URLS).format(after=rng.randint(0, 5000)), headers={'X-Client-ID': 'analytics'})
+            response = conn.getresponse()
+            response.read()
+            with lock:
+                counts[response.status] = counts.get(response.status, 0) + 1
+            if response.status in (429, 503):
+                # a well behaved client backs off, but not for the whole Retry-After so the pressure stays on
+                time.sleep(0.05)
+    finally:
+        conn.close()
+
+
+def writer(base_url, stop, customers, seed):
+    """ creates orders until stop is set
+
+    Returns:
+        tuple: (latencies of the created orders, failed requests)
+    """
+    from app.blueprints.orders.data.generator import PRODUCTS
+
+    product, price = next(iter(PRODUCTS.items()))
+    order = json.dumps({'Product': product, 'ShippingTotal': 5, 'Items': [{'ProductName': product, 'Quantity': 1, 'UnitPrice': price}]})
+    conn = http.client.HTTPConnection(urlsplit(base_url).netloc)
+    rng = random.Random(seed)
+    latencies = []
+    failed = 0
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            conn.request('POST', f'/customers/{rng.randint(1, customers)}/create-order', body=order,
+                         headers={'Content-Type': 'application/json', 'X-Client-ID': 'order-entry'})
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                failed += 1
+            time.sleep(0.01)
+    finally:
+        conn.close()
+    return latencies, failed
+
+
+def run(base_url, args):
+    stop = threading.Event()
+    counts = {}
+    lock = threading.Lock()
+    readers = [threading.Thread(target=reader, args=(base_url, stop, counts, lock, args.seed + number)) for number in range(args.readers)]
+    for thread in readers:
+        thread.start()
+    result = {}
+    writing = threading.Thread(target=lambda: result.update(write=writer(base_url, stop, args.customers, args.seed)))
+    started = time.perf_counter()
+    writing.start()
+    time.sleep(args.duration)
+    stop.set()
+    writing.join()
+    for thread in readers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies, failed = result['write']
+    return {'writes': summarize(latencies, elapsed), 'failed_writes': failed, 'reads': {str(status): count for status, count in sorted(counts.items())}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=2000, help='number of generated customers')
+    parser.add_argument('--orders', type=int, default=10, help='orders per customer')
+    parser.add_argument('--items', type=int, default=3, help='items per order')
+    parser.add_argument('--readers', type=int, default=16, help='concurrent analytics threads')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run each mode')
+    parser.add_argument('--read-rate', type=float, default=20, help='bulk reads per second allowed for the analytics client')
+    parser.add_argument('--bulk-slots', type=int, default=2, help='slots the bulk reads can hold')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data')
+    parser.add_argument('--output', help='json file to write the results to (defaults to stdout)')
+    args = parser.parse_args(argv)
+
+    from wsgi import app
+    from app.blueprints.orders.admission import admission_control
+
+    modes = {
+        'off': {'ORDERS_ADMISSION_ENABLED': False},
+        'on': {
+            'ORDERS_ADMISSION_ENABLED': True,
+            'ORDERS_ADMISSION_BULK_CONCURRENCY': args.bulk_slots,
+            'ORDERS_ROUTE_RATE_LIMITS': {f'GET {path}': (args.read_rate, args.read_rate) for path in ('/items', '/orders')}
+        }
+    }
+    results = {
+        'meta': metadata(customers=args.customers, orders=args.orders, items=args.items, readers=args.readers,
+                         duration=args.duration, read_rate=args.read_rate, bulk_slots=args.bulk_slots, seed=args.seed),
+        'modes': {}
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode, config in modes.items():
+            with scratch_database(tmp, args.customers, args.orders, args.items, args.seed):
+                app.config.update(config)
+                admission_control.init_app(app)
+                with wsgi_server(app) as url:
+                    entry = results['modes'][mode] = run(url, args)
+            writes = entry['writes']
+            print(f'admission {mode:<3}  writes p50 {writes["p50_ms"]:8.2f}ms  p99 {writes["p99_ms"]:8.2f}ms  '
+                  f'{writes["throughput_rps"]:6.1f}/s  reads by status {entry["reads"]}')
+
+    results['peak_rss_kb'] = peak_rss_kb()
+    write_results(results, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+""" load test every orders api route through the flask test client, a real wsgi server and the asgi app
+
+Each mode gets a freshly generated database, which is then recreated once
+through a create-sample-data job (timed as the setup) so the load itself never
+wipes the data.  For every route the latency percentiles, throughput, SQL
+statements per request and peak RSS are recorded so results can be compared
+between commits.  The asgi mode reads through aiosqlite on its native routes,
+only the statements of the requests it hands to flask are counted.
+
+usage:
+    python -m benchmarks.api --customers 2000 --orders 10 --items 3 --requests 200 --output results.json
+"""
+import argparse
+import http.client
+import json
+import random
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+from .common import asgi_server, metadata, peak_rss_kb, scratch_database, summarize, write_results, wsgi_server
+
+# url and body may be callables taking (rand, ids) so each request can target different rows
+Scenario = namedtuple('Scenario', ['name', 'method', 'url', 'body', 'collect', 'limit'])
+
+
+def _scenario(name, method, url, body=None, collect=None, limit=None):
+    return Scenario(name, method, url, body, collect, limit)
+
+
+def _pick(key):
+    return lambda rand, ids: rand.choice(ids[key])
+
+
+def _pop(key):
+    return lambda rand, ids: ids[key].pop()
+
+
+def build_scenarios():
+    """ returns every route in controller.py in an order where creates feed the later updates and deletes
+
+    POST /orders/recreate-database wipes the data, it is timed once by recreate_database() instead.
+    """
+    customer = _pick('customers')
+    order = _pick('orders')
+    item = _pick('items')
+    product = _pick('products')
+    return [
+        _scenario('POST /customers', 'POST', '/customers',
+                  lambda r, ids: {'FirstName': 'Bench', 'LastName': f'Mark{r.randint(0, 999)}', 'ShipToState': 'MN'},
+                  collect='newCustomers'),
+        _scenario('POST /customers/<id>/create-order', 'POST', lambda r, ids: f'/customers/{customer(r, ids)}/create-order',
+                  lambda r, ids: {'Product': 'Ninja', 'ShippingTotal': 5, 'Items': [{'ProductName': 'Ninja', 'Quantity': 2, 'UnitPrice': 11.12}]},
+                  collect='newOrders'),
+        _scenario('POST /orders/<id>/create-item', 'POST', lambda r, ids: f'/orders/{order(r, ids)}/create-item',
+                  lambda r, ids: {'ProductName': 'Frog', 'Quantity': 1, 'UnitPrice': 14.68},
+                  collect='newItems'),
+        _scenario('POST /orders/<id>/items', 'POST', lambda r, ids: f'/orders/{order(r, ids)}/items',
+                  lambda r, ids: [{'ProductName': 'Robot', 'Quantity': r.randint(1, 5), 'UnitPrice': 32.40} for _ in range(20)]),
+        _scenario('PATCH /orders/<id>/items', 'PATCH', lambda r, ids: f'/orders/{order(r, ids)}/items',
+                  lambda r, ids: [{'ProductName': 'Frog', 'Quantity': 1, 'UnitPrice': 14.68}] * 5),
+        _scenario('POST /orders/bulk', 'POST', '/orders/bulk',
+                  lambda r, ids: [{'CustomerID': customer(r, ids), 'Product': 'Koala', 'ShippingTotal': 3,
+                                   'Items': [{'ProductName': 'Koala', 'Quantity': 1, 'UnitPrice': 52.03}]} for _ in range(10)]),
+        _scenario('POST /orders/bulk (500 orders)', 'POST', '/orders/bulk',
+                  lambda r, ids: [{'CustomerID': customer(r, ids), 'Product': 'Koala', 'ShippingTotal': 3,
+                                   'Items': [{'ProductName': 'Koala', 'Quantity': 1, 'UnitPrice': 52.03}] * 3} for _ in range(500)],
+                  limit=20),
+        _scenario('POST /products', 'POST', '/products',
+                  lambda r, ids: {'Name': f'Bench {r.getrandbits(64):x}', 'UnitPrice': round(r.uniform(1, 50), 2)},
+                  collect='newProducts'),
+        _scenario('GET /orders?limit=100', 'GET', '/orders?limit=100'),
+        _scenario('GET /orders?limit=100&after=<id>', 'GET', lambda r, ids: f'/orders?limit=100&after={order(r, ids)}'),
+        _scenario('GET /orders?CustomerID=<id>', 'GET', lambda r, ids: f'/orders?CustomerID={customer(r, ids)}'),
+        _scenario('GET /orders?Product=Ninja&limit=100', 'GET', '/orders?Product=Ninja&limit=100'),
+        _scenario('GET /orders?stream=true&CustomerID=<id>', 'GET', lambda r, ids: f'/orders?stream=true&CustomerID={customer(r, ids)}'),
+        _scenario('GET /orders/<id>', 'GET', lambda r, ids: f'/orders/{order(r, ids)}'),
+        _scenario('GET /orders/cache-stats', 'GET', '/orders/cache-stats'),
+        _scenario('GET /items?limit=100', 'GET', '/items?limit=100'),
+        _scenario('GET /items?OrderHeaderID=<id>', 'GET', lambda r, ids: f'/items?OrderHeaderID={order(r, ids)}'),
+        _scenario('GET /items/<id>', 'GET', lambda r, ids: f'/items/{item(r, ids)}'),
+        _scenario('GET /customers?limit=100', 'GET', '/customers?limit=100'),
+        _scenario('GET /customers?LastName=Smith&limit=100', 'GET', '/customers?LastName=Smith&limit=100'),
+        _scenario('GET /customers/<id>', 'GET', lambda r, ids: f'/customers/{customer(r, ids)}'),
+        _scenario('GET /customers/<id>/orders', 'GET', lambda r, ids: f'/customers/{customer(r, ids)}/orders'),
+        _scenario('GET /products', 'GET', '/products'),
+        _scenario('GET /products/<id>', 'GET', lambda r, ids: f'/products/{product(r, ids)}'),
+        _scenario('GET /reports/sales-by-product', 'GET', '/reports/sales-by-product', limit=20),
+        _scenario('GET /reports/sales-by-state?ShipToState=MN', 'GET', '/reports/sales-by-state?ShipToState=MN', limit=20),
+        _scenario('GET /reports/sales-by-period?start=2019-01-01', 'GET', '/reports/sales-by-period?start=2019-01-01', limit=20),
+        _scenario('GET /search?q=smi', 'GET', '/search?q=smi'),
+        _scenario('GET /search?q=ninja&kind=item', 'GET', '/search?q=ninja&kind=item'),
+        _scenario('GET /orders/export?CustomerID=<id>', 'GET', lambda r, ids: f'/orders/export?CustomerID={customer(r, ids)}'),
+        _scenario('GET /orders/export', 'GET', '/orders/export', limit=5),
+        _scenario('GET /items/export?customer=true', 'GET', '/items/export?customer=true', limit=5),
+        _scenario('GET /changes/latest', 'GET', '/changes/latest'),
+        _scenario('GET /changes?since=<id>&limit=100', 'GET', lambda r, ids: f'/changes?since={r.randint(0, ids["latestChange"])}&limit=100'),
+        _scenario('GET /jobs', 'GET', '/jobs'),
+        _scenario('GET /jobs/<id>', 'GET', lambda r, ids: f'/jobs/{_pick("jobs")(r, ids)}'),
+        # archives nothing, an exclusive job so repeated submits mostly return the one still queued
+        _scenario('POST /jobs', 'POST', '/jobs', {'type': 'archive-orders', 'params': {'before': '1990-01-01'}}),
+        _scenario('PUT /orders/<id>', 'PUT', lambda r, ids: f'/orders/{order(r, ids)}',
+                  lambda r, ids: {'ShippingTotal': round(r.uniform(0, 25), 2)}),
+        _scenario('PUT /items/<id>', 'PUT', lambda r, ids: f'/items/{item(r, ids)}',
+                  lambda r, ids: {'Quantity': r.randint(1, 10)}),
+        _scenario('PUT /customers/<id>', 'PUT', lambda r, ids: f'/customers/{customer(r, ids)}',
+                  lambda r, ids: {'ShipToState': r.choice(['MN', 'TX'])}),
+        _scenario('PUT /products/<id>', 'PUT', lambda r, ids: f'/products/{_pick("newProducts")(r, ids)}',
+                  lambda r, ids: {'UnitPrice': round(r.uniform(1, 50), 2)}),
+        _scenario('DELETE /items/<id>', 'DELETE', lambda r, ids: f'/items/{_pop("newItems")(r, ids)}'),
+        _scenario('DELETE /orders/<id>', 'DELETE', lambda r, ids: f'/orders/{_pop("newOrders")(r, ids)}'),
+        _scenario('DELETE /customers/<id>', 'DELETE', lambda r, ids: f'/customers/{_pop("newCustomers")(r, ids)}'),
+    ]
+
+
+class TestClientDriver:
+    """ sends requests in process through the flask test client """
+    mode = 'test_client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, body=None):
+        response = self.client.open(url, method=method, json=body)
+        data = response.get_data()
+        return response.status_code, data
+
+
+class HttpDriver:
+    """ sends requests over http to a running wsgi or asgi server """
+    def __init__(self, base_url, mode):
+        self.netloc = urlsplit(base_url).netloc
+        self.mode = mode
+
+    def request(self, method, url, body=None):
+        conn = http.client.HTTPConnection(self.netloc)
+        try:
+            headers = {}
+            payload = None
+            if body is not None:
+                payload = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            conn.request(method, url, payload, headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+
+def recreate_database(driver, customers, orders, items, seed=0):
+    """ recreates the database with the same generated data through a create-sample-data job
+
+    Returns:
+        tuple: (the job id, seconds until the job finished)
+    """
+    params = {'customers': customers, 'orders': orders, 'items': items, 'seed': seed}
+    start = time.perf_counter()
+    status, data = driver.request('POST', '/jobs', {'type': 'create-sample-data', 'params': params})
+    if status >= 400:
+        raise RuntimeError(f'recreating the database failed: {status} {data[:200]}')
+    jobId = json.loads(data)['JobID']
+    while True:
+        job = json.loads(driver.request('GET', f'/jobs/{jobId}')[1])
+        if job['Status'] in ('succeeded', 'failed'):
+            break
+        time.sleep(0.05)
+    if job['Status'] != 'succeeded':
+        raise RuntimeError(f'recreating the database failed: {job["Message"]}')
+    return jobId, time.perf_counter() - start
+
+
+def collect_ids(driver, customers, orders, items, jobId):
+    """ returns the ids the scenarios pick from, read after the recreate """
+    return {
+        'customers': list(range(1, customers + 1)),
+        'orders': list(range(1, customers * orders + 1)),
+        'items': list(range(1, customers * orders * items + 1)),
+        'products': [product['ProductID'] for product in json.loads(driver.request('GET', '/products')[1])],
+        'jobs': [jobId],
+        'latestChange': json.loads(driver.request('GET', '/changes/latest')[1])['ChangeID']
+    }
+
+
+def run_scenarios(driver, engine, ids, requests, seed=0):
+    """ runs every scenario sequentially and returns the summary per route """
+    from app.blueprints.orders.loaders import count_queries
+
+    rand = random.Random(seed)
+    results = {}
+    for scenario in build_scenarios():
+        if scenario.collect:
+            ids[scenario.collect] = []
+        latencies = []
+        errors = 0
+        with count_queries(engine) as statements:
+            started = time.perf_counter()
+            for _ in range(min(requests, scenario.limit or requests)):
+                url = scenario.url(rand, ids) if callable(scenario.url) else scenario.url
+                body = scenario.body(rand, ids) if callable(scenario.body) else scenario.body
+                start = time.perf_counter()
+                status, data = driver.request(scenario.method, url, body)
+                latencies.append(time.perf_counter() - start)
+                if status >= 400:
+                    errors += 1
+                elif scenario.collect:
+                    ids[scenario.collect].append(json.loads(data)['id'])
+            elapsed = time.perf_counter() - started
+
+        summary = summarize(latencies, elapsed, len(statements))
+        summary['errors'] = errors
+        summary['peak_rss_kb'] = peak_rss_kb()
+        results[scenario.name] = summary
+        print(f'{driver.mode:<12} {scenario.name:<45} p50 {summary["p50_ms"]:8.2f}ms  p99 {summary["p99_ms"]:8.2f}ms  '
+              f'{summary["throughput_rps"]:8.1f} req/s  {summary["statements_per_request"]:5.1f} sql/req  {errors} errors')
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=2000, help='number of generated customers')
+    parser.add_argument('--orders', type=int, default=10, help='orders per customer')
+    parser.add_argument('--items', type=int, default=3, help='items per order')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data and the request mix')
+    parser.add_argument('--modes', nargs='+', default=['test_client', 'wsgi', 'asgi'], choices=['test_client', 'wsgi', 'asgi'])
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache')
+    parser.add_argument('--output', help='json file to write the results to (defaults to stdout)')
+    args = parser.parse_args(argv)
+
+    from wsgi import app
+    from app.blueprints.orders.aio import OrdersASGI
+    from app.blueprints.orders.cache import response_cache
+    response_cache.enabled = not args.no_cache
+
+    results = {
+        'meta': metadata(customers=args.customers, orders=args.orders, items=args.items,
+                         requests=args.requests, seed=args.seed, cache=response_cache.enabled),
+        'setup': {},
+        'modes': {}
+    }
+    servers = {
+        'test_client': lambda: nullcontext(None),
+        'wsgi': lambda: wsgi_server(app),
+        'asgi': lambda: asgi_server(OrdersASGI(app))
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in args.modes:
+            with scratch_database(tmp, args.customers, args.orders, args.items, args.seed) as engine, servers[mode]() as url:
+                driver = TestClientDriver(app) if url is None else HttpDriver(url, mode)
+                jobId, seconds = recreate_database(driver, args.customers, args.orders, args.items, args.seed)
+                results['setup'][mode] = {'recreate_seconds': seconds}
+                print(f'{mode:<12} {"POST /jobs create-sample-data":<45} {seconds:8.2f}s')
+                ids = collect_ids(driver, args.customers, args.orders, args.items, jobId)
+                results['modes'][mode] = run_scenarios(driver, engine, ids, args.requests, args.seed)
+
+    results['peak_rss_kb'] = peak_rss_kb()
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
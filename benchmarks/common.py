@@ -0,0 +1,172 @@
+""" shared helpers for the benchmark scripts """
+import datetime
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, pct):
+    """ returns the pct percentile (0-100) of a list of numbers using nearest rank """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed, statements=None):
+    """ summarizes a list of request latencies (in seconds) as milliseconds and requests per second """
+    summary = {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'throughput_rps': len(latencies) / elapsed if elapsed else None,
+    }
+    if statements is not None:
+        summary['statements_per_request'] = statements / len(latencies)
+    return summary
+
+
+def peak_rss_kb():
+    """ returns the peak resident set size of this process in kilobytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, linux reports kilobytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def metadata(**kwargs):
+    """ returns the run metadata written at the top of every result file """
+    meta = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': sys.platform
+    }
+    meta.update(kwargs)
+    return meta
+
+
+def write_results(results, output=None):
+    """ writes the results as json to a file, or stdout when no file is given """
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+        print(f'wrote results to {output}')
+    else:
+        print(text)
+
+
+@contextmanager
+def scratch_database(directory, customers, orders, items, seed=0):
+    """ binds the orders session to a freshly seeded sqlite database for the duration of the block
+
+    Yields:
+        Engine: the engine for the scratch database
+    """
+    from wsgi import app
+    from app.blueprints.orders.bulk import load_sample_data
+    from app.blueprints.orders.cache import response_cache
+    from app.blueprints.orders.data.generator import generate_sample_data
+    from app.blueprints.orders.database import session, bind_engine, create_engine_from_config
+    from app.blueprints.orders.models import Base
+
+    path = os.path.join(directory, f'bench-{time.time_ns()}.db')
+    engine = bind_engine(create_engine_from_config(app.config, f'sqlite:///{path}'), Base)
+    load_sample_data(engine, generate_sample_data(customers, orders, items, seed))
+    with engine.connect() as conn:
+        conn.execute('ANALYZE')
+    response_cache.clear()
+    try:
+        yield engine
+    finally:
+        session.remove()
+        engine.dispose()
+
+
+@contextmanager
+def wsgi_server(app, threaded=True, workers=None):
+    """ serves the app with the werkzeug wsgi server on a free local port in a background thread
+
+    Args:
+        app (Flask): the wsgi app
+        threaded (bool, optional): handle each connection in a new thread
+        workers (int, optional): handle connections on a fixed pool of threads instead, like a
+            production wsgi server with a bounded number of workers
+
+    Yields:
+        str: the base url of the server
+    """
+    from werkzeug.serving import BaseWSGIServer, make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if workers:
+        from concurrent.futures import ThreadPoolExecutor
+
+        class PooledWSGIServer(BaseWSGIServer):
+            multithread = True
+            executor = ThreadPoolExecutor(workers)
+
+            def process_request(self, request, client_address):
+                self.executor.submit(self.process_request_thread, request, client_address)
+
+            def process_request_thread(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+        server = PooledWSGIServer('127.0.0.1', 0, app)
+    else:
+        server = make_server('127.0.0.1', 0, app, threaded=threaded)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        thread.join()
+        if workers:
+            server.executor.shutdown()
+
+
+@contextmanager
+def asgi_server(application):
+    """ serves an ASGI app with uvicorn on a free local port in a background thread
+
+    Yields:
+        str: the base url of the server
+    """
+    import socket
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(application, log_level='error', lifespan='on'))
+    thread = threading.Thread(target=server.run, kwargs={'sockets': [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f'http://127.0.0.1:{sock.getsockname()[1]}'
+    finally:
+        server.should_exit = True
+        thread.join()
+        sock.close()
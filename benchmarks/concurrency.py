@@ -0,0 +1,137 @@
+""" throughput of the WSGI app and the ASGI app (asgi.py) under many concurrent slow clients
+
+Each client opens a connection, sends the request line, waits --delay seconds
+before finishing the headers (a slow network or upload) and then reads the
+whole response.  The WSGI app runs on a fixed pool of --workers threads, like a
+production WSGI server, so a slow client holds a worker for its whole request;
+the ASGI app waits on the event loop instead.  Both servers are checked to
+return identical bodies before they are measured.
+
+usage:
+    python -m benchmarks.concurrency --customers 2000 --clients 64 --delay 0.1 --workers 8 --output results.json
+"""
+import argparse
+import asyncio
+import http.client
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+from .common import asgi_server, metadata, peak_rss_kb, scratch_database, summarize, write_results, wsgi_server
+
+DEFAULT_URLS = [
+    '/orders?limit=100',
+    '/orders?CustomerID=7',
+    '/items?OrderHeaderID=7',
+    '/customers/7',
+    '/customers/7/orders'
+]
+
+
+def fetch(base_url, url):
+    """ returns (status, body) for a plain GET """
+    conn = http.client.HTTPConnection(urlsplit(base_url).netloc)
+    try:
+        conn.request('GET', url)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+async def slow_request(host, port, url, delay):
+    """ sends a GET with the headers split around a delay and returns the response status """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f'GET {url} HTTP/1.1\r\nHost: {host}:{port}\r\n'.encode())
+        await writer.drain()
+        await asyncio.sleep(delay)
+        writer.write(b'Connection: close\r\n\r\n')
+        await writer.drain()
+        data = await reader.read()
+    finally:
+        writer.close()
+    return int(data.split(b' ', 2)[1]) if data else 599
+
+
+async def run_clients(base_url, urls, clients, rounds, delay):
+    """ runs the clients concurrently, each sending rounds requests one after another
+
+    Returns:
+        tuple: (latencies, errors, elapsed)
+    """
+    parts = urlsplit(base_url)
+    latencies = []
+    errors = 0
+
+    async def client(index):
+        nonlocal errors
+        for i in range(rounds):
+            start = time.perf_counter()
+            try:
+                status = await slow_request(parts.hostname, parts.port, urls[(index + i) % len(urls)], delay)
+            except OSError:
+                status = 599
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(index) for index in range(clients)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=2000, help='number of generated customers')
+    parser.add_argument('--orders', type=int, default=10, help='orders per customer')
+    parser.add_argument('--items', type=int, default=3, help='items per order')
+    parser.add_argument('--clients', type=int, default=64, help='concurrent clients')
+    parser.add_argument('--rounds', type=int, default=5, help='requests sent by each client')
+    parser.add_argument('--delay', type=float, default=0.1, help='seconds each client takes to send its request')
+    parser.add_argument('--workers', type=int, default=8, help='worker threads for the wsgi server')
+    parser.add_argument('--urls', nargs='+', default=DEFAULT_URLS, help='urls the clients cycle through')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data')
+    parser.add_argument('--output', help='json file to write the results to (defaults to stdout)')
+    args = parser.parse_args(argv)
+
+    from wsgi import app
+    from app.blueprints.orders.aio import OrdersASGI
+
+    results = {
+        'meta': metadata(customers=args.customers, orders=args.orders, items=args.items, clients=args.clients,
+                         rounds=args.rounds, delay=args.delay, workers=args.workers, urls=args.urls),
+        'modes': {}
+    }
+    mismatches = []
+    with tempfile.TemporaryDirectory() as tmp:
+        with scratch_database(tmp, args.customers, args.orders, args.items, args.seed):
+            servers = {
+                'wsgi': lambda: wsgi_server(app, workers=args.workers),
+                'asgi': lambda: asgi_server(OrdersASGI(app))
+            }
+            bodies = {}
+            for mode, server in servers.items():
+                with server() as url:
+                    bodies[mode] = [fetch(url, path) for path in args.urls]
+                    latencies, errors, elapsed = asyncio.run(run_clients(url, args.urls, args.clients, args.rounds, args.delay))
+
+                summary = summarize(latencies, elapsed)
+                summary['errors'] = errors
+                results['modes'][mode] = summary
+                print(f'{mode:<5} {args.clients} clients  p50 {summary["p50_ms"]:8.2f}ms  p99 {summary["p99_ms"]:8.2f}ms  '
+                      f'{summary["throughput_rps"]:8.1f} req/s  {errors} errors')
+
+            for path, wsgiResponse, asgiResponse in zip(args.urls, bodies['wsgi'], bodies['asgi']):
+                if wsgiResponse != asgiResponse:
+                    mismatches.append(path)
+                    print(f'MISMATCH {path}')
+
+    results['identical'] = not mismatches
+    results['peak_rss_kb'] = peak_rss_kb()
+    write_results(results, args.output)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
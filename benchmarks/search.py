@@ -0,0 +1,93 @@
+""" compare the FTS5 search index with the LIKE baseline used on databases without it
+
+Each query is run through both paths for the full result set and for the first
+page.  The two must match the same rows (the script exits non zero otherwise),
+the LIKE path scans every Customer, OrderHeader and OrderItem row while FTS5
+only reads the matching entries of its index.
+
+usage:
+    python -m benchmarks.search --customers 2000 --orders 10 --items 3 --output results.json
+"""
+import argparse
+import sys
+import tempfile
+import time
+from .common import metadata, peak_rss_kb, scratch_database, write_results
+
+DEFAULT_QUERIES = ['nin', 'pi', 'koala', 'jen sim', 'al won', 'ch', 'zz']
+
+
+def _time(func, repeat):
+    """ returns the best wall time of repeated calls and the last result """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def compare(conn, q, page, repeat):
+    """ runs a query through both paths and returns its result entry """
+    from app.blueprints.orders.search import SEARCH_PAGE_SIZE, fts_search, like_search, query_terms
+
+    terms = query_terms(q)
+    entry = {}
+    for name, limit in (('all', -1), ('page', page or SEARCH_PAGE_SIZE)):
+        ftsTime, ftsRows = _time(lambda: fts_search(conn, terms, limit=limit), repeat)
+        likeTime, likeRows = _time(lambda: like_search(conn, terms, limit=limit), repeat)
+        entry[name] = {
+            'matches': len(ftsRows),
+            'fts_ms': round(ftsTime * 1000, 3),
+            'like_ms': round(likeTime * 1000, 3),
+            'speedup': round(likeTime / ftsTime, 2) if ftsTime else None
+        }
+        if name == 'all':
+            # same rows, the order differs (ranked vs by id)
+            entry['identical'] = {(r['kind'], r['id']) for r in ftsRows} == {(r['kind'], r['id']) for r in likeRows}
+    return entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=2000, help='number of generated customers')
+    parser.add_argument('--orders', type=int, default=10, help='orders per customer')
+    parser.add_argument('--items', type=int, default=3, help='items per order')
+    parser.add_argument('--queries', nargs='+', default=DEFAULT_QUERIES, help='search strings to run')
+    parser.add_argument('--page', type=int, help='results per page for the first page timings')
+    parser.add_argument('--repeat', type=int, default=5, help='timed repetitions, the best is kept')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data')
+    parser.add_argument('--output', help='json file to write the results to (defaults to stdout)')
+    args = parser.parse_args(argv)
+
+    results = {
+        'meta': metadata(customers=args.customers, orders=args.orders, items=args.items,
+                         page=args.page, repeat=args.repeat, seed=args.seed),
+        'queries': {}
+    }
+    mismatches = []
+    with tempfile.TemporaryDirectory() as tmp:
+        with scratch_database(tmp, args.customers, args.orders, args.items, args.seed) as engine:
+            from app.blueprints.orders.search import create_search_index
+            if not create_search_index(engine):
+                print('this sqlite build does not include FTS5', file=sys.stderr)
+                return 1
+
+            with engine.connect() as conn:
+                for q in args.queries:
+                    entry = results['queries'][q] = compare(conn, q, args.page, args.repeat)
+                    if not entry['identical']:
+                        mismatches.append(q)
+                    for name in ('all', 'page'):
+                        timing = entry[name]
+                        print(f'{q!r:<12} {name:<4} {timing["matches"]:7d} matches  fts {timing["fts_ms"]:8.2f}ms  '
+                              f'like {timing["like_ms"]:8.2f}ms  {"identical" if entry["identical"] else "MISMATCH"}')
+
+    results['peak_rss_kb'] = peak_rss_kb()
+    write_results(results, args.output)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
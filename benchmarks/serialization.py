@@ -0,0 +1,96 @@
+""" compare the marshmallow dump with the compiled serializer used by the list routes
+
+Every list route schema is dumped both ways for the same objects; the encoded
+json must be byte for byte identical (the script exits non zero otherwise) and
+the time per object is reported for each path.
+
+usage:
+    python -m benchmarks.serialization --customers 2000 --orders 10 --items 3 --output results.json
+"""
+import argparse
+import sys
+import tempfile
+import time
+from .common import metadata, peak_rss_kb, scratch_database, write_results
+
+
+def _time(func, repeat):
+    """ returns the best wall time of repeated calls """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def build_cases(limit):
+    """ returns (name, schema factory, objects) for every schema a list route dumps """
+    from app.blueprints.orders.database import session
+    from app.blueprints.orders.loaders import query_for_schema
+    from app.blueprints.orders.models import Customer, OrderHeader, OrderItem
+    from app.blueprints.orders.schemas import CustomerSchema, OrderHeaderSchema, OrderItemSchema
+
+    cases = [
+        ('OrderHeaderSchema', lambda: OrderHeaderSchema(many=True), OrderHeader, OrderHeader.OrderHeaderID),
+        ('OrderItemSchema', lambda: OrderItemSchema(many=True), OrderItem, OrderItem.OrderItemID),
+        ('CustomerSchema', lambda: CustomerSchema(many=True, exclude=['Orders']), Customer, Customer.CustomerID),
+    ]
+    for name, factory, model, key in cases:
+        objects = query_for_schema(session, model, factory()).order_by(key).limit(limit).all()
+        yield name, factory, objects
+
+
+def compare(factory, objects, repeat):
+    """ dumps the objects with both paths and returns (identical, marshmallow seconds, compiled seconds) """
+    from app.blueprints.orders.serializers import compiled, dumps
+
+    plain = factory()
+    fast = compiled(factory())
+    identical = dumps(plain.dump(objects)) == dumps(fast.dump(objects))
+    return identical, _time(lambda: plain.dump(objects), repeat), _time(lambda: fast.dump(objects), repeat)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=2000, help='number of generated customers')
+    parser.add_argument('--orders', type=int, default=10, help='orders per customer')
+    parser.add_argument('--items', type=int, default=3, help='items per order')
+    parser.add_argument('--limit', type=int, default=1000, help='objects dumped per schema (one page)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed repetitions, the best is kept')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data')
+    parser.add_argument('--output', help='json file to write the results to (defaults to stdout)')
+    args = parser.parse_args(argv)
+
+    from wsgi import app
+
+    results = {
+        'meta': metadata(customers=args.customers, orders=args.orders, items=args.items,
+                         limit=args.limit, repeat=args.repeat, seed=args.seed),
+        'schemas': {}
+    }
+    mismatches = []
+    with tempfile.TemporaryDirectory() as tmp:
+        with scratch_database(tmp, args.customers, args.orders, args.items, args.seed), app.app_context():
+            for name, factory, objects in build_cases(args.limit):
+                identical, marshmallowTime, compiledTime = compare(factory, objects, args.repeat)
+                if not identical:
+                    mismatches.append(name)
+                results['schemas'][name] = {
+                    'objects': len(objects),
+                    'identical': identical,
+                    'marshmallow_ms': round(marshmallowTime * 1000, 3),
+                    'compiled_ms': round(compiledTime * 1000, 3),
+                    'speedup': round(marshmallowTime / compiledTime, 2) if compiledTime else None
+                }
+                print(f'{name:<20} {len(objects):6d} objects  marshmallow {marshmallowTime * 1000:8.2f}ms  '
+                      f'compiled {compiledTime * 1000:8.2f}ms  {"identical" if identical else "MISMATCH"}')
+
+    results['peak_rss_kb'] = peak_rss_kb()
+    write_results(results, args.output)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+""" write throughput and read latency with one database and with the orders sharded over several
+
+Every configuration runs in a fresh interpreter (sharding is set up when the
+app is created) against new sqlite files seeded with the same generated data.
+--writers processes (threads would share the GIL and measure it instead)
+each create orders for random customers through their own test client, so
+with one database every write waits for the same lock while with N shards
+writers to different customers commit side by side.  The list route
+(a query on every shard, merged) and a customer scoped route (one shard) are
+timed afterwards.
+
+usage:
+    python -m benchmarks.sharding --customers 2000 --shards 1 4 --writers 8 --writes 200 --output results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from .common import metadata, peak_rss_kb, summarize, write_results
+
+READ_URLS = ['/orders?limit=100', '/customers/{id}/orders']
+
+
+def child(args):
+    """ runs in the fresh interpreter: seeds the shards, runs the writers and readers and prints the results as json """
+    from wsgi import app
+    from app.blueprints.orders.controller import create_sample_data
+    from app.blueprints.orders.data.generator import generate_sample_data
+
+    client = app.test_client()
+    client.get('/orders?limit=1')
+    with app.app_context():
+        start = time.perf_counter()
+        create_sample_data(generate_sample_data(args.customers, args.orders, args.items, args.seed))
+        seeded = time.perf_counter() - start
+
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(args.writers)
+    queue = context.Queue()
+    writers = [context.Process(target=writer, args=(args, number, barrier, queue)) for number in range(args.writers)]
+    for process in writers:
+        process.start()
+    reports = [queue.get() for _ in writers]
+    for process in writers:
+        process.join()
+    latencies = [elapsed for report in reports for elapsed in report['latencies']]
+    elapsed = max(report['end'] for report in reports) - min(report['start'] for report in reports)
+    results = {'seed_s': seeded, 'writes': summarize(latencies, elapsed), 'failed_writes': sum(report['failed'] for report in reports), 'reads': {}}
+
+    rng = random.Random(args.seed)
+    for url in READ_URLS:
+        times = []
+        start = time.perf_counter()
+        for _ in range(args.reads):
+            began = time.perf_counter()
+            client.get(url.format(id=rng.randint(1, args.customers)))
+            times.append(time.perf_counter() - began)
+        results['reads'][url] = summarize(times, time.perf_counter() - start)
+    print(json.dumps(results))
+
+
+def writer(args, number, barrier, queue):
+    """ runs in a writer process: creates --writes orders once every writer is ready and reports the latencies """
+    from wsgi import app
+    from app.blueprints.orders.data.generator import PRODUCTS
+
+    client = app.test_client()
+    client.get('/orders?limit=1')
+    product, price = next(iter(PRODUCTS.items()))
+    order = {'Product': product, 'ShippingTotal': 5, 'Items': [{'ProductName': product, 'Quantity': 1, 'UnitPrice': price}] * args.items}
+    rng = random.Random(args.seed + number)
+    latencies = []
+    failed = 0
+    barrier.wait()
+    start = time.perf_counter()
+    for _ in range(args.writes):
+        began = time.perf_counter()
+        response = client.post(f'/customers/{rng.randint(1, args.customers)}/create-order', json=order)
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - began)
+        else:
+            failed += 1
+    queue.put({'latencies': latencies, 'failed': failed, 'start': start, 'end': time.perf_counter()})
+
+
+def run_child(directory, shards, argv):
+    urls = [f'sqlite:///{os.path.join(directory, f"shards{shards}-{number}.db")}' for number in range(shards)]
+    env = dict(os.environ, ORDERS_DATABASE_URL=urls[0], ORDERS_SHARD_URLS=','.join(urls[1:]), ORDERS_JOB_WORKERS='0')
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.sharding', '--child'] + argv, env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=2000, help='number of generated customers')
+    parser.add_argument('--orders', type=int, default=10, help='orders per customer')
+    parser.add_argument('--items', type=int, default=3, help='items per order')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4], help='the numbers of databases to compare')
+    parser.add_argument('--writers', type=int, default=8, help='concurrent writer processes')
+    parser.add_argument('--writes', type=int, default=200, help='orders created by each writer')
+    parser.add_argument('--reads', type=int, default=100, help='requests per read url')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data')
+    parser.add_argument('--output', help='json file to write the results to (defaults to stdout)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args)
+        return 0
+
+    results = {
+        'meta': metadata(customers=args.customers, orders=args.orders, items=args.items, writers=args.writers,
+                         writes=args.writes, reads=args.reads, seed=args.seed),
+        'shards': {}
+    }
+    childArgs = [f'--{name}={getattr(args, name)}' for name in ('customers', 'orders', 'items', 'writers', 'writes', 'reads', 'seed')]
+    with tempfile.TemporaryDirectory() as tmp:
+        for shards in args.shards:
+            entry = results['shards'][shards] = run_child(tmp, shards, childArgs)
+            writes = entry['writes']
+            reads = '  '.join(f'{url} p50 {summary["p50_ms"]:.2f}ms' for url, summary in entry['reads'].items())
+            print(f'{shards} shard(s): seeded in {entry["seed_s"]:.2f}s, {writes["throughput_rps"]:.0f} writes/s '
+                  f'(p95 {writes["p95_ms"]:.1f}ms, {entry["failed_writes"]} failed)  {reads}')
+
+    results['peak_rss_kb'] = peak_rss_kb()
+    write_results(results, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+""" startup cost: import time and time to the first response, each measured in a fresh interpreter
+
+A database with the requested number of rows is generated first, then every
+run starts a new python process that imports the app and times the first
+GET request through the test client (which runs the first request hooks: the
+migration check and the sample data emptiness check).  The emptiness check is
+also timed on its own against loading every order, which is what it replaced.
+
+usage:
+    python -m benchmarks.startup --customers 2000 --orders 10 --items 3 --runs 5 --output results.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from .common import metadata, peak_rss_kb, scratch_database, write_results
+
+FIRST_URL = '/orders?limit=10'
+
+
+def child(url):
+    """ runs in the fresh interpreter: prints the import and first response times as json """
+    start = time.perf_counter()
+    from wsgi import app
+    imported = time.perf_counter()
+    response = app.test_client().get(url)
+    responded = time.perf_counter()
+    print(json.dumps({'import_s': imported - start, 'first_response_s': responded - imported, 'status': response.status_code}))
+
+
+def run_child(database_url, url):
+    env = dict(os.environ, ORDERS_DATABASE_URL=database_url)
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.startup', '--child', url], env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def time_emptiness_checks(repeat):
+    """ returns (seconds for the single row check, seconds for loading every order) """
+    from app.blueprints.orders.controller import has_orders
+    from app.blueprints.orders.database import session
+    from app.blueprints.orders.models import OrderHeader
+
+    def best(func):
+        times = []
+        for _ in range(repeat):
+            session.remove()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    return best(has_orders), best(lambda: not session.query(OrderHeader).all())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--customers', type=int, default=2000, help='number of generated customers')
+    parser.add_argument('--orders', type=int, default=10, help='orders per customer')
+    parser.add_argument('--items', type=int, default=3, help='items per order')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh processes started')
+    parser.add_argument('--url', default=FIRST_URL, help='the first request sent by every process')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the data')
+    parser.add_argument('--output', help='json file to write the results to (defaults to stdout)')
+    parser.add_argument('--child', metavar='URL', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.child)
+        return 0
+
+    from wsgi import app
+
+    results = {
+        'meta': metadata(customers=args.customers, orders=args.orders, items=args.items, runs=args.runs, url=args.url, seed=args.seed),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        with scratch_database(tmp, args.customers, args.orders, args.items, args.seed) as engine:
+            with app.app_context():
+                singleRow, allRows = time_emptiness_checks(args.runs)
+            runs = [run_child(str(engine.url), args.url) for _ in range(args.runs)]
+
+    errors = sum(run['status'] >= 400 for run in runs)
+    for name in ('import_s', 'first_response_s'):
+        values = sorted(run[name] for run in runs)
+        results[name.replace('_s', '_ms')] = {
+            'min': round(values[0] * 1000, 2),
+            'median': round(values[len(values) // 2] * 1000, 2),
+            'max': round(values[-1] * 1000, 2)
+        }
+    results['emptiness_check_ms'] = {'first_row': round(singleRow * 1000, 3), 'all_rows': round(allRows * 1000, 3)}
+    results['errors'] = errors
+    print(f'import {results["import_ms"]["median"]:8.2f}ms  first response {results["first_response_ms"]["median"]:8.2f}ms  '
+          f'emptiness check {singleRow * 1000:.3f}ms (loading every order {allRows * 1000:.2f}ms)  {errors} errors')
+
+    results['peak_rss_kb'] = peak_rss_kb()
+    write_results(results, args.output)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import os
+import tempfile
+import pytest
+
+# the app binds a default database on import, point it at a scratch file before anything imports it
+os.environ.setdefault('ORDERS_DATABASE_URL', f'sqlite:///{os.path.join(tempfile.mkdtemp(), "orders-tests.db")}')
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import create_app
+    return create_app()
+
+
+@pytest.fixture(scope='module')
+def engine(app, tmp_path_factory):
+    """ binds the orders session to a freshly seeded sqlite file for the tests of a module """
+    from app.blueprints.orders.cache import response_cache
+    from app.blueprints.orders.database import session, bind_engine, create_engine_from_config
+    from app.blueprints.orders.models import Base
+    from app.blueprints.orders.queryplan import seed_database
+
+    path = tmp_path_factory.mktemp('orders') / 'orders.db'
+    engine = bind_engine(create_engine_from_config(app.config, f'sqlite:///{path}'), Base)
+    seed_database(engine, customers=200)
+    response_cache.clear()
+    yield engine
+    session.remove()
+    engine.dispose()
+
+
+@pytest.fixture
+def client(app, engine):
+    from app.blueprints.orders.cache import response_cache
+
+    client = app.test_client()
+    # run the before first request hooks outside of the tests
+    client.get('/orders/help')
+    # every test reads the database, not responses cached by an earlier one
+    response_cache.clear()
+    return client
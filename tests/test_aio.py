@@ -0,0 +1,151 @@
+""" the native ASGI routes (aio.py) answer like the flask routes and wait for admission slots like them """
+import asyncio
+import pytest
+
+pytest.importorskip('aiosqlite')
+
+
+@pytest.fixture
+def asgi(app, engine):
+    from app.blueprints.orders.aio import OrdersASGI
+
+    asgi = OrdersASGI(app)
+    yield asgi
+    if asgi.db is not None:
+        asyncio.run(asgi.db.close())
+    asgi.executor.shutdown()
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    """ two slots, one for bulk reads, and room for one waiter """
+    from app.blueprints.orders.admission import admission_control, AdmissionQueue
+
+    queue = AdmissionQueue(2, 1, 1)
+    monkeypatch.setattr(admission_control, 'enabled', True)
+    monkeypatch.setattr(admission_control, 'queue', queue)
+    monkeypatch.setattr(admission_control, 'maxWait', 0.2)
+    return queue
+
+
+async def get(asgi, path, query=b'', body=False, headers=()):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': list(headers), 'client': ('127.0.0.1', 1)}
+    await asgi(scope, receive, send)
+    if body:
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+    return messages[0]['status']
+
+
+@pytest.mark.parametrize('path', ['/orders/3', '/items/3', '/customers/3', '/customers/3/orders'])
+def test_etag_matches_flask(asgi, client, path):
+    tag = client.get(path).headers['ETag']
+    assert asyncio.run(get(asgi, path, headers=[(b'if-none-match', tag.encode())])) == 304
+
+
+def test_customer_orders_match_flask(asgi, client):
+    expected = client.get('/customers/3/orders')
+    ids = [order['OrderHeaderID'] for order in expected.get_json()]
+    assert len(ids) > 1 and ids == sorted(ids)
+    assert asyncio.run(get(asgi, '/customers/3/orders', body=True)) == (200, expected.get_data())
+
+
+def test_product_filter_uses_the_catalog(app, engine, asgi, client):
+    from app.blueprints.orders.catalog import product_catalog
+
+    # an item linked to a product under an older name, the flask route finds it through its ProductID
+    productId = product_catalog.id_for('Ninja')
+    engine.execute('UPDATE OrderItem SET ProductName = ? WHERE OrderItemID = (SELECT min(OrderItemID) FROM OrderItem WHERE ProductID = ?)', 'Old Ninja', productId)
+    try:
+        for query in ('Product=Ninja&limit=500', 'Product=Ninja&stream=1', 'Product=Unknown'):
+            expected = client.get(f'/items?{query}')
+            status, body = asyncio.run(get(asgi, '/items', query.encode(), body=True))
+            assert (status, body) == (expected.status_code, expected.get_data())
+            assert b'Old Ninja' in body or 'Ninja' not in query
+    finally:
+        engine.execute('UPDATE OrderItem SET ProductName = ? WHERE ProductName = ?', 'Ninja', 'Old Ninja')
+
+
+def test_native_routes_wait_for_a_slot(asgi, queue):
+    from app.blueprints.orders.admission import BULK
+
+    async def run():
+        # a bulk read holding the only bulk slot
+        await queue.acquire_async(BULK, 1)
+        waiting = asyncio.ensure_future(get(asgi, '/orders', b'limit=5'))
+        await asyncio.sleep(0.05)
+        assert queue.waiting == 1
+        # the queue is full
+        assert await get(asgi, '/items') == 503
+        # the waiter is shed after the max wait
+        assert await waiting == 503
+
+        waiting = asyncio.ensure_future(get(asgi, '/orders', b'stream=1'))
+        await asyncio.sleep(0.05)
+        queue.release(BULK)
+        assert await waiting == 200
+
+        # single rows are not bulk reads, and the flask fallback takes a slot of its own
+        assert await get(asgi, '/orders/3') == 200
+        assert await get(asgi, '/orders/999999') != 200
+
+    asyncio.run(run())
+    assert (queue.running, queue.bulkRunning, queue.waiting) == (0, 0, 0)
+
+
+def test_process_exits_without_lifespan_shutdown(tmp_path):
+    import os
+    import subprocess
+    import sys
+
+    script = '''
+import asyncio, sqlite3, sys
+from sqlalchemy import column, select, table
+from app.blueprints.orders.aio import AsyncSQLite
+
+sqlite3.connect(sys.argv[1]).execute('CREATE TABLE t (x INTEGER)')
+# no pool, like a server run without the lifespan
+db = AsyncSQLite(sys.argv[1], pool_size=0)
+print(asyncio.run(db.fetch(select([column('x')]).select_from(table('t')), ['x'])))
+'''
+    result = subprocess.run([sys.executable, '-c', script, str(tmp_path / 'exit.db')], capture_output=True, timeout=60,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == b'[]'
+
+
+def test_connections_are_pooled_between_lifespan_startup_and_shutdown(asgi):
+    async def run():
+        sent = []
+        started = asyncio.Event()
+        messages = asyncio.Queue()
+        await messages.put({'type': 'lifespan.startup'})
+
+        async def send(message):
+            sent.append(message['type'])
+            started.set()
+
+        task = asyncio.ensure_future(asgi({'type': 'lifespan'}, messages.get, send))
+        await started.wait()
+        await get(asgi, '/orders/3')
+        await get(asgi, '/orders/4')
+        pooled = asgi.db._opened
+        await messages.put({'type': 'lifespan.shutdown'})
+        await task
+        return sent, pooled
+
+    sent, pooled = asyncio.run(run())
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert pooled == 1 and asgi.db._opened == 0
+
+
+def test_no_pool_without_lifespan(asgi):
+    assert asyncio.run(get(asgi, '/orders/3')) == 200
+    assert asgi.db.pool_size == 0
@@ -0,0 +1,47 @@
+""" the bulk import writes a batch with a fixed number of statements, whatever its size """
+import pytest
+from sqlalchemy import func
+from app.blueprints.orders.database import session
+from app.blueprints.orders.loaders import count_queries
+from app.blueprints.orders.models import OrderHeader
+
+
+def _orders(count):
+    return [{
+        'CustomerID': 1 + i % 50,
+        'Product': 'Ninja',
+        'ShippingTotal': 5,
+        'Items': [{'ProductName': 'Ninja', 'Quantity': 1 + i % 3, 'UnitPrice': 10}, {'ProductName': 'Pirate', 'Quantity': 2, 'UnitPrice': 2.5}]
+    } for i in range(count)]
+
+
+def test_bulk_import_statements_do_not_grow_with_the_batch(app, client, engine):
+    # the first import loads the product catalog
+    client.post('/orders/bulk', json=_orders(1))
+    counts = []
+    for size in (5, 200):
+        with count_queries(engine) as statements:
+            response = client.post('/orders/bulk', json=_orders(size))
+        assert response.get_json()['created'] == size
+        counts.append(len(statements))
+    assert counts[0] == counts[1]
+
+
+def test_bulk_import_maps_items_to_their_orders(app, client, engine):
+    assert client.post('/orders/bulk', json=_orders(20)).get_json()['created'] == 20
+    with app.app_context():
+        orders = session.query(OrderHeader).order_by(OrderHeader.OrderHeaderID.desc()).limit(20).all()
+        for order in orders:
+            assert len(order.orderItems) == 2
+            assert order.ItemTotal == pytest.approx(sum(item.Quantity * item.UnitPrice for item in order.orderItems))
+
+
+def test_bulk_import_does_not_reuse_the_ids_of_deleted_orders(app, client, engine):
+    client.post('/orders/bulk', json=_orders(3))
+    with app.app_context():
+        newest = session.query(func.max(OrderHeader.OrderHeaderID)).scalar()
+    assert client.delete(f'/orders/{newest}').status_code == 200
+    assert client.post('/orders/bulk', json=_orders(3)).get_json()['created'] == 3
+    with app.app_context():
+        ids = [row[0] for row in session.query(OrderHeader.OrderHeaderID).filter(OrderHeader.OrderHeaderID >= newest).order_by(OrderHeader.OrderHeaderID)]
+    assert ids == [newest + 1, newest + 2, newest + 3]
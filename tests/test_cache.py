@@ -0,0 +1,37 @@
+""" the response cache (cache.py) must not keep a response built from rows changed while it was read """
+from app.blueprints.orders.cache import ResponseCache
+
+
+def test_response_invalidated_while_built_is_not_cached(app):
+    cache = ResponseCache()
+    calls = []
+
+    @cache.cached(lambda id, data: [f'order:{id}'])
+    def get(resource, id):
+        calls.append(id)
+        if len(calls) == 1:
+            # a write to the order commits while the first response is being built
+            cache.invalidate([f'order:{id}'])
+        return {'OrderHeaderID': id, 'Version': len(calls)}, 200
+
+    with app.test_request_context('/orders/1'):
+        assert get(None, id=1).get_json()['Version'] == 1
+        assert get(None, id=1).get_json()['Version'] == 2
+        # built after the invalidation, so this one is kept
+        assert get(None, id=1).get_json()['Version'] == 2
+    assert len(calls) == 2
+    assert cache._running == {} and cache._invalidated == {}
+
+
+def test_other_tags_do_not_skip_the_cache(app):
+    cache = ResponseCache()
+
+    @cache.cached(lambda id, data: [f'order:{id}'])
+    def get(resource, id):
+        cache.invalidate(['order:2'])
+        return {'OrderHeaderID': id}, 200
+
+    with app.test_request_context('/orders/1'):
+        get(None, id=1)
+        get(None, id=1)
+    assert cache.stats['hits'] == 1
@@ -0,0 +1,32 @@
+""" long polls and event streams on /changes share a small number of waiter slots """
+import threading
+import time
+from app.blueprints.orders.changes import change_feed
+
+
+def test_waiters_are_limited(client, monkeypatch):
+    monkeypatch.setattr(change_feed, 'maxWaiters', 1)
+    since = client.get('/changes/latest').get_json()['ChangeID']
+    statuses = []
+    poll = threading.Thread(target=lambda: statuses.append(client.get(f'/changes?since={since}&wait=1').status_code))
+    poll.start()
+    deadline = time.monotonic() + 5
+    while change_feed.waiting == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    try:
+        assert change_feed.waiting == 1
+        response = client.get(f'/changes?since={since}&wait=1')
+        assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+        assert client.get(f'/changes?since={since}', headers={'Accept': 'text/event-stream'}).status_code == 503
+        # a poll that does not wait is still answered
+        assert client.get(f'/changes?since={since}').status_code == 200
+    finally:
+        poll.join()
+    assert statuses == [200] and change_feed.waiting == 0
+
+    # a stream gives its slot back when it is closed
+    monkeypatch.setattr(change_feed, 'streamSeconds', 0)
+    response = client.get(f'/changes?since={since}', headers={'Accept': 'text/event-stream'})
+    assert response.status_code == 200 and change_feed.waiting == 1
+    response.close()
+    assert change_feed.waiting == 0
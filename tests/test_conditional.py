@@ -0,0 +1,75 @@
+""" the single row GET routes send an ETag from the row Version and answer a matching If-None-Match with 304 """
+import pytest
+
+
+def _version(tag):
+    # table-id-epoch-version
+    return int(tag.strip('"').rsplit('-', 1)[1])
+
+
+@pytest.mark.parametrize('url', ['/orders/3', '/items/3', '/customers/3', '/products/1'])
+def test_etag_and_not_modified(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    tag = response.headers['ETag']
+    assert client.get(url, headers={'If-None-Match': tag}).status_code == 304
+
+
+def test_product_etag_changes_with_the_product(client):
+    tag = client.get('/products/1').headers['ETag']
+    price = client.get('/products/1').get_json()['UnitPrice']
+    assert client.put('/products/1', json={'UnitPrice': price + 1}, headers={'If-Match': tag}).status_code == 200
+    try:
+        response = client.get('/products/1', headers={'If-None-Match': tag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != tag
+        assert response.get_json()['UnitPrice'] == price + 1
+    finally:
+        client.put('/products/1', json={'UnitPrice': price})
+
+
+def test_order_put_bumps_the_version_once(client):
+    response = client.get('/orders/4')
+    tag, shipping = response.headers['ETag'], response.get_json()['ShippingTotal']
+    put = client.put('/orders/4', json={'ShippingTotal': shipping + 1}, headers={'If-Match': tag})
+    assert put.status_code == 200
+    assert _version(put.headers['ETag']) == _version(tag) + 1
+    response = client.get('/orders/4')
+    assert response.headers['ETag'] == put.headers['ETag']
+    assert response.get_json()['GrandTotal'] > 0
+
+
+def test_item_put_bumps_its_order_once(client):
+    item = client.get('/items/5').get_json()
+    orderTag = client.get(f'/orders/{item["OrderHeaderID"]}').headers['ETag']
+    assert client.put('/items/5', json={'Quantity': item['Quantity'] + 1}).status_code == 200
+    assert _version(client.get(f'/orders/{item["OrderHeaderID"]}').headers['ETag']) == _version(orderTag) + 1
+
+
+ORDER = {'Product': 'Ninja', 'ShippingTotal': 5, 'Items': [{'ProductName': 'Ninja', 'Quantity': 1, 'UnitPrice': 10}]}
+
+
+def test_deleted_order_tag_does_not_match_a_new_order(client):
+    created = client.post('/customers/2/create-order', json=ORDER).get_json()['id']
+    tag = client.get(f'/orders/{created}').headers['ETag']
+    assert client.delete(f'/orders/{created}').status_code == 200
+    # the id of the deleted (newest) order is not handed out again
+    recreated = client.post('/customers/2/create-order', json=ORDER).get_json()['id']
+    assert recreated != created
+    assert client.get(f'/orders/{recreated}', headers={'If-None-Match': tag}).status_code == 200
+    assert client.get(f'/orders/{created}', headers={'If-None-Match': tag}).status_code != 304
+
+
+def test_recreated_database_does_not_match_old_tags(client):
+    from app.blueprints.orders.cache import response_cache
+    from app.blueprints.orders.controller import create_sample_data
+
+    # ids the sample data reuses, with the same Version
+    urls = ['/orders/1', '/items/1', '/customers/1', '/products/1']
+    tags = {url: client.get(url).headers['ETag'] for url in urls}
+    create_sample_data()
+    response_cache.clear()
+    for url in urls:
+        response = client.get(url, headers={'If-None-Match': tags[url]})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != tags[url]
@@ -0,0 +1,35 @@
+""" a request holds its Idempotency-Key until it finishes, even when it runs longer than the lock """
+import threading
+import time
+from app.blueprints.orders.idempotency import IdempotencyStore, REPLAYED_HEADER
+
+
+def test_retry_after_the_lock_expired_does_not_run_the_handler_again(app):
+    store = IdempotencyStore()
+    store.lockSeconds = 0.05
+    calls, started, release = [], threading.Event(), threading.Event()
+
+    @store.idempotent
+    def handler(resource):
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return app.response_class('{}', status=201, mimetype='application/json')
+
+    def post():
+        with app.test_request_context('/orders', method='POST', headers={'Idempotency-Key': 'slow'}, data='{}'):
+            return handler(None)
+
+    first = threading.Thread(target=post)
+    first.start()
+    assert started.wait(5)
+    # the pending marker has expired by now
+    time.sleep(0.1)
+    try:
+        assert post().status_code == 409
+    finally:
+        release.set()
+        first.join()
+    response = post()
+    assert response.status_code == 201 and response.headers[REPLAYED_HEADER] == 'true'
+    assert calls == [1]
@@ -0,0 +1,26 @@
+""" the per endpoint metrics (instrumentation.py) cover the whole body of streamed responses """
+from app.blueprints.orders.instrumentation import instrumentation
+from app.blueprints.orders.pagination import STREAM_BATCH_SIZE
+
+
+def test_streamed_response_is_recorded_when_closed(client):
+    instrumentation.reset()
+    response = client.get('/items?stream=true')
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) > STREAM_BATCH_SIZE
+    # not recorded until the server closes the response
+    assert ('GET', '/items') not in instrumentation._metrics
+    response.close()
+
+    metrics = instrumentation._metrics[('GET', '/items')]
+    assert metrics.requests == 1
+    # the rows are loaded while the body is sent
+    assert metrics.statements >= 1
+    assert metrics.rows >= len(lines)
+
+
+def test_buffered_response_is_recorded(client):
+    instrumentation.reset()
+    response = client.get('/orders/3')
+    assert 'orm rows' in response.headers['Server-Timing']
+    assert instrumentation._metrics[('GET', '/orders/<int:id>')].requests == 1
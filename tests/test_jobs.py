@@ -0,0 +1,43 @@
+""" exclusive job types are single-flight: submitting one while it is queued or running returns that job """
+import threading
+import time
+from app.blueprints.orders.jobs import job_queue
+
+
+def _wait_for(client, jobId, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f'/jobs/{jobId}').get_json()
+        if job['Status'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'job {jobId} did not finish')
+
+
+def test_recreate_database_twice_runs_one_job(client, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def blocking(progress, **params):
+        started.set()
+        release.wait(5)
+        return {}
+
+    # keep the registered schema and exclusive flag, only hold the job open until both submits are in
+    schema, exclusive = job_queue.types['create-sample-data'][1:]
+    monkeypatch.setitem(job_queue.types, 'create-sample-data', (blocking, schema, exclusive))
+    monkeypatch.setattr(job_queue, 'workers', 1)
+
+    first = client.post('/orders/recreate-database').get_json()['id']
+    assert started.wait(5)
+    try:
+        assert client.post('/orders/recreate-database').get_json()['id'] == first
+        assert client.post('/jobs', json={'type': 'create-sample-data', 'params': {}}).get_json()['JobID'] == first
+    finally:
+        release.set()
+    assert _wait_for(client, first)['Status'] == 'succeeded'
+    assert client.get('/jobs?Type=create-sample-data').get_json() == [client.get(f'/jobs/{first}').get_json()]
+
+    # once it finished a new one can start
+    second = client.post('/orders/recreate-database').get_json()['id']
+    assert second != first
+    assert _wait_for(client, second)['Status'] == 'succeeded'
@@ -0,0 +1,47 @@
+""" the collection routes page by default, and the X-Next-Cursor header walks every record once """
+import json
+import pytest
+from app.blueprints.orders.loaders import assert_query_count
+from app.blueprints.orders.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+# url -> the key the route pages by, OrderItemSchema does not dump OrderItemID so items are compared whole
+COLLECTIONS = {'/orders': 'OrderHeaderID', '/items': None, '/customers': 'CustomerID'}
+
+
+def _key(row, key):
+    return row[key] if key else row
+
+
+@pytest.mark.parametrize('url', sorted(COLLECTIONS))
+def test_default_page_size(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert len(response.get_json()) == DEFAULT_PAGE_SIZE
+    if COLLECTIONS[url]:
+        assert response.headers['X-Next-Cursor'] == str(response.get_json()[-1][COLLECTIONS[url]])
+    assert response.headers['Link'].endswith(f'after={response.headers["X-Next-Cursor"]}>; rel="next"')
+
+
+def test_limit_is_capped(client):
+    assert len(client.get(f'/items?limit={MAX_PAGE_SIZE * 10}').get_json()) == MAX_PAGE_SIZE
+
+
+@pytest.mark.parametrize('url', sorted(COLLECTIONS))
+def test_cursor_walks_the_stream(client, url):
+    key = COLLECTIONS[url]
+    streamed = [_key(json.loads(line), key) for line in client.get(f'{url}?stream=true').get_data(as_text=True).splitlines()]
+    assert len(streamed) > DEFAULT_PAGE_SIZE
+
+    paged = []
+    response = client.get(f'{url}?limit=300')
+    while True:
+        paged += [_key(row, key) for row in response.get_json()]
+        if 'X-Next-Cursor' not in response.headers:
+            break
+        response = client.get(f'{url}?limit=300&after={response.headers["X-Next-Cursor"]}')
+    assert paged == streamed
+
+
+def test_default_page_query_count(client, engine):
+    with assert_query_count(engine, 2):
+        client.get('/orders')
@@ -0,0 +1,32 @@
+""" pins the number of SQL statements per request, so a lazy load that sneaks back in (N+1) fails here """
+import pytest
+from app.blueprints.orders.loaders import assert_query_count, count_queries
+
+# url -> statements: the rows, then one selectinload() per relationship the schema dumps
+QUERY_COUNTS = {
+    '/orders?limit=50': 2,
+    '/items?limit=50': 1,
+    '/customers?limit=50': 1,
+    # the versions for the ETag, then the customer, its orders and their items
+    '/customers/7': 5,
+    '/orders/7': 3
+}
+
+
+@pytest.mark.parametrize('url', sorted(QUERY_COUNTS))
+def test_query_count(client, engine, url):
+    with assert_query_count(engine, QUERY_COUNTS[url]):
+        response = client.get(url)
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('url', ['/orders', '/items', '/customers'])
+def test_query_count_does_not_grow_with_page_size(client, engine, url):
+    counts = []
+    for limit in (5, 200):
+        with count_queries(engine) as statements:
+            response = client.get(f'{url}?limit={limit}')
+        assert response.status_code == 200
+        assert len(response.get_json()) == limit
+        counts.append(len(statements))
+    assert counts[0] == counts[1]
@@ -0,0 +1,9 @@
+""" runs the query plan regression check (queryplan.py) against the seeded database """
+import pytest
+from app.blueprints.orders.queryplan import PLAN_CHECKS, check_query_plans
+
+
+@pytest.mark.parametrize('url', PLAN_CHECKS)
+def test_no_table_scans(app, engine, url):
+    failures = check_query_plans(app, engine, [url])
+    assert not failures.get(url), '\n'.join(f'{detail}: {" ".join(statement.split())}' for statement, detail in failures[url])
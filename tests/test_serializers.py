@@ -0,0 +1,42 @@
+""" the compiled serializers (serializers.py) must encode to the same bytes as the marshmallow schemas """
+import json
+import pytest
+from app.blueprints.orders.database import session
+from app.blueprints.orders.loaders import query_for_schema
+from app.blueprints.orders.models import Customer, OrderHeader, OrderItem
+from app.blueprints.orders.schemas import CustomerSchema, OrderHeaderSchema, OrderItemSchema
+from app.blueprints.orders.serializers import compiled, dumps
+
+# every schema a list route dumps: schema factory, model and the key the route pages by
+LIST_SCHEMAS = {
+    'OrderHeaderSchema': (lambda **kwargs: OrderHeaderSchema(**kwargs), OrderHeader, OrderHeader.OrderHeaderID),
+    'OrderItemSchema': (lambda **kwargs: OrderItemSchema(**kwargs), OrderItem, OrderItem.OrderItemID),
+    'CustomerSchema': (lambda **kwargs: CustomerSchema(exclude=['Orders'], **kwargs), Customer, Customer.CustomerID)
+}
+
+
+@pytest.fixture(params=sorted(LIST_SCHEMAS))
+def case(request, app, engine):
+    factory, model, key = LIST_SCHEMAS[request.param]
+    with app.app_context():
+        objects = query_for_schema(session, model, factory(many=True)).order_by(key).limit(200).all()
+        yield factory, objects
+
+
+def test_compiled_dump_is_identical(case):
+    factory, objects = case
+    assert dumps(compiled(factory(many=True)).dump(objects)) == dumps(factory(many=True).dump(objects))
+    assert dumps(compiled(factory()).dump(objects[0])) == dumps(factory().dump(objects[0]))
+
+
+def test_encoder_keeps_key_order_and_float_format(case):
+    factory, objects = case
+    data = factory(many=True).dump(objects)
+    # the same bytes as the standard library encoder (compact), whichever encoder dumps() picked
+    assert dumps(data) == json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    assert list(json.loads(dumps(data))[0]) == list(data[0])
+
+
+def test_encoder_falls_back_for_settings():
+    encoded = dumps({'b': 1.5, 'a': [1, 2]}, indent=2)
+    assert '\n' in encoded and json.loads(encoded) == {'b': 1.5, 'a': [1, 2]}
@@ -0,0 +1,4 @@
+from app import create_app
+
+# wsgi entry point, serve with any WSGI server: gunicorn wsgi:app
+app = create_app()